@@ -0,0 +1,120 @@
+"""
+
+    bench_import.py
+
+    Import time benchmark for GreynirTopic
+
+    Copyright (C) 2020 by Miðeind ehf.
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+    This program measures the time and memory that it takes to import
+    parts of GreynirTopic in a fresh Python interpreter, and reports
+    which of the heavy dependencies (Gensim, SciPy, the Greynir parser)
+    each import pulls in.
+
+    Usage: python bench/bench_import.py [--repeat N] [--json]
+
+"""
+
+from typing import Dict, List, Any
+
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+
+# The import statements to measure
+STATEMENTS = [
+    "import numpy",
+    "from greynir_topic import Model",
+    "from greynir_topic import Model, TupleModel, ServingState",
+    "from greynir_topic import Dictionary",
+    "from greynir_topic import TokenDocument",
+]
+
+# Heavy dependencies whose presence in sys.modules is reported
+HEAVY_MODULES = ["gensim", "scipy", "reynir"]
+
+# Executed in the child interpreter: runs the statement and prints
+# the elapsed time, the peak memory use and the heavy modules loaded
+_CHILD = """
+import sys, time, json, resource
+t0 = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - t0
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+if sys.platform == "darwin":
+    rss //= 1024
+print(json.dumps(dict(
+    seconds=elapsed, max_rss_kb=rss,
+    loaded=[m for m in {heavy!r} if m in sys.modules],
+)))
+"""
+
+
+def measure(statement: str, repeat: int) -> Dict[str, Any]:
+    """ Run an import statement in repeat fresh interpreters
+        and return the median import time and peak memory """
+    env = dict(os.environ)
+    src = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    code = _CHILD.format(statement=statement, heavy=HEAVY_MODULES)
+    runs = []  # type: List[Dict[str, Any]]
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", code], env=env, check=True,
+            stdout=subprocess.PIPE, universal_newlines=True,
+        ).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return dict(
+        statement=statement,
+        median_ms=1000.0 * statistics.median(r["seconds"] for r in runs),
+        max_rss_mb=statistics.median(r["max_rss_kb"] for r in runs) / 1024.0,
+        loaded=runs[0]["loaded"],
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="GreynirTopic import time benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per statement")
+    parser.add_argument("--json", action="store_true", help="output JSON")
+    args = parser.parse_args()
+    results = [measure(statement, args.repeat) for statement in STATEMENTS]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results:
+        print(
+            "{0:<60} {1:8.1f} ms {2:8.1f} MB   {3}".format(
+                r["statement"], r["median_ms"], r["max_rss_mb"],
+                ", ".join(r["loaded"]) or "-",
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
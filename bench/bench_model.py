@@ -0,0 +1,452 @@
+"""
+
+    bench_model.py
+
+    Training, inference and memory benchmarks for GreynirTopic
+
+    Copyright (C) 2020 by Miðeind ehf.
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+    This program measures the performance of GreynirTopic on a synthetic
+    corpus of lemma/category strings, whose vocabulary follows Zipf's law,
+    so that the results are reproducible without any corpus data:
+
+    * training: the time, throughput and memory use of each training
+      stage, as reported by Model.training_report
+    * topic_vector: the latency (median and 99th percentile) of single
+      topic vector calculations, and of batches via topic_vectors()
+    * nearest_neighbors: queries per second for indexes of several sizes
+      (filled with random unit vectors), exact and, optionally, with an
+      approximate nearest neighbor index
+    * lemmatization: documents and lemmas per second for TokenDocument
+      and, optionally, ParsedDocument, on a sample of Icelandic text
+    * the peak memory use of the benchmark process
+
+    The results can be written to a JSON file and compared with those
+    of an earlier run.
+
+    Usage: python bench/bench_model.py [options]
+           (see python bench/bench_model.py --help)
+
+"""
+
+from typing import Iterator, List, Dict, Sequence, Any, Optional
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+
+_SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+if _SRC not in sys.path:
+    sys.path.insert(0, _SRC)
+
+import greynir_topic  # noqa: E402
+from greynir_topic import Model, Document, Corpus  # noqa: E402
+from greynir_topic.index import DenseIndex  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None  # type: ignore
+
+
+# Syllables from which synthetic lemmas are formed
+_SYLLABLES = [
+    "a", "á", "ar", "ber", "bú", "dal", "ey", "fjör", "ga", "gerð", "hús",
+    "i", "ís", "kon", "la", "leg", "ma", "mál", "nes", "ó", "ráð", "rík",
+    "sa", "skip", "staf", "stein", "tal", "un", "ur", "val", "vík", "þing",
+    "ör", "æ", "ætt",
+]
+
+# Word categories of synthetic lemmas, with their relative frequencies
+_CATEGORIES = [
+    ("kk", 0.24), ("kvk", 0.2), ("hk", 0.2), ("so", 0.16),
+    ("lo", 0.12), ("ao", 0.05), ("fs", 0.03),
+]
+
+# A sample of Icelandic text for the lemmatization benchmark
+_SAMPLE_TEXT = [
+    "Maðurinn fór út í búð að kaupa mat handa fjölskyldunni.",
+    "Búðin var lokuð vegna veðurs og hann varð leiður.",
+    "Ríkisstjórnin kynnti í dag nýtt frumvarp um breytingar á lögum um fiskveiðar.",
+    "Veðurstofan spáir hvassri norðanátt og snjókomu á Norðurlandi í nótt.",
+    "Tónleikarnir í Hörpu voru vel sóttir og áhorfendur fögnuðu ákaft.",
+    "Nemendur skólans tóku þátt í keppni í stærðfræði og stóðu sig vel.",
+    "Flugvélin lenti á Keflavíkurflugvelli skömmu eftir hádegi.",
+    "Sveitarfélagið hyggst byggja nýjan leikskóla á næsta ári.",
+]
+
+
+def synthetic_vocabulary(size: int, seed: int = 0) -> List[str]:
+    """ Return a list of size distinct, Icelandic-looking
+        lemma/category strings, in random order """
+    rng = np.random.RandomState(seed)
+    cats = [c for c, _ in _CATEGORIES]
+    p = np.array([w for _, w in _CATEGORIES])
+    p /= p.sum()
+    vocabulary = []  # type: List[str]
+    seen = set()
+    while len(vocabulary) < size:
+        n = 1 + rng.poisson(1.5)
+        lemma = "".join(rng.choice(_SYLLABLES, n))
+        word = "{0}/{1}".format(lemma, cats[rng.choice(len(cats), p=p)])
+        if word not in seen:
+            seen.add(word)
+            vocabulary.append(word)
+    return vocabulary
+
+
+class SyntheticDocument(Document):
+
+    """ A document consisting of a given list of lemmas """
+
+    def __init__(self, lemmas: List[str]) -> None:
+        super().__init__()
+        self._lemmas = lemmas
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._lemmas)
+
+
+class SyntheticCorpus(Corpus):
+
+    """ A reproducible corpus of documents whose lemmas are drawn
+        from a vocabulary with Zipfian frequencies (the r-th most
+        frequent lemma has a frequency proportional to 1 / r**zipf),
+        with document lengths drawn from a log-normal distribution """
+
+    def __init__(
+        self, num_docs: int, *, vocabulary_size: int = 20000,
+        doc_length: int = 150, zipf: float = 1.1, seed: int = 0
+    ) -> None:
+        super().__init__()
+        self._num_docs = num_docs
+        self._doc_length = doc_length
+        self._seed = seed
+        self._vocabulary = synthetic_vocabulary(vocabulary_size, seed)
+        weights = 1.0 / np.arange(1, vocabulary_size + 1) ** zipf
+        self._cdf = np.cumsum(weights / weights.sum())
+        self._params = (num_docs, vocabulary_size, doc_length, zipf, seed)
+
+    def __len__(self) -> int:
+        return self._num_docs
+
+    def document(self, i: int) -> List[str]:
+        """ Return the lemmas of the i-th document; the same
+            lemmas are returned on every call """
+        rng = np.random.RandomState((self._seed, i))
+        n = max(1, int(rng.lognormal(np.log(self._doc_length), 0.5)))
+        ranks = np.searchsorted(self._cdf, rng.random_sample(n))
+        ranks = np.minimum(ranks, len(self._vocabulary) - 1)
+        vocabulary = self._vocabulary
+        return [vocabulary[r] for r in ranks.tolist()]
+
+    def __iter__(self) -> Iterator[Document]:
+        for i in range(self._num_docs):
+            yield SyntheticDocument(self.document(i))
+
+    def fingerprint(self) -> str:
+        return "synthetic:{0}".format(self._params)
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0)
+
+
+def _latency(seconds: Sequence[float]) -> Dict[str, float]:
+    """ Summarize a list of latencies, in milliseconds """
+    ms = 1000.0 * np.asarray(seconds)
+    return dict(
+        p50_ms=float(np.percentile(ms, 50)),
+        p99_ms=float(np.percentile(ms, 99)),
+        mean_ms=float(ms.mean()),
+    )
+
+
+def bench_training(
+    model: Model, corpus: SyntheticCorpus, *, processes: int, ann_lists: int
+) -> Dict[str, Any]:
+    """ Train a similarity model and return the metrics of each stage """
+    t0 = time.perf_counter()
+    model.train_similarity(
+        corpus, min_count=3, max_ratio=0.5, processes=processes, ann_lists=ann_lists
+    )
+    total = time.perf_counter() - t0
+    report = model.training_report
+    assert report is not None
+    return dict(
+        total_seconds=total,
+        stages={s["stage"]: s for s in report.stages},
+    )
+
+
+def bench_topic_vector(
+    model: Model, corpus: SyntheticCorpus, *, num_queries: int, batch_size: int
+) -> Dict[str, Any]:
+    """ Measure single and batched topic vector latencies """
+    queries = [corpus.document(i % len(corpus)) for i in range(num_queries)]
+    model.warm_up()
+    single = []  # type: List[float]
+    for lemmas in queries:
+        t0 = time.perf_counter()
+        model.topic_vector(lemmas)
+        single.append(time.perf_counter() - t0)
+    batched = []  # type: List[float]
+    for start in range(0, num_queries, batch_size):
+        batch = queries[start : start + batch_size]
+        t0 = time.perf_counter()
+        model.topic_vectors(batch)
+        batched.append(time.perf_counter() - t0)
+    return dict(
+        single=_latency(single),
+        batch=dict(
+            _latency(batched),
+            batch_size=batch_size,
+            documents_per_second=num_queries / sum(batched),
+        ),
+    )
+
+
+def bench_nearest_neighbors(
+    directory: str, dimensions: int, sizes: Sequence[int], *,
+    num_queries: int, num_neighbors: int, ann_lists: int, probes: int, seed: int
+) -> List[Dict[str, Any]]:
+    """ Measure nearest neighbor queries per second for similarity
+        indexes of the given sizes, filled with random unit vectors """
+    rng = np.random.RandomState(seed)
+    results = []  # type: List[Dict[str, Any]]
+    for size in sizes:
+        model = Model("nn{0}".format(size), directory=directory, dimensions=dimensions)
+
+        def chunks() -> Iterator[np.ndarray]:
+            for start in range(0, size, 65536):
+                n = min(65536, size - start)
+                yield rng.standard_normal((n, dimensions)).astype(np.float32)
+
+        DenseIndex.build_dense(model.simindex_filename, chunks(), dimensions)
+        queries = [
+            list(enumerate(q.tolist()))
+            for q in rng.standard_normal((num_queries, dimensions))
+        ]
+        model.load_similarity_index()
+        result = dict(size=size)  # type: Dict[str, Any]
+        t0 = time.perf_counter()
+        for q in queries:
+            model.nearest_neighbors(q, num_neighbors)
+        result["exact_qps"] = num_queries / (time.perf_counter() - t0)
+        if ann_lists > 0 and size >= ann_lists:
+            model.calculate_ann_index(ann_lists)
+            t0 = time.perf_counter()
+            for q in queries:
+                model.nearest_neighbors(q, num_neighbors, probes=probes)
+            result["ann_qps"] = num_queries / (time.perf_counter() - t0)
+            result["ann_lists"] = ann_lists
+            result["probes"] = probes
+        results.append(result)
+    return results
+
+
+def bench_lemmatization(num_docs: int, *, parse: bool) -> Dict[str, Any]:
+    """ Measure the lemmatization rate of TokenDocument and,
+        if parse is True, ParsedDocument """
+    from greynir_topic import TokenDocument, ParsedDocument
+
+    texts = [_SAMPLE_TEXT[i % len(_SAMPLE_TEXT)] for i in range(num_docs)]
+    classes = [TokenDocument] + ([ParsedDocument] if parse else [])
+    result = {}  # type: Dict[str, Any]
+    for cls in classes:
+        if cls is ParsedDocument:
+            # Exclude the one-time loading of the parser
+            list(cls(texts[0]))
+        lemmas = 0
+        t0 = time.perf_counter()
+        for text in texts:
+            lemmas += sum(1 for _ in cls(text))
+        elapsed = time.perf_counter() - t0
+        result[cls.__name__] = dict(
+            documents=num_docs,
+            lemmas=lemmas,
+            documents_per_second=num_docs / elapsed,
+            lemmas_per_second=lemmas / elapsed,
+        )
+    return result
+
+
+def environment() -> Dict[str, Any]:
+    """ Return information about the environment of the benchmark """
+    import gensim  # type: ignore
+
+    return dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        processor=platform.processor(),
+        cpus=os.cpu_count(),
+        numpy=np.__version__,
+        gensim=gensim.__version__,
+        greynir_topic=greynir_topic.__version__,
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+
+
+def _flatten(d: Any, prefix: str = "") -> Dict[str, float]:
+    """ Flatten the numeric leaves of a nested result into a dict """
+    result = {}  # type: Dict[str, float]
+    if isinstance(d, dict):
+        for k, v in d.items():
+            result.update(_flatten(v, "{0}{1}.".format(prefix, k)))
+    elif isinstance(d, list):
+        for item in d:
+            key = item.get("size", len(result)) if isinstance(item, dict) else len(result)
+            result.update(_flatten(item, "{0}{1}.".format(prefix, key)))
+    elif isinstance(d, (int, float)) and not isinstance(d, bool):
+        result[prefix[:-1]] = float(d)
+    return result
+
+
+# Metrics that are compared with an earlier run, by suffix
+_COMPARED = ("seconds", "_ms", "_qps", "per_second", "rss_mb")
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any]) -> None:
+    """ Print the ratio of each timing, throughput and memory
+        metric to its value in a baseline run """
+    old = _flatten({k: v for k, v in baseline.items() if k != "environment"})
+    new = _flatten({k: v for k, v in results.items() if k != "environment"})
+    for key in sorted(old.keys() & new.keys()):
+        if key.endswith(_COMPARED) and old[key] > 0.0:
+            print(
+                "{0:<60} {1:12.3f} {2:12.3f} {3:8.2f}x".format(
+                    key, old[key], new[key], new[key] / old[key]
+                )
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="GreynirTopic benchmarks")
+    parser.add_argument("--docs", type=int, default=2000, help="documents in the corpus")
+    parser.add_argument("--vocabulary", type=int, default=20000, help="vocabulary size")
+    parser.add_argument("--doc-length", type=int, default=150, help="median document length")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent")
+    parser.add_argument("--dimensions", type=int, default=100, help="topic vector dimensions")
+    parser.add_argument("--processes", type=int, default=1, help="training processes")
+    parser.add_argument(
+        "--index-sizes", default="1000,10000,100000",
+        help="comma-separated similarity index sizes",
+    )
+    parser.add_argument("--queries", type=int, default=200, help="queries per measurement")
+    parser.add_argument("--batch", type=int, default=64, help="topic vector batch size")
+    parser.add_argument("--neighbors", type=int, default=10, help="neighbors per query")
+    parser.add_argument("--ann-lists", type=int, default=0, help="ANN inverted lists (0 = none)")
+    parser.add_argument("--probes", type=int, default=8, help="ANN probes per query")
+    parser.add_argument("--lemmatize", type=int, default=200, help="documents to lemmatize")
+    parser.add_argument("--parse", action="store_true", help="also benchmark ParsedDocument")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    parser.add_argument("--json", action="store_true", help="output JSON")
+    args = parser.parse_args()
+
+    corpus = SyntheticCorpus(
+        args.docs, vocabulary_size=args.vocabulary,
+        doc_length=args.doc_length, zipf=args.zipf, seed=args.seed,
+    )
+    results = dict(
+        environment=environment(),
+        params={k: v for k, v in vars(args).items() if k not in ("output", "compare", "json")},
+    )  # type: Dict[str, Any]
+    with tempfile.TemporaryDirectory() as directory:
+        model = Model("bench", directory=directory, dimensions=args.dimensions)
+        results["training"] = bench_training(
+            model, corpus, processes=args.processes, ann_lists=args.ann_lists
+        )
+        results["topic_vector"] = bench_topic_vector(
+            model, corpus, num_queries=args.queries, batch_size=args.batch
+        )
+        results["nearest_neighbors"] = bench_nearest_neighbors(
+            directory, args.dimensions,
+            [int(n) for n in args.index_sizes.split(",") if n],
+            num_queries=args.queries, num_neighbors=args.neighbors,
+            ann_lists=args.ann_lists, probes=args.probes, seed=args.seed,
+        )
+    if args.lemmatize > 0:
+        results["lemmatization"] = bench_lemmatization(args.lemmatize, parse=args.parse)
+    results["peak_rss_mb"] = _peak_rss_mb()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        training = results["training"]
+        for name, stage in training["stages"].items():
+            rate = stage.get("documents_per_second")
+            print(
+                "training {0:<20} {1:10.3f} s {2}".format(
+                    name, stage["wall_seconds"],
+                    "{0:12.1f} docs/s".format(rate) if rate is not None else "",
+                )
+            )
+        tv = results["topic_vector"]
+        print(
+            "topic_vector single      p50 {0:.3f} ms  p99 {1:.3f} ms".format(
+                tv["single"]["p50_ms"], tv["single"]["p99_ms"]
+            )
+        )
+        print(
+            "topic_vectors batch {0:<4} p50 {1:.3f} ms  p99 {2:.3f} ms".format(
+                tv["batch"]["batch_size"], tv["batch"]["p50_ms"], tv["batch"]["p99_ms"]
+            )
+        )
+        for nn in results["nearest_neighbors"]:
+            print(
+                "nearest_neighbors {0:>9} {1:10.1f} qps{2}".format(
+                    nn["size"], nn["exact_qps"],
+                    "  (ANN {0:.1f} qps)".format(nn["ann_qps"]) if "ann_qps" in nn else "",
+                )
+            )
+        for name, lem in results.get("lemmatization", {}).items():
+            print(
+                "{0:<24} {1:10.1f} docs/s {2:12.1f} lemmas/s".format(
+                    name, lem["documents_per_second"], lem["lemmas_per_second"]
+                )
+            )
+        if results["peak_rss_mb"] is not None:
+            print("peak memory {0:.1f} MB".format(results["peak_rss_mb"]))
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,20 +29,51 @@
 
 # Expose the greynir-topic API
 
+import sys
+from typing import Any
+
 from .model import (
     Document,
     Corpus,
-    Dictionary,
     Model,
 )
 from .tuplemodel import (
     TupleModel,
     TupleDocument,
 )
-from .tokenmodel import (
-    TokenDocument,
-    ParsedDocument,
-)
+from .parsecache import ParseCache
+from .serving import ServingState
+from .metrics import TrainingObserver, TrainingReport
+
+# Classes that are imported on first access, since importing them
+# pulls in heavy dependencies (Gensim and the Greynir parser) that
+# services which only serve models do not need
+_LAZY = {
+    "Dictionary": ".dictionary",
+    "TokenDocument": ".tokenmodel",
+    "ParsedDocument": ".tokenmodel",
+}
+
+
+def __getattr__(name: str) -> Any:
+    """ Module attribute lookup hook (cf. PEP 562) """
+    if name in _LAZY:
+        from importlib import import_module
+
+        value = getattr(import_module(_LAZY[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+def __dir__() -> Any:
+    return sorted(set(globals()) | set(_LAZY))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ is not supported: import everything up front
+    from .dictionary import Dictionary
+    from .tokenmodel import TokenDocument, ParsedDocument
 
 __author__ = u"Miðeind ehf"
 __copyright__ = "(C) 2020 Miðeind ehf."
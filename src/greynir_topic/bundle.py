@@ -0,0 +1,170 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Single-file model bundles
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module implements a file format that packs a number of named
+    NumPy arrays, along with arbitrary JSON metadata, into a single file.
+    It is used to store the serving state of a model (see serving.py),
+    so that a model can be deployed by copying one file, and loaded
+    without unpickling anything.
+
+    The file layout is as follows:
+
+    * the magic string b"GTBUNDLE"
+    * the format version, as a little-endian 32-bit unsigned integer
+    * the length of the header, as a little-endian 32-bit unsigned integer
+    * the header: a UTF-8 encoded JSON object containing the metadata
+      and a table of sections, giving the name, dtype, shape, file
+      offset, size and SHA-256 checksum of each array
+    * the arrays, in raw C order, each starting on a 64-byte boundary
+
+    The arrays are memory-mapped in place when a bundle is read, so
+    reading is nearly instantaneous regardless of the bundle size.
+
+"""
+
+from typing import Dict, Tuple, Any
+
+import os
+import json
+import hashlib
+
+import numpy as np  # type: ignore
+
+
+# Identifies a bundle file
+_MAGIC = b"GTBUNDLE"
+
+# The current version of the file format
+BUNDLE_VERSION = 1
+
+# Sections start on 64-byte boundaries, i.e. at the start of a cache line
+_ALIGNMENT = 64
+
+# Size of the fixed part of the file, before the header
+_PREFIX_SIZE = len(_MAGIC) + 4 + 4
+
+
+def _align(offset: int) -> int:
+    """ Round an offset up to the next alignment boundary """
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _header(sections: Dict[str, Any], metadata: Dict[str, Any]) -> bytes:
+    return json.dumps(
+        {"metadata": metadata, "sections": sections}, sort_keys=True
+    ).encode("utf-8")
+
+
+def write_bundle(
+    filename: str, arrays: Dict[str, np.ndarray], metadata: Dict[str, Any] = None
+) -> None:
+    """ Write a dict of named arrays, and a dict of JSON-serializable
+        metadata, to a bundle file. The file is first written under a
+        temporary name and then renamed, so that readers never see
+        a partially written bundle. """
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    # Lay out the sections relative to the start of the data area
+    sections = {}  # type: Dict[str, Dict[str, Any]]
+    offset = 0
+    for name in sorted(arrays):
+        a = arrays[name]
+        sections[name] = dict(
+            dtype=a.dtype.str,
+            shape=list(a.shape),
+            offset=offset,
+            nbytes=a.nbytes,
+            sha256=hashlib.sha256(a.data).hexdigest(),
+        )
+        offset = _align(offset + a.nbytes)
+    # Convert the section offsets to file offsets. Doing so lengthens
+    # the header, which may in turn move the data area; repeat until
+    # the offsets are stable.
+    start = 0
+    while True:
+        placed = {
+            name: dict(info, offset=start + info["offset"])
+            for name, info in sections.items()
+        }
+        header = _header(placed, metadata or {})
+        data_start = _align(_PREFIX_SIZE + len(header))
+        if data_start == start:
+            break
+        start = data_start
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "wb") as f:
+        f.write(_MAGIC)
+        f.write(BUNDLE_VERSION.to_bytes(4, "little"))
+        f.write(len(header).to_bytes(4, "little"))
+        f.write(header)
+        for name in sorted(arrays):
+            f.write(b"\0" * (placed[name]["offset"] - f.tell()))
+            f.write(arrays[name].data)
+    os.replace(temp_filename, filename)
+
+
+def read_bundle_header(filename: str) -> Dict[str, Any]:
+    """ Read and return the header of a bundle file, containing
+        its metadata and table of sections """
+    with open(filename, "rb") as f:
+        prefix = f.read(_PREFIX_SIZE)
+        if len(prefix) < _PREFIX_SIZE or prefix[: len(_MAGIC)] != _MAGIC:
+            raise ValueError("{0} is not a model bundle".format(filename))
+        version = int.from_bytes(prefix[len(_MAGIC) : len(_MAGIC) + 4], "little")
+        if version > BUNDLE_VERSION:
+            raise ValueError(
+                "Unsupported model bundle version {0} in {1}".format(version, filename)
+            )
+        header_len = int.from_bytes(prefix[len(_MAGIC) + 4 :], "little")
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    header["version"] = version
+    return header
+
+
+def read_bundle(
+    filename: str, *, verify: bool = False
+) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """ Read a bundle file, returning its arrays, memory-mapped in place,
+        and its metadata. If verify is True, the checksum of each array
+        is verified, which requires reading the entire file. """
+    header = read_bundle_header(filename)
+    arrays = {}
+    for name, info in header["sections"].items():
+        dtype = np.dtype(info["dtype"])
+        shape = tuple(info["shape"])
+        if info["nbytes"] == 0:
+            # An empty array cannot be memory-mapped
+            a = np.empty(shape, dtype=dtype)
+        else:
+            a = np.memmap(filename, dtype=dtype, mode="r", offset=info["offset"], shape=shape)
+        if verify and hashlib.sha256(a.data).hexdigest() != info["sha256"]:
+            raise ValueError(
+                "Checksum mismatch in section '{0}' of {1}".format(name, filename)
+            )
+        arrays[name] = a
+    return arrays, header["metadata"]
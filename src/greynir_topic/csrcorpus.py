@@ -0,0 +1,294 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Binary sparse vector corpus
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module implements a binary format for the intermediate vector
+    corpora that are created during training. A corpus is stored as the
+    three arrays of a compressed sparse row (CSR) matrix, with one row
+    per document, in separate .npy files:
+
+    * base.indptr.npy: the start of each row within indices and data,
+      followed by the total number of nonzero elements (int64)
+    * base.indices.npy: the column (term) index of each element (int32)
+    * base.data.npy: the value of each element (float32)
+
+    The files are written incrementally and memory-mapped when read.
+    Iterating over a CsrCorpus yields each document as a Gensim-compatible
+    bag-of-words, i.e. a list of (term index, value) tuples.
+
+"""
+
+from typing import Iterator, Iterable, List, Tuple, Optional, Any
+
+import os
+
+import numpy as np  # type: ignore
+
+from .npyio import NpyWriter
+
+
+# A sparse vector, i.e. a list of (index, value) tuples
+SparseVector = List[Tuple[int, float]]
+
+# Default number of documents in each chunk when iterating by chunks
+_DEFAULT_CHUNKSIZE = 4096
+
+
+def tfidf_transform(matrix: Any, idfs: np.ndarray, eps: float = 1e-12) -> Any:
+    """ Apply the default Gensim TFIDF transformation (term count times
+        idf weight, followed by L2 normalization) to the rows of a CSR
+        bag-of-words matrix. The result is identical to that of
+        gensim.models.TfidfModel, up to floating point rounding. """
+    m = matrix.copy()
+    m.data = m.data * idfs[m.indices].astype(m.data.dtype)
+    m.eliminate_zeros()
+    sq = m.copy()
+    sq.data = sq.data.astype(np.float64) ** 2
+    norms = np.sqrt(np.asarray(sq.sum(axis=1)).ravel())
+    nonzero = norms > 0.0
+    scale = np.ones_like(norms)
+    scale[nonzero] = 1.0 / norms[nonzero]
+    rows = np.repeat(np.arange(m.shape[0]), np.diff(m.indptr))
+    m.data = (m.data * scale[rows]).astype(matrix.dtype)
+    # Drop negligible weights, as Gensim does
+    m.data[np.abs(m.data) <= eps] = 0.0
+    m.eliminate_zeros()
+    return m
+
+
+def _rows(
+    indptr: np.ndarray, indices: np.ndarray, data: np.ndarray
+) -> Iterator[SparseVector]:
+    """ Yield the rows of a CSR matrix as lists of (index, value) tuples """
+    # Convert the whole matrix to Python objects at once
+    offsets = indptr.tolist()
+    indices = indices.tolist()
+    data = data.tolist()
+    for a, b in zip(offsets[:-1], offsets[1:]):
+        yield list(zip(indices[a:b], data[a:b]))
+
+
+class CsrWriter:
+
+    """ Writes a CsrCorpus incrementally, one document
+        or one block of documents at a time """
+
+    def __init__(self, base_filename: str) -> None:
+        self._indptr = NpyWriter(base_filename + ".indptr.npy", np.int64)
+        self._indices = NpyWriter(base_filename + ".indices.npy", np.int32)
+        self._data = NpyWriter(base_filename + ".data.npy", np.float32)
+        self._nnz = 0
+        self._indptr.write(np.zeros(1, dtype=np.int64))
+
+    def add_document(self, vector: SparseVector) -> None:
+        """ Append a single sparse document vector """
+        n = len(vector)
+        if n:
+            indices, data = zip(*vector)
+            self._indices.write(np.array(indices, dtype=np.int32))
+            self._data.write(np.array(data, dtype=np.float32))
+        self._nnz += n
+        self._indptr.write(np.array([self._nnz], dtype=np.int64))
+
+    def add_matrix(self, matrix: Any) -> None:
+        """ Append the rows of a scipy.sparse CSR matrix """
+        matrix.sort_indices()
+        self._indices.write(matrix.indices)
+        self._data.write(matrix.data)
+        self._indptr.write(matrix.indptr[1:].astype(np.int64) + self._nnz)
+        self._nnz += matrix.nnz
+
+    def close(self) -> None:
+        self._indptr.close()
+        self._indices.close()
+        self._data.close()
+
+    def __enter__(self) -> "CsrWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close()
+
+
+class CsrCorpus:
+
+    """ A corpus of sparse document vectors stored as memory-mapped
+        CSR arrays, usable wherever Gensim expects a corpus """
+
+    def __init__(self, base_filename: str, num_terms: Optional[int] = None) -> None:
+        self._base = base_filename
+        self._indptr = self._load("indptr")
+        self._indices = self._load("indices")
+        self._data = self._load("data")
+        self._num_terms = num_terms
+
+    def _load(self, name: str) -> np.ndarray:
+        """ Memory-map one of the arrays of the corpus """
+        try:
+            return np.load(
+                "{0}.{1}.npy".format(self._base, name), mmap_mode="r"
+            )
+        except ValueError:
+            # An empty array cannot be memory-mapped
+            return np.load("{0}.{1}.npy".format(self._base, name))
+
+    @staticmethod
+    def filenames(base_filename: str) -> List[str]:
+        """ Return the names of the files making up a corpus """
+        return [
+            "{0}.{1}.npy".format(base_filename, name)
+            for name in ("indptr", "indices", "data")
+        ]
+
+    @staticmethod
+    def exists(base_filename: str) -> bool:
+        """ Return True if all files of a corpus exist """
+        return all(os.path.exists(f) for f in CsrCorpus.filenames(base_filename))
+
+    @staticmethod
+    def remove(base_filename: str) -> None:
+        """ Remove the files of a corpus, if they exist """
+        for fname in CsrCorpus.filenames(base_filename):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    @classmethod
+    def serialize(
+        cls, base_filename: str, corpus: Iterable[SparseVector],
+        num_terms: Optional[int] = None
+    ) -> "CsrCorpus":
+        """ Write a stream of sparse document vectors to disk """
+        with CsrWriter(base_filename) as w:
+            for vector in corpus:
+                w.add_document(vector)
+        return cls(base_filename, num_terms)
+
+    @property
+    def base_filename(self) -> str:
+        return self._base
+
+    @property
+    def num_terms(self) -> int:
+        """ The number of columns (terms) in the corpus matrix """
+        if self._num_terms is None:
+            self._num_terms = int(self._indices.max()) + 1 if len(self._indices) else 0
+        return self._num_terms
+
+    @property
+    def num_nnz(self) -> int:
+        return len(self._indices)
+
+    def __len__(self) -> int:
+        return len(self._indptr) - 1
+
+    def __iter__(self) -> Iterator[SparseVector]:
+        """ Yield each document as a list of (term index, value) tuples """
+        for start in range(0, len(self), _DEFAULT_CHUNKSIZE):
+            end = min(start + _DEFAULT_CHUNKSIZE, len(self))
+            indptr = self._indptr[start : end + 1]
+            yield from _rows(
+                indptr - indptr[0],
+                self._indices[indptr[0] : indptr[-1]],
+                self._data[indptr[0] : indptr[-1]],
+            )
+
+    def matrix(self, start: int = 0, end: Optional[int] = None) -> Any:
+        """ Return the given range of documents as a scipy.sparse CSR matrix """
+        from scipy import sparse  # type: ignore
+
+        end = len(self) if end is None else min(end, len(self))
+        indptr = np.asarray(self._indptr[start : end + 1])
+        a, b = int(indptr[0]), int(indptr[-1])
+        return sparse.csr_matrix(
+            (np.asarray(self._data[a:b]), np.asarray(self._indices[a:b]), indptr - a),
+            shape=(end - start, self.num_terms),
+        )
+
+    def chunks(self, chunksize: int = _DEFAULT_CHUNKSIZE) -> Iterator[Any]:
+        """ Yield the corpus as a sequence of scipy.sparse CSR matrices """
+        for start in range(0, len(self), chunksize):
+            yield self.matrix(start, start + chunksize)
+
+    def term_frequencies(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Return the document frequency (the number of documents
+            containing each term) and the collection frequency (the sum
+            of each term's values over all documents) of every term """
+        dfs = np.zeros(self.num_terms, dtype=np.int64)
+        cfs = np.zeros(self.num_terms, dtype=np.float64)
+        for start in range(0, self.num_nnz, _DEFAULT_CHUNKSIZE * 64):
+            end = start + _DEFAULT_CHUNKSIZE * 64
+            indices = np.asarray(self._indices[start:end])
+            dfs += np.bincount(indices, minlength=self.num_terms)
+            cfs += np.bincount(
+                indices, weights=self._data[start:end], minlength=self.num_terms
+            )
+        return dfs, cfs
+
+
+class TfidfCsrCorpus:
+
+    """ A view of a plain CsrCorpus that applies the TFIDF
+        transformation to its documents on the fly, one chunk
+        of documents at a time, instead of storing them """
+
+    def __init__(self, corpus: CsrCorpus, idfs: np.ndarray) -> None:
+        self._corpus = corpus
+        self._idfs = idfs
+
+    @property
+    def corpus(self) -> CsrCorpus:
+        """ The underlying plain corpus """
+        return self._corpus
+
+    @property
+    def idfs(self) -> np.ndarray:
+        return self._idfs
+
+    @property
+    def num_terms(self) -> int:
+        return self._corpus.num_terms
+
+    def __len__(self) -> int:
+        return len(self._corpus)
+
+    def __iter__(self) -> Iterator[SparseVector]:
+        """ Yield each TFIDF-transformed document as
+            a list of (term index, weight) tuples """
+        for m in self.chunks():
+            yield from _rows(m.indptr, m.indices, m.data)
+
+    def matrix(self, start: int = 0, end: Optional[int] = None) -> Any:
+        """ Return the given range of TFIDF-transformed
+            documents as a scipy.sparse CSR matrix """
+        return tfidf_transform(self._corpus.matrix(start, end), self._idfs)
+
+    def chunks(self, chunksize: int = _DEFAULT_CHUNKSIZE) -> Iterator[Any]:
+        """ Yield the TFIDF-transformed corpus as a
+            sequence of scipy.sparse CSR matrices """
+        for m in self._corpus.chunks(chunksize):
+            yield tfidf_transform(m, self._idfs)
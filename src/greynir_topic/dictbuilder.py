@@ -0,0 +1,243 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Bounded-memory dictionary construction
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module implements a dictionary builder whose memory use has a
+    fixed ceiling, regardless of the size of the raw corpus vocabulary.
+
+    The builder keeps exact document and collection frequencies for at
+    most max_vocabulary lemmas at a time. When that limit is reached,
+    the lemmas with the lowest document frequencies are evicted, keeping
+    the heavy hitters. In addition, the document and collection
+    frequencies of every lemma are recorded in count-min sketches: small,
+    fixed-size tables of counters that give an estimate of the frequency
+    of any lemma that never underestimates it. When an evicted (or never
+    tracked) lemma turns up again, it re-enters the tracked set with its
+    document and collection frequencies estimated from the sketches, so
+    frequent lemmas that happen to arrive late, or in bursts, are not
+    lost, and their counts include their occurrences before eviction.
+
+    Finally, a Gensim dictionary is created from the tracked lemmas and
+    filtered with the same min_count and max_ratio rules as a dictionary
+    built from the full vocabulary. As long as the vocabulary limit
+    comfortably exceeds the number of lemmas that survive filtering,
+    the result is identical or very nearly so; compare_dictionaries()
+    measures the difference.
+
+"""
+
+from typing import Iterable, Dict, List, Any, TYPE_CHECKING
+
+import zlib
+
+import numpy as np  # type: ignore
+
+if TYPE_CHECKING:
+    from .dictionary import Dictionary
+
+
+# Fraction of max_vocabulary that is kept when the tracked lemmas are pruned.
+# Pruning down below the limit amortizes the cost of pruning.
+_PRUNE_TO = 0.8
+
+# Default number of rows (hash functions) in the count-min sketch
+_DEFAULT_SKETCH_DEPTH = 4
+
+
+class DictionaryBuilder:
+
+    """ Builds a Gensim dictionary from a stream of lemma lists
+        in bounded memory, by pruning infrequent lemmas during
+        the pass and estimating document frequencies with a
+        count-min sketch """
+
+    def __init__(
+        self, max_vocabulary: int, *,
+        sketch_width: int = None, sketch_depth: int = _DEFAULT_SKETCH_DEPTH
+    ) -> None:
+        """ Create a builder that tracks at most max_vocabulary lemmas
+            at a time (plus the new lemmas of the document being added,
+            since pruning takes place between documents). The count-min
+            sketches have sketch_depth rows of sketch_width counters; the
+            width is rounded up to a power of two and defaults to eight
+            times max_vocabulary. """
+        if max_vocabulary < 1:
+            raise ValueError("max_vocabulary must be positive")
+        self._max_vocabulary = max_vocabulary
+        width = 1
+        while width < (sketch_width or 8 * max_vocabulary):
+            width *= 2
+        self._mask = width - 1
+        self._sketch = np.zeros((sketch_depth, width), dtype=np.int32)
+        # Collection frequencies can be much larger than document frequencies
+        self._cf_sketch = np.zeros((sketch_depth, width), dtype=np.int64)
+        self._rows = np.arange(sketch_depth, dtype=np.int64)[:, None]
+        # Tracked lemmas, mapped to [document frequency, collection frequency]
+        self._tracked = {}  # type: Dict[str, List[int]]
+        self._num_docs = 0
+        self._num_pos = 0
+        self._num_nnz = 0
+        self._num_prunes = 0
+        self._num_evicted = 0
+        self._max_evicted_df = 0
+        self._num_readmitted = 0
+        self._peak_tracked = 0
+
+    def _cells(self, lemmas: List[str]) -> np.ndarray:
+        """ Return the sketch column of each lemma in each row,
+            as an array of shape (depth, len(lemmas)). The row hashes
+            are derived from two base hashes (Kirsch-Mitzenmacher). """
+        keys = [lemma.encode("utf-8") for lemma in lemmas]
+        h1 = np.fromiter((zlib.crc32(k) for k in keys), dtype=np.int64, count=len(keys))
+        h2 = np.fromiter(
+            (zlib.adler32(k) | 1 for k in keys), dtype=np.int64, count=len(keys)
+        )
+        return (h1[None, :] + self._rows * h2[None, :]) & self._mask
+
+    def add_document(self, lemmas: Iterable[str]) -> None:
+        """ Add the lemmas of a document, e.g. a list of lemma
+            strings or a LemmaCounts instance, to the builder """
+        counts = getattr(lemmas, "counts", None)
+        if counts is None:
+            counts = {}
+            for lemma in lemmas:
+                counts[lemma] = counts.get(lemma, 0) + 1
+        self._num_docs += 1
+        self._num_pos += sum(counts.values())
+        self._num_nnz += len(counts)
+        if not counts:
+            return
+        distinct = list(counts)
+        cells = self._cells(distinct)
+        rows = np.broadcast_to(self._rows, cells.shape)
+        np.add.at(self._sketch, (rows, cells), 1)
+        occurrences = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+        np.add.at(self._cf_sketch, (rows, cells), np.broadcast_to(occurrences, cells.shape))
+        tracked = self._tracked
+        new = []  # type: List[int]
+        for i, lemma in enumerate(distinct):
+            entry = tracked.get(lemma)
+            if entry is None:
+                new.append(i)
+            else:
+                entry[0] += 1
+                entry[1] += counts[lemma]
+        if new:
+            # Estimate the frequencies of new lemmas from the sketches,
+            # which include this document as well as any earlier ones
+            dfs = self._sketch[self._rows, cells[:, new]].min(axis=0)
+            cfs = self._cf_sketch[self._rows, cells[:, new]].min(axis=0)
+            for i, df, cf in zip(new, dfs.tolist(), cfs.tolist()):
+                lemma = distinct[i]
+                if df > 1:
+                    self._num_readmitted += 1
+                tracked[lemma] = [df, cf]
+            self._peak_tracked = max(self._peak_tracked, len(tracked))
+            if len(tracked) > self._max_vocabulary:
+                self._prune()
+
+    def add_documents(self, documents: Iterable[Iterable[str]]) -> None:
+        """ Add a stream of documents to the builder """
+        for lemmas in documents:
+            self.add_document(lemmas)
+
+    def _prune(self) -> None:
+        """ Evict the tracked lemmas with the lowest document
+            frequencies, down to a fraction of the limit """
+        keep = int(self._max_vocabulary * _PRUNE_TO)
+        tracked = self._tracked
+        dfs = np.fromiter((e[0] for e in tracked.values()), dtype=np.int64, count=len(tracked))
+        # Stable sort by descending df, so that ties are broken by age
+        order = np.argsort(-dfs, kind="stable")
+        evict = np.zeros(len(tracked), dtype=bool)
+        evict[order[keep:]] = True
+        self._max_evicted_df = max(self._max_evicted_df, int(dfs[evict].max()))
+        self._tracked = {
+            lemma: entry
+            for (lemma, entry), e in zip(tracked.items(), evict.tolist())
+            if not e
+        }
+        self._num_evicted += int(evict.sum())
+        self._num_prunes += 1
+
+    def dictionary(self, *, min_count: int = 5, max_ratio: float = 0.5) -> "Dictionary":
+        """ Return a Gensim dictionary of the tracked lemmas, filtered
+            in the same way as Model.train_dictionary() filters a
+            dictionary built from the full vocabulary """
+        from .dictionary import Dictionary
+
+        dic = Dictionary()
+        for ix, (lemma, (df, cf)) in enumerate(self._tracked.items()):
+            dic.token2id[lemma] = ix
+            dic.dfs[ix] = df
+            dic.cfs[ix] = cf
+        dic.num_docs = self._num_docs
+        dic.num_pos = self._num_pos
+        dic.num_nnz = self._num_nnz
+        if min_count > 0 or max_ratio < 1.0:
+            dic.filter_extremes(no_below=min_count, no_above=max_ratio, keep_n=None)
+        return dic
+
+    def report(self) -> Dict[str, Any]:
+        """ Return statistics about the pruning during the pass """
+        return dict(
+            num_docs=self._num_docs,
+            max_vocabulary=self._max_vocabulary,
+            tracked=len(self._tracked),
+            peak_tracked=self._peak_tracked,
+            prunes=self._num_prunes,
+            evicted=self._num_evicted,
+            readmitted=self._num_readmitted,
+            # No lemma whose document frequency exceeds this was ever evicted;
+            # if it is below min_count, pruning cannot have removed any lemma
+            # that the filtering would have kept
+            max_evicted_df=self._max_evicted_df,
+            sketch_bytes=self._sketch.nbytes + self._cf_sketch.nbytes,
+            exact=self._num_prunes == 0,
+        )
+
+
+def compare_dictionaries(approximate: Any, exact: Any) -> Dict[str, Any]:
+    """ Compare a dictionary built by a DictionaryBuilder with one
+        built from the full vocabulary, returning the number of lemmas
+        in each, the number of lemmas that are missing from or extra
+        in the approximate one, and the mean and maximum relative
+        error of the document frequencies of the common lemmas """
+    a = {lemma: approximate.dfs[ix] for lemma, ix in approximate.token2id.items()}
+    e = {lemma: exact.dfs[ix] for lemma, ix in exact.token2id.items()}
+    common = a.keys() & e.keys()
+    errors = np.array([abs(a[w] - e[w]) / e[w] for w in common], dtype=np.float64)
+    return dict(
+        approximate=len(a),
+        exact=len(e),
+        common=len(common),
+        missing=len(e.keys() - a.keys()),
+        extra=len(a.keys() - e.keys()),
+        mean_df_error=float(errors.mean()) if len(errors) else 0.0,
+        max_df_error=float(errors.max()) if len(errors) else 0.0,
+    )
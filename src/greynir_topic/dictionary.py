@@ -0,0 +1,84 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Lemma dictionary
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+    This module contains the Dictionary class, a thin subclass of the
+    Gensim dictionary, and the HashDictionary class, which maps lemmas
+    to a fixed number of hash buckets instead (see hashing.py). It is
+    kept apart from model.py so that Gensim is only imported when a
+    dictionary is actually needed, i.e. when training a model or
+    serving it via the Gensim models, and not when serving it from a
+    ServingState or a bundle.
+
+"""
+
+from typing import Iterable, Mapping, List
+
+import zlib
+
+from gensim import corpora  # type: ignore
+
+from .hashing import HashVocabulary
+
+
+class Dictionary(corpora.Dictionary):
+
+    """ Subclass of gensim.corpora.Dictionary that adds a __contains__
+        operator for easy membership check """
+
+    def __init__(self, iterator: Iterable[List[str]] = None) -> None:
+        super().__init__(iterator)
+
+    def __contains__(self, word: str) -> bool:
+        """ Return True if the given word/lemma is in the dictionary """
+        return word in self.token2id
+
+    @property
+    def vocabulary(self) -> Mapping[str, int]:
+        """ The mapping from lemmas to ids """
+        return self.token2id
+
+
+class HashDictionary(corpora.HashDictionary):
+
+    """ Subclass of gensim.corpora.HashDictionary that maps lemmas to
+        num_buckets ids via a stable hash function (CRC-32), without
+        storing the lemmas themselves. The document statistics (dfs,
+        cfs, num_docs etc.) are filled in after the corpus has been
+        converted to bags of words. """
+
+    def __init__(self, num_buckets: int) -> None:
+        super().__init__(id_range=num_buckets, myhash=zlib.crc32, debug=False)
+        # Collection frequencies, which the Gensim class does not keep
+        self.cfs = {}  # type: dict
+
+    @property
+    def vocabulary(self) -> HashVocabulary:
+        """ The mapping from lemmas to ids, i.e. hash buckets """
+        return HashVocabulary(self.id_range)
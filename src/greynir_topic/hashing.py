@@ -0,0 +1,149 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Hashed vocabularies
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module implements the "hashing trick" for vocabularies: instead
+    of assigning an index to each distinct lemma via a dictionary, each
+    lemma is mapped to one of a fixed number of buckets by a stable hash
+    function (CRC-32 of its UTF-8 encoding). No dictionary pass over the
+    corpus is needed, and the vocabulary takes no memory at all, at the
+    cost of occasional collisions, where unrelated lemmas share a bucket.
+
+    The HashVocabulary class can be used wherever a token2id mapping is
+    expected by the inference engine. The hashing_report() function
+    measures the collision rate for a sample of documents, and its
+    effect on document similarities.
+
+"""
+
+from typing import Iterable, Dict, List, Any
+
+import zlib
+
+import numpy as np  # type: ignore
+
+
+def bucket_of(lemma: str, num_buckets: int) -> int:
+    """ Return the hash bucket of a lemma. This is identical to the
+        id assigned by gensim.corpora.HashDictionary with
+        myhash=zlib.crc32 and id_range=num_buckets. """
+    return zlib.crc32(lemma.encode("utf-8")) % num_buckets
+
+
+class HashVocabulary:
+
+    """ A mapping from lemma strings to hash buckets, with the
+        get() interface of a token2id dict. Every lemma maps
+        to some bucket. """
+
+    def __init__(self, num_buckets: int) -> None:
+        if num_buckets < 1:
+            raise ValueError("num_buckets must be positive")
+        self._num_buckets = num_buckets
+
+    @property
+    def num_buckets(self) -> int:
+        return self._num_buckets
+
+    def __len__(self) -> int:
+        return self._num_buckets
+
+    def get(self, lemma: Any, default: Any = None) -> Any:
+        if not isinstance(lemma, str):
+            return default
+        return zlib.crc32(lemma.encode("utf-8")) % self._num_buckets
+
+    def __getitem__(self, lemma: str) -> int:
+        if not isinstance(lemma, str):
+            raise KeyError(lemma)
+        return self.get(lemma)
+
+    def __contains__(self, lemma: Any) -> bool:
+        return isinstance(lemma, str)
+
+
+def _counts(lemmas: Iterable[str]) -> Dict[str, int]:
+    counts = getattr(lemmas, "counts", None)
+    if counts is not None:
+        return counts
+    counts = {}
+    for lemma in lemmas:
+        counts[lemma] = counts.get(lemma, 0) + 1
+    return counts
+
+
+def _cosine(a: Dict[Any, float], b: Dict[Any, float]) -> float:
+    dot = sum(v * b[k] for k, v in a.items() if k in b)
+    norm = np.sqrt(sum(v * v for v in a.values()) * sum(v * v for v in b.values()))
+    return float(dot / norm) if norm > 0.0 else 0.0
+
+
+def hashing_report(
+    documents: Iterable[Iterable[str]], num_buckets: int, *,
+    num_pairs: int = 1000, seed: int = 0
+) -> Dict[str, Any]:
+    """ Measure the effect of hashing a sample of documents into the
+        given number of buckets. Returns the number of distinct lemmas,
+        the number of buckets used, the fraction of lemmas that share
+        a bucket with another lemma (along with the fraction expected
+        from a uniform hash), and the mean and maximum absolute error
+        in the cosine similarity of the bags of words of randomly
+        chosen pairs of documents, hashed versus exact. """
+    docs = [_counts(lemmas) for lemmas in documents]
+    lemmas = set()  # type: set
+    for counts in docs:
+        lemmas.update(counts)
+    vocab = HashVocabulary(num_buckets)
+    buckets = np.array([vocab.get(lemma) for lemma in lemmas], dtype=np.int64)
+    occupancy = np.bincount(buckets, minlength=num_buckets)
+    colliding = int(occupancy[occupancy > 1].sum())
+    m = len(lemmas)
+    hashed = []  # type: List[Dict[int, float]]
+    for counts in docs:
+        h = {}  # type: Dict[int, float]
+        for lemma, count in counts.items():
+            b = vocab.get(lemma)
+            h[b] = h.get(b, 0) + count
+        hashed.append(h)
+    errors = []  # type: List[float]
+    if len(docs) > 1:
+        rng = np.random.RandomState(seed)
+        for _ in range(num_pairs):
+            i, j = rng.choice(len(docs), 2, replace=False)
+            errors.append(
+                abs(_cosine(hashed[i], hashed[j]) - _cosine(docs[i], docs[j]))
+            )
+    return dict(
+        num_lemmas=m,
+        num_buckets=num_buckets,
+        buckets_used=int((occupancy > 0).sum()),
+        collision_rate=colliding / m if m else 0.0,
+        expected_collision_rate=1.0 - (1.0 - 1.0 / num_buckets) ** max(m - 1, 0),
+        mean_similarity_error=float(np.mean(errors)) if errors else 0.0,
+        max_similarity_error=float(np.max(errors)) if errors else 0.0,
+    )
@@ -0,0 +1,583 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Similarity index utilities
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module contains functionality for building and querying
+    document similarity indexes.
+
+    A DenseIndex stores the topic vectors of all documents in a corpus as
+    rows of a single L2-normalized float32 matrix, saved as a .npy file.
+    The file is memory-mapped when loaded, so that opening it is nearly
+    instantaneous and multiple processes on the same host share a single
+    copy of it in the operating system's page cache. The cosine similarities
+    of a query vector to all documents are obtained with a single
+    matrix-vector product.
+
+    An IVFIndex is an optional approximate nearest neighbor index on top
+    of a DenseIndex. It partitions the document vectors into clusters
+    around coarse centroids, found by spherical k-means, and keeps an
+    inverted list of the documents in each cluster. A query is only
+    compared with the documents in the clusters whose centroids are
+    closest to it; the number of such clusters (probes) trades recall
+    for latency.
+
+"""
+
+from typing import Iterable, Sequence, List, Tuple, Dict, Optional
+
+import os
+import time
+
+import numpy as np  # type: ignore
+
+from .npyio import NpyWriter
+
+
+# A TopicVector is a sparse array of floats,
+# i.e. a list of (index, content) tuples
+TopicVector = List[Tuple[int, float]]
+
+# Number of document vectors to normalize and write at a time
+_CHUNK_SIZE = 4096
+
+
+def top_k(
+    similarities: np.ndarray, k: Optional[int] = None, cutoff: float = 0.0, *,
+    exclude: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Return the indices and the similarity scores of the (at most) k
+        items with the highest similarity scores at or above the cutoff,
+        sorted by descending score. Items with equal scores are sorted
+        by ascending index. If k is None or 0, all items at or above
+        the cutoff are returned. If exclude is given, it is a boolean
+        array marking items that are never returned, whatever their
+        scores, such as deleted documents. """
+    similarities = np.asarray(similarities)
+    keep = similarities >= cutoff
+    if exclude is not None:
+        keep &= ~exclude
+    candidates = np.flatnonzero(keep)
+    scores = similarities[candidates]
+    if k and k < len(candidates):
+        # Find the k-th highest score without sorting everything,
+        # then keep all candidates with at least that score (there
+        # may be more than k of them if there are ties)
+        kth = -np.partition(-scores, k - 1)[k - 1]
+        keep = scores >= kth
+        candidates = candidates[keep]
+        scores = scores[keep]
+    # Sort by descending score, then by ascending index
+    order = np.lexsort((candidates, -scores))
+    if k:
+        order = order[:k]
+    return candidates[order], scores[order]
+
+
+class DenseIndex:
+
+    """ A similarity index over L2-normalized dense document vectors.
+
+        Each row of the index has an external document id. Initially, the
+        id of a row is simply its row number, but when deleted rows are
+        removed by compaction, the ids of the remaining rows are kept in
+        a separate array (followed by the next unused id). Deleted rows
+        are marked in a tombstone bitmap, and are excluded from query
+        results until they are removed by compaction. """
+
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        ids: Optional[np.ndarray] = None,
+        deleted: Optional[np.ndarray] = None,
+        filename: Optional[str] = None,
+    ) -> None:
+        """ Create an index from a matrix of normalized
+            document vectors, of shape (documents, dimensions) """
+        assert vectors.ndim == 2
+        assert ids is None or len(ids) == len(vectors) + 1
+        self._vectors = vectors
+        self._ids = ids
+        if deleted is not None and not deleted.any():
+            deleted = None
+        self._deleted = deleted
+        self._filename = filename
+
+    @staticmethod
+    def _sidecar(filename: str, name: str) -> str:
+        """ Return the name of an auxiliary file of an index file """
+        if filename.endswith(".npy"):
+            filename = filename[:-4]
+        return "{0}.{1}.npy".format(filename, name)
+
+    @staticmethod
+    def ids_filename(filename: str) -> str:
+        return DenseIndex._sidecar(filename, "ids")
+
+    @staticmethod
+    def deleted_filename(filename: str) -> str:
+        return DenseIndex._sidecar(filename, "deleted")
+
+    @staticmethod
+    def filenames(filename: str) -> List[str]:
+        """ Return the names of all files that may make up an index """
+        return [
+            filename,
+            DenseIndex.ids_filename(filename),
+            DenseIndex.deleted_filename(filename),
+        ]
+
+    @staticmethod
+    def remove(filename: str) -> None:
+        """ Remove the files of an index, if they exist """
+        for fname in DenseIndex.filenames(filename):
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    @staticmethod
+    def replace(src_filename: str, dst_filename: str) -> None:
+        """ Move an index from one set of files to another,
+            replacing the latter """
+        for src, dst in zip(
+            DenseIndex.filenames(src_filename), DenseIndex.filenames(dst_filename)
+        ):
+            if os.path.exists(src):
+                os.replace(src, dst)
+            elif os.path.exists(dst):
+                os.remove(dst)
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        """ L2-normalize the rows of a matrix, in place,
+            leaving all-zero rows unchanged """
+        norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+        nonzero = norms > 0.0
+        vectors[nonzero] /= norms[nonzero, None]
+        return vectors
+
+    @classmethod
+    def build(
+        cls, filename: str, topic_vectors: Iterable[TopicVector], dimensions: int
+    ) -> "DenseIndex":
+        """ Build an index from a stream of sparse topic vectors and save it
+            to the given .npy file, which is written incrementally """
+        cls.remove(filename)
+        with NpyWriter(filename, np.float32, (dimensions,)) as w:
+            for chunk in cls._dense_chunks(topic_vectors, dimensions):
+                w.write(cls.normalize(chunk))
+        return cls.load(filename)
+
+    @classmethod
+    def build_dense(
+        cls, filename: str, chunks: Iterable[np.ndarray], dimensions: int
+    ) -> "DenseIndex":
+        """ Build an index from a stream of dense vector chunks, each of
+            shape (rows, dimensions), and save it to the given .npy file """
+        cls.remove(filename)
+        with NpyWriter(filename, np.float32, (dimensions,)) as w:
+            for chunk in chunks:
+                w.write(cls.normalize(np.array(chunk, dtype=np.float32)))
+        return cls.load(filename)
+
+    @classmethod
+    def append(
+        cls, filename: str, topic_vectors: Iterable[TopicVector], dimensions: int
+    ) -> "DenseIndex":
+        """ Append the vectors of additional documents to an
+            index file, and return the enlarged index """
+        with NpyWriter(filename, np.float32, (dimensions,), append=True) as w:
+            start = w.rows
+            for chunk in cls._dense_chunks(topic_vectors, dimensions):
+                w.write(cls.normalize(chunk))
+            added = w.rows - start
+        ids_filename = cls.ids_filename(filename)
+        if os.path.exists(ids_filename):
+            # The new documents get the next unused ids
+            ids = np.load(ids_filename)
+            ids = np.concatenate([ids[:-1], np.arange(ids[-1], ids[-1] + added + 1)])
+            np.save(ids_filename, ids)
+        return cls.load(filename)
+
+    @staticmethod
+    def _dense_chunks(
+        topic_vectors: Iterable[TopicVector], dimensions: int
+    ) -> Iterable[np.ndarray]:
+        """ Convert a stream of sparse topic vectors into a stream of
+            dense float32 matrix chunks. Any dimensions beyond the given
+            number are ignored; this can happen when an LSI model of
+            less than full rank is updated with additional documents. """
+        chunk = np.zeros((_CHUNK_SIZE, dimensions), dtype=np.float32)
+        n = 0
+        for tv in topic_vectors:
+            for ix, val in tv:
+                if ix < dimensions:
+                    chunk[n, ix] = val
+            n += 1
+            if n == _CHUNK_SIZE:
+                yield chunk
+                chunk = np.zeros((_CHUNK_SIZE, dimensions), dtype=np.float32)
+                n = 0
+        if n:
+            yield chunk[:n]
+
+    @classmethod
+    def load(cls, filename: str, *, mmap: bool = True) -> "DenseIndex":
+        """ Load an index from a .npy file, by default memory-mapping it """
+        try:
+            vectors = np.load(filename, mmap_mode="r" if mmap else None)
+        except ValueError:
+            # An empty array cannot be memory-mapped
+            vectors = np.load(filename)
+        ids = None
+        if os.path.exists(cls.ids_filename(filename)):
+            ids = np.load(cls.ids_filename(filename))
+        deleted = None
+        if os.path.exists(cls.deleted_filename(filename)):
+            bits = np.load(cls.deleted_filename(filename))
+            deleted = np.zeros(len(vectors), dtype=bool)
+            # Rows that have been appended after the bitmap
+            # was written are not deleted
+            unpacked = np.unpackbits(bits).astype(bool)[: len(vectors)]
+            deleted[: len(unpacked)] = unpacked
+        return cls(vectors, ids, deleted, filename)
+
+    def save(self, filename: str) -> None:
+        """ Save the index to a .npy file """
+        self.remove(filename)
+        np.save(filename, self._vectors)
+        if self._ids is not None:
+            np.save(self.ids_filename(filename), self._ids)
+        if self._deleted is not None:
+            np.save(self.deleted_filename(filename), np.packbits(self._deleted))
+        self._filename = filename
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._vectors
+
+    @property
+    def dimensions(self) -> int:
+        return self._vectors.shape[1]
+
+    def __len__(self) -> int:
+        return self._vectors.shape[0]
+
+    @property
+    def next_id(self) -> int:
+        """ The id that the next document added to the index will get """
+        return len(self) if self._ids is None else int(self._ids[-1])
+
+    @property
+    def deleted(self) -> Optional[np.ndarray]:
+        """ A boolean array marking deleted rows, or None if there are none """
+        return self._deleted
+
+    @property
+    def num_deleted(self) -> int:
+        return 0 if self._deleted is None else int(self._deleted.sum())
+
+    @property
+    def deleted_fraction(self) -> float:
+        return self.num_deleted / len(self) if len(self) else 0.0
+
+    def ids_of(self, rows: np.ndarray) -> np.ndarray:
+        """ Return the document ids of the given rows """
+        return np.asarray(rows) if self._ids is None else self._ids[rows]
+
+    def rows_of(self, ids: Iterable[int]) -> np.ndarray:
+        """ Return the rows of the given document ids,
+            omitting ids that are not in the index """
+        ids = np.fromiter(ids, dtype=np.int64)
+        if self._ids is None:
+            return ids[(ids >= 0) & (ids < len(self))]
+        # The ids are in ascending order
+        rows = np.searchsorted(self._ids[:-1], ids)
+        found = rows < len(self)
+        found[found] = self._ids[rows[found]] == ids[found]
+        return rows[found]
+
+    def delete(self, ids: Iterable[int]) -> int:
+        """ Mark the documents with the given ids as deleted, returning
+            the number of newly deleted documents. If the index was
+            loaded from a file, the tombstone bitmap file is updated. """
+        rows = np.unique(self.rows_of(ids))
+        deleted = (
+            np.zeros(len(self), dtype=bool)
+            if self._deleted is None
+            else self._deleted.copy()
+        )
+        count = int((~deleted[rows]).sum())
+        if count:
+            deleted[rows] = True
+            if self._filename is not None:
+                np.save(self.deleted_filename(self._filename), np.packbits(deleted))
+            self._deleted = deleted
+        return count
+
+    def compact_into(
+        self, filename: str, start: int = 0, end: Optional[int] = None, *,
+        append: bool = False
+    ) -> np.ndarray:
+        """ Write the rows in the range [start, end) that have not been
+            deleted to an index file, or append them to it, keeping their
+            document ids. Returns an array that maps each row in the
+            range to its new row number, or -1 if it was deleted. """
+        end = len(self) if end is None else end
+        live = np.ones(end - start, dtype=bool)
+        if self._deleted is not None:
+            live = ~self._deleted[start:end]
+        ids_filename = self.ids_filename(filename)
+        ids = [] if not append else [np.load(ids_filename)[:-1]]
+        with NpyWriter(
+            filename, np.float32, (self.dimensions,), append=append
+        ) as w:
+            mapping = np.full(end - start, -1, dtype=np.int64)
+            mapping[live] = np.arange(w.rows, w.rows + int(live.sum()))
+            for a in range(start, end, _CHUNK_SIZE):
+                b = min(a + _CHUNK_SIZE, end)
+                keep = live[a - start : b - start]
+                w.write(np.asarray(self._vectors[a:b])[keep])
+                ids.append(self.ids_of(np.arange(a, b))[keep])
+        ids.append(np.array([self.next_id], dtype=np.int64))
+        np.save(ids_filename, np.concatenate(ids).astype(np.int64))
+        if not append and os.path.exists(self.deleted_filename(filename)):
+            os.remove(self.deleted_filename(filename))
+        return mapping
+
+    def dense_query(self, topic_vector: TopicVector) -> np.ndarray:
+        """ Convert a sparse topic vector to a normalized dense query vector """
+        q = np.zeros(self.dimensions, dtype=np.float32)
+        for ix, val in topic_vector:
+            if ix < len(q):
+                q[ix] = val
+        norm = np.sqrt(np.dot(q, q))
+        if norm > 0.0:
+            q /= norm
+        return q
+
+    def similarities(self, query: np.ndarray) -> np.ndarray:
+        """ Return the cosine similarities of a normalized dense query
+            vector to all rows in the index, including deleted rows, which
+            should be excluded from the results via top_k(exclude=deleted) """
+        return np.dot(self._vectors, query.astype(np.float32, copy=False))
+
+    def __getitem__(self, topic_vector: TopicVector) -> np.ndarray:
+        """ Return the cosine similarities of a sparse topic vector to all
+            rows in the index (like gensim.similarities.Similarity) """
+        return self.similarities(self.dense_query(topic_vector))
+
+
+class IVFIndex:
+
+    """ An inverted file (IVF) approximate nearest neighbor index
+        over the vectors of a DenseIndex """
+
+    # Default number of k-means iterations when building the index
+    _DEFAULT_ITERATIONS = 10
+
+    # Default number of training vectors per centroid for k-means
+    _TRAINING_VECTORS_PER_LIST = 256
+
+    def __init__(
+        self, centroids: np.ndarray, offsets: np.ndarray, items: np.ndarray
+    ) -> None:
+        """ Create an index from its constituent arrays:
+            centroids: the normalized centroids, of shape (lists, dimensions).
+            offsets: the start of each inverted list within items,
+                followed by the total number of items.
+            items: the DenseIndex row numbers in each inverted list.
+        """
+        assert len(offsets) == len(centroids) + 1
+        self._centroids = centroids
+        self._offsets = offsets
+        self._items = items
+
+    @property
+    def num_lists(self) -> int:
+        return len(self._centroids)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """ Return the number of the closest centroid for each vector """
+        result = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), _CHUNK_SIZE):
+            chunk = np.asarray(vectors[start : start + _CHUNK_SIZE])
+            result[start : start + len(chunk)] = np.argmax(
+                np.dot(chunk, centroids.T), axis=1
+            )
+        return result
+
+    @classmethod
+    def build(
+        cls,
+        index: DenseIndex,
+        num_lists: int,
+        *,
+        iterations: int = None,
+        seed: int = 0
+    ) -> "IVFIndex":
+        """ Build an IVF index with the given number of
+            inverted lists over the vectors of a DenseIndex """
+        vectors = index.vectors
+        n = len(vectors)
+        num_lists = max(1, min(num_lists, n))
+        rng = np.random.RandomState(seed)
+        # Train the centroids on a sample of the vectors
+        sample_size = min(n, num_lists * cls._TRAINING_VECTORS_PER_LIST)
+        sample = np.asarray(
+            vectors[np.sort(rng.choice(n, sample_size, replace=False))],
+            dtype=np.float32,
+        )
+        centroids = sample[rng.choice(sample_size, num_lists, replace=False)].copy()
+        for _ in range(iterations or cls._DEFAULT_ITERATIONS):
+            assignment = cls._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=num_lists)
+            empty = counts == 0
+            # Restart empty clusters at random sample vectors
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            centroids = DenseIndex.normalize(sums)
+        # Assign all vectors to their closest centroids
+        assignment = cls._assign(vectors, centroids)
+        items = np.argsort(assignment, kind="stable")
+        offsets = np.zeros(num_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignment, minlength=num_lists))
+        return cls(centroids, offsets, items)
+
+    def add(self, index: DenseIndex, start: int) -> None:
+        """ Add the rows of a DenseIndex from the given start row
+            onwards to the inverted lists of their closest centroids """
+        new_rows = np.arange(start, len(index), dtype=np.int64)
+        if not len(new_rows):
+            return
+        assignment = np.concatenate(
+            [
+                np.repeat(np.arange(self.num_lists), np.diff(self._offsets)),
+                self._assign(index.vectors[start:], self._centroids),
+            ]
+        )
+        items = np.concatenate([self._items, new_rows])
+        order = np.argsort(assignment, kind="stable")
+        self._items = items[order]
+        self._offsets = np.zeros(self.num_lists + 1, dtype=np.int64)
+        self._offsets[1:] = np.cumsum(np.bincount(assignment, minlength=self.num_lists))
+
+    def remap(self, mapping: np.ndarray) -> None:
+        """ Renumber the rows in the inverted lists after compaction of
+            the DenseIndex, given an array mapping old row numbers to new
+            ones (or to -1 for removed rows) """
+        lists = np.repeat(np.arange(self.num_lists), np.diff(self._offsets))
+        items = mapping[self._items]
+        keep = items >= 0
+        self._items = items[keep]
+        self._offsets = np.zeros(self.num_lists + 1, dtype=np.int64)
+        self._offsets[1:] = np.cumsum(np.bincount(lists[keep], minlength=self.num_lists))
+
+    @classmethod
+    def load(cls, filename: str) -> "IVFIndex":
+        """ Load an index from a .npz file """
+        with np.load(filename) as f:
+            return cls(f["centroids"], f["offsets"], f["items"])
+
+    def save(self, filename: str) -> None:
+        """ Save the index to a .npz file, atomically replacing any
+            previous version, so that an interrupted save does not leave
+            a corrupt index behind """
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "wb") as f:
+            np.savez(
+                f, centroids=self._centroids, offsets=self._offsets, items=self._items
+            )
+        os.replace(temp_filename, filename)
+
+    def candidates(self, query: np.ndarray, probes: int) -> np.ndarray:
+        """ Return the DenseIndex row numbers in the inverted lists
+            of the probes centroids closest to the query vector """
+        scores = np.dot(self._centroids, query)
+        probes = min(max(1, probes), self.num_lists)
+        lists = np.argpartition(-scores, probes - 1)[:probes]
+        return np.concatenate(
+            [self._items[self._offsets[i] : self._offsets[i + 1]] for i in lists]
+        )
+
+    def search(
+        self,
+        index: DenseIndex,
+        query: np.ndarray,
+        k: Optional[int] = None,
+        cutoff: float = 0.0,
+        *,
+        probes: int = 1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """ Return the row numbers and similarity scores of the approximate
+            nearest neighbors of a normalized query vector, like top_k() """
+        rows = np.sort(self.candidates(query, probes))
+        scores = np.dot(index.vectors[rows], query.astype(np.float32, copy=False))
+        deleted = None if index.deleted is None else index.deleted[rows]
+        indices, scores = top_k(scores, k, cutoff, exclude=deleted)
+        return rows[indices], scores
+
+
+def recall_at_k(
+    index: DenseIndex,
+    ann: IVFIndex,
+    queries: np.ndarray,
+    k: int = 10,
+    probes: Sequence[int] = (1, 2, 4, 8, 16),
+) -> List[Dict[str, float]]:
+    """ Measure the recall@k of an approximate index against an exact
+        search over the same vectors, for a matrix of normalized query
+        vectors and for each number of probes. Returns a list of dicts
+        with the recall and the mean query latencies in milliseconds. """
+    t0 = time.perf_counter()
+    exact = [
+        set(top_k(index.similarities(q), k, -1.0, exclude=index.deleted)[0].tolist())
+        for q in queries
+    ]
+    exact_ms = (time.perf_counter() - t0) * 1000.0 / max(1, len(queries))
+    report = []
+    for p in probes:
+        found = 0
+        t0 = time.perf_counter()
+        approx = [ann.search(index, q, k, -1.0, probes=p)[0] for q in queries]
+        ann_ms = (time.perf_counter() - t0) * 1000.0 / max(1, len(queries))
+        for truth, result in zip(exact, approx):
+            found += len(truth.intersection(result.tolist()))
+        total = sum(len(truth) for truth in exact)
+        report.append(
+            dict(
+                probes=p,
+                recall=found / total if total else 1.0,
+                exact_ms=exact_ms,
+                ann_ms=ann_ms,
+            )
+        )
+    return report
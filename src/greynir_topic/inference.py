@@ -0,0 +1,249 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Topic vector inference engine
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module implements a fast path for topic vector inference.
+
+    Calculating a topic vector for a bag of words with Gensim involves
+    three steps: Dictionary.doc2bow(), TfidfModel.__getitem__() and
+    LsiModel.__getitem__(). Mathematically, with a bag of word counts c,
+    idf weights w and the LSI basis U, the topic vector is
+
+        U.T @ (c * w) / ||c * w||
+
+    The InferenceEngine precomputes the projection matrix P = w[:, None] * U,
+    of shape (vocabulary size, dimensions), whereupon the topic vector is
+    obtained by gathering the rows of P for the words in the bag, summing
+    them weighted by the word counts, and normalizing.
+
+"""
+
+from typing import Iterable, Sequence, List, Tuple, Mapping, Callable, Optional, Any
+
+import numpy as np  # type: ignore
+
+
+# A TopicVector is a sparse array of floats,
+# i.e. a list of (index, content) tuples
+TopicVector = List[Tuple[int, float]]
+
+# Weights below this absolute value are dropped from TFIDF vectors
+# (this is the default in gensim.models.TfidfModel)
+_TFIDF_EPS = 1e-12
+
+# Values below this absolute value are dropped from sparse topic vectors
+# (this is the default in gensim.matutils.full2sparse)
+_TOPIC_EPS = 1e-9
+
+
+class InferenceEngine:
+
+    """ Calculates topic vectors from lemma lists using
+        a precomputed dense projection matrix """
+
+    def __init__(
+        self, token2id: Mapping[str, int], idfs: np.ndarray, projection: np.ndarray
+    ) -> None:
+        """ Create an inference engine.
+            token2id: a mapping from lemma strings to vocabulary indices.
+            idfs: the idf weight of each vocabulary index.
+            projection: the projection matrix, of shape
+                (vocabulary size, dimensions), with each row
+                already multiplied by the corresponding idf weight.
+        """
+        assert projection.ndim == 2 and len(idfs) == projection.shape[0]
+        self._token2id = token2id
+        self._idfs = idfs
+        self._projection = projection
+
+    @staticmethod
+    def supports_tfidf(tfidf: Any) -> bool:
+        """ Return True if the given Gensim TFIDF model uses the
+            default scheme (raw term counts, L2 normalization),
+            which is the only one supported by the fast path """
+        if getattr(tfidf, "smartirs", None) is not None:
+            return False
+        # Gensim replaces normalize=True with the unitvec function itself
+        normalize = getattr(tfidf, "normalize", True)
+        if normalize is not True and getattr(normalize, "__name__", "") != "unitvec":
+            return False
+        return getattr(tfidf, "pivot", None) is None
+
+    @classmethod
+    def supports(cls, tfidf: Any, lsi: Any) -> bool:
+        """ Return True if the given Gensim models can be
+            compiled into an inference engine """
+        return cls.supports_tfidf(tfidf) and lsi.projection.u is not None
+
+    @staticmethod
+    def idf_vector(tfidf: Any, num_terms: int) -> np.ndarray:
+        """ Return the idf weights of a Gensim TFIDF model as a dense array """
+        idfs = np.zeros(num_terms, dtype=np.float64)
+        for termid, idf in tfidf.idfs.items():
+            if termid < num_terms:
+                idfs[termid] = idf
+        return idfs
+
+    @classmethod
+    def from_models(
+        cls, dictionary: Any, tfidf: Any, lsi: Any, *, dtype: Any = np.float32
+    ) -> "InferenceEngine":
+        """ Compile an inference engine from a Gensim
+            dictionary, TFIDF model and LSI model """
+        if not cls.supports(tfidf, lsi):
+            raise ValueError("Unsupported TFIDF or LSI model configuration")
+        idfs = cls.idf_vector(tfidf, lsi.projection.u.shape[0])
+        u = lsi.projection.u[:, : lsi.num_topics]
+        projection = (idfs[:, None] * u).astype(dtype)
+        # Hashed dictionaries provide a vocabulary object instead of token2id
+        vocabulary = getattr(dictionary, "vocabulary", None)
+        return cls(
+            dictionary.token2id if vocabulary is None else vocabulary, idfs, projection
+        )
+
+    @property
+    def dimensions(self) -> int:
+        return self._projection.shape[1]
+
+    @property
+    def num_terms(self) -> int:
+        return self._projection.shape[0]
+
+    @property
+    def token2id(self) -> Mapping[str, int]:
+        return self._token2id
+
+    @property
+    def idfs(self) -> np.ndarray:
+        return self._idfs
+
+    @property
+    def projection(self) -> np.ndarray:
+        return self._projection
+
+    def bag(
+        self, lemmas: Iterable[Any], *, get: Callable[[Any], Optional[int]] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """ Return the vocabulary indices and counts of the known
+            lemmas in the given iterable. If get is given, it is used
+            instead of token2id.get() to look up the lemmas. """
+        counts = {}  # type: dict
+        get = get or self._token2id.get
+        for lemma in lemmas:
+            ix = get(lemma)
+            if ix is not None:
+                counts[ix] = counts.get(ix, 0) + 1
+        return (
+            np.fromiter(counts.keys(), dtype=np.int64, count=len(counts)),
+            np.fromiter(counts.values(), dtype=np.float64, count=len(counts)),
+        )
+
+    def dense_vector_from_bag(self, ids: np.ndarray, counts: np.ndarray) -> np.ndarray:
+        """ Return a dense topic vector for a bag of words,
+            given as arrays of vocabulary indices and counts """
+        if not len(ids):
+            return np.zeros(self.dimensions, dtype=np.float64)
+        weights = counts * self._idfs[ids]
+        norm = np.sqrt(np.dot(weights, weights))
+        if norm == 0.0:
+            return np.zeros(self.dimensions, dtype=np.float64)
+        # Drop the terms that the TFIDF model would drop as negligible
+        keep = np.abs(weights) > _TFIDF_EPS * norm
+        return np.dot(counts[keep], self._projection[ids[keep]]) / norm
+
+    def dense_vector(self, lemmas: Iterable[str]) -> np.ndarray:
+        """ Return a dense topic vector for an iterable of lemmas """
+        return self.dense_vector_from_bag(*self.bag(lemmas))
+
+    @staticmethod
+    def sparse(vector: np.ndarray) -> TopicVector:
+        """ Convert a dense topic vector to a sparse one """
+        nz = np.flatnonzero(np.abs(vector) > _TOPIC_EPS)
+        return list(zip(nz.tolist(), vector[nz].tolist()))
+
+    def topic_vector(self, lemmas: Iterable[str]) -> TopicVector:
+        """ Return a sparse topic vector for an iterable of lemmas """
+        return self.sparse(self.dense_vector(lemmas))
+
+    def bag_matrix(
+        self, batch: Sequence[Iterable[Any]], *,
+        get: Callable[[Any], Optional[int]] = None
+    ) -> Any:
+        """ Return a sparse CSR matrix of shape (len(batch), vocabulary size)
+            containing the bags of words of the lemma lists in the batch.
+            If get is given, it is used instead of token2id.get() to look
+            up the lemmas. """
+        from scipy import sparse  # type: ignore
+
+        get = get or self._token2id.get
+        indptr = [0]
+        indices = []  # type: List[int]
+        for lemmas in batch:
+            indices.extend(ix for ix in map(get, lemmas) if ix is not None)
+            indptr.append(len(indices))
+        m = sparse.csr_matrix(
+            (
+                np.ones(len(indices), dtype=self._projection.dtype),
+                np.array(indices, dtype=np.int64),
+                np.array(indptr, dtype=np.int64),
+            ),
+            shape=(len(batch), self.num_terms),
+        )
+        # Add up the counts of repeated lemmas within each document
+        m.sum_duplicates()
+        return m
+
+    def dense_vectors_from_matrix(self, bags: Any) -> np.ndarray:
+        """ Return an array of shape (rows, dimensions) containing the
+            topic vectors of the rows of a sparse bag-of-words matrix """
+        weights = bags.multiply(self._idfs[None, :]).tocsr()
+        norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+        result = np.asarray(bags @ self._projection)
+        nonzero = norms > 0.0
+        result[nonzero] /= norms[nonzero, None]
+        result[~nonzero] = 0.0
+        return result
+
+    def dense_vectors(
+        self, batch: Sequence[Iterable[Any]], *, chunksize: int = None,
+        get: Callable[[Any], Optional[int]] = None
+    ) -> np.ndarray:
+        """ Return an array of shape (len(batch), dimensions) containing
+            the topic vectors of the lemma lists in the batch. If chunksize
+            is given, at most that many documents are processed at a time,
+            to limit the size of the intermediate matrices. If get is given,
+            it is used instead of token2id.get() to look up the lemmas. """
+        n = len(batch)
+        if not chunksize or chunksize >= n:
+            return self.dense_vectors_from_matrix(self.bag_matrix(batch, get=get))
+        result = np.empty((n, self.dimensions), dtype=self._projection.dtype)
+        for start in range(0, n, chunksize):
+            end = min(start + chunksize, n)
+            chunk = self.bag_matrix(batch[start:end], get=get)
+            result[start:end] = self.dense_vectors_from_matrix(chunk)
+        return result
@@ -0,0 +1,166 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Lemma stream cache
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module implements an on-disk cache of the lemma stream that
+    is produced by iterating through a corpus. Training a model requires
+    two passes over the corpus, one to build the dictionary and another
+    to build the plain vector corpus. Lemmatization (particularly parsing)
+    is by far the most expensive part of each pass, so the first pass
+    records its output in the cache and the second pass replays it.
+
+    The cache consists of three files:
+
+    * base.ids: the lemma stream, as 32-bit interned lemma ids
+    * base.offsets: 64-bit offsets of the start of each document
+      within the lemma stream, followed by the total stream length
+    * base.vocab: the interned lemma strings, as a JSON list (lemmas
+      may contain any characters, including line breaks)
+
+"""
+
+from typing import Iterator, Iterable, List, Tuple, Dict
+
+import os
+import json
+from array import array
+
+import numpy as np  # type: ignore
+
+
+# A bag of words, i.e. a list of (dictionary id, count) tuples
+BagOfWords = List[Tuple[int, int]]
+
+# Number of lemma ids to buffer in memory before writing them to disk
+_FLUSH_LIMIT = 1 << 20
+
+
+class LemmaStreamCache:
+
+    """ Records a stream of lemma lists (one list per document) to disk,
+        and replays it either as lemma lists or as bags of words """
+
+    def __init__(self, base_filename: str) -> None:
+        self._base = base_filename
+        self._vocab = []  # type: List[str]
+        self._complete = False
+
+    @property
+    def ids_filename(self) -> str:
+        return self._base + ".ids"
+
+    @property
+    def offsets_filename(self) -> str:
+        return self._base + ".offsets"
+
+    @property
+    def vocab_filename(self) -> str:
+        return self._base + ".vocab"
+
+    @property
+    def filenames(self) -> List[str]:
+        return [self.ids_filename, self.offsets_filename, self.vocab_filename]
+
+    def record(self, documents: Iterable[List[str]]) -> Iterator[List[str]]:
+        """ Pass the lemma lists from the given iterable through
+            unchanged, while writing them to the cache """
+        self._complete = False
+        index = {}  # type: Dict[str, int]
+        vocab = []  # type: List[str]
+        ids = array("I")
+        offsets = array("q")
+        position = 0
+        with open(self.ids_filename, "wb") as f_ids, open(
+            self.offsets_filename, "wb"
+        ) as f_offsets:
+            for lemmas in documents:
+                offsets.append(position)
+                for lemma in lemmas:
+                    ix = index.get(lemma)
+                    if ix is None:
+                        ix = index[lemma] = len(vocab)
+                        vocab.append(lemma)
+                    ids.append(ix)
+                position += len(lemmas)
+                if len(ids) >= _FLUSH_LIMIT:
+                    ids.tofile(f_ids)
+                    offsets.tofile(f_offsets)
+                    ids = array("I")
+                    offsets = array("q")
+                yield lemmas
+            # Terminate the offset list with the total stream length
+            offsets.append(position)
+            ids.tofile(f_ids)
+            offsets.tofile(f_offsets)
+        with open(self.vocab_filename, "w", encoding="utf-8") as f_vocab:
+            json.dump(vocab, f_vocab, ensure_ascii=False)
+        self._vocab = vocab
+        self._complete = True
+
+    def _load(self) -> Tuple[np.ndarray, np.ndarray]:
+        """ Return the lemma id stream and the document offsets """
+        if not self._complete:
+            # Not recorded in this session: read the vocabulary from file
+            with open(self.vocab_filename, "r", encoding="utf-8") as f_vocab:
+                self._vocab = json.load(f_vocab)
+            self._complete = True
+        offsets = np.fromfile(self.offsets_filename, dtype=np.int64)
+        if os.path.getsize(self.ids_filename):
+            ids = np.memmap(self.ids_filename, dtype=np.uint32, mode="r")
+        else:
+            # Cannot memory-map an empty file
+            ids = np.zeros(0, dtype=np.uint32)
+        return ids, offsets
+
+    def __iter__(self) -> Iterator[List[str]]:
+        """ Replay the cached stream as lemma lists """
+        ids, offsets = self._load()
+        vocab = self._vocab
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield [vocab[ix] for ix in ids[start:end]]
+
+    def bags(self, token2id: Dict[str, int]) -> Iterator[BagOfWords]:
+        """ Replay the cached stream as bags of words, using the
+            given dictionary mapping from lemmas to ids. The bags are
+            identical to those returned by Dictionary.doc2bow(). """
+        ids, offsets = self._load()
+        # Map interned lemma ids to dictionary ids (-1 = not in dictionary)
+        mapping = np.array(
+            [token2id.get(lemma, -1) for lemma in self._vocab], dtype=np.int64
+        )
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            doc = mapping[ids[start:end]]
+            keys, counts = np.unique(doc[doc >= 0], return_counts=True)
+            yield list(zip(keys.tolist(), counts.tolist()))
+
+    def remove(self) -> None:
+        """ Remove the cache files, if they exist """
+        for fname in self.filenames:
+            if os.path.exists(fname):
+                os.remove(fname)
+        self._complete = False
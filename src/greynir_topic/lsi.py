@@ -0,0 +1,262 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    LSI training utilities
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module contains utilities for training LSI models on large
+    corpora:
+
+    * reservoir_sample() draws a uniform random sample of documents from
+      a corpus stream of unknown length, in a single pass, so that the LSI
+      basis can be fitted on the sample instead of on the whole corpus.
+
+    * train_chunked() trains an LSI model on a stored corpus by splitting
+      it into chunks of documents, decomposing each chunk (a truncated
+      SVD) in a pool of worker processes, and merging the decompositions
+      in corpus order. This is the one-pass algorithm of Gensim's LsiModel,
+      and of its distributed mode, but using local processes instead of
+      Pyro workers and a dispatcher.
+
+    * project_corpus() calculates the topic vectors of all documents in a
+      stored plain vector corpus, optionally in a pool of worker processes,
+      each of which projects a separate range of documents.
+
+    * compare_bases() measures how close two LSI bases are, via the
+      principal angles between the subspaces that they span.
+
+"""
+
+from typing import Iterable, Iterator, List, Tuple, Dict, Optional, Union, Any, TypeVar
+
+import multiprocessing
+
+import numpy as np  # type: ignore
+
+from .csrcorpus import CsrCorpus, TfidfCsrCorpus
+from .inference import InferenceEngine
+
+
+T = TypeVar("T")
+
+# Default number of documents projected at a time
+_DEFAULT_CHUNKSIZE = 4096
+
+
+def reservoir_sample(items: Iterable[T], size: int, *, seed: int = 0) -> List[T]:
+    """ Return a uniform random sample of (at most) size items from
+        an iterable, in the order in which they occur in it, using
+        reservoir sampling (Vitter's Algorithm R) """
+    rng = np.random.RandomState(seed)
+    reservoir = []  # type: List[Tuple[int, T]]
+    for i, item in enumerate(items):
+        if i < size:
+            reservoir.append((i, item))
+        else:
+            j = rng.randint(0, i + 1)
+            if j < size:
+                reservoir[j] = (i, item)
+    reservoir.sort(key=lambda x: x[0])
+    return [item for _, item in reservoir]
+
+
+# State of SVD worker processes, set by _init_svd_worker()
+_svd_corpus = None  # type: Optional[Union[CsrCorpus, TfidfCsrCorpus]]
+_svd_params = None  # type: Optional[Dict[str, Any]]
+
+
+def _svd_params_of(lsi: Any) -> Dict[str, Any]:
+    """ Return the decomposition parameters of a Gensim LsiModel """
+    return dict(
+        num_terms=lsi.num_terms,
+        num_topics=lsi.num_topics,
+        extra_dims=lsi.extra_samples,
+        power_iters=lsi.power_iters,
+        dtype=lsi.dtype,
+        random_seed=lsi.random_seed,
+    )
+
+
+def _decompose(
+    corpus: Union[CsrCorpus, TfidfCsrCorpus], rows: Tuple[int, int], params: Dict[str, Any]
+) -> Any:
+    """ Return the truncated SVD of a range of documents,
+        as a Gensim Projection instance """
+    from gensim.models.lsimodel import Projection  # type: ignore
+
+    start, end = rows
+    # Projection expects a (terms x documents) matrix in CSC format
+    job = corpus.matrix(start, end).T.tocsc().astype(params["dtype"])
+    return Projection(
+        params["num_terms"], params["num_topics"], job,
+        extra_dims=params["extra_dims"], power_iters=params["power_iters"],
+        dtype=params["dtype"], random_seed=params["random_seed"],
+    )
+
+
+def _init_svd_worker(
+    base_filename: str, num_terms: int, idfs: Optional[np.ndarray], params: Dict[str, Any]
+) -> None:
+    """ Initialize an SVD worker process """
+    global _svd_corpus, _svd_params
+    corpus = CsrCorpus(base_filename, num_terms)
+    _svd_corpus = corpus if idfs is None else TfidfCsrCorpus(corpus, idfs)
+    _svd_params = params
+
+
+def _decompose_range(rows: Tuple[int, int]) -> Any:
+    """ Decompose a range of documents within a worker process """
+    assert _svd_corpus is not None and _svd_params is not None
+    return _decompose(_svd_corpus, rows, _svd_params)
+
+
+def train_chunked(
+    corpus: Union[CsrCorpus, TfidfCsrCorpus], lsi: Any, *,
+    processes: int = 1, chunksize: int = None
+) -> None:
+    """ Add the documents of a stored TFIDF corpus (or of a plain corpus
+        with an on-the-fly TFIDF transformation) to a Gensim LsiModel,
+        typically a fresh one created without a corpus. The corpus is
+        split into chunks of chunksize documents (by default, the chunk
+        size of the model), which are decomposed in a pool of processes
+        if processes > 1. The decompositions are merged into the model's
+        projection in corpus order, with the model's decay factor, so the
+        result is the same as that of LsiModel.add_documents() with the
+        one-pass algorithm. """
+    chunksize = chunksize or lsi.chunksize
+    ranges = [
+        (start, min(start + chunksize, len(corpus)))
+        for start in range(0, len(corpus), chunksize)
+    ]
+    params = _svd_params_of(lsi)
+    if processes <= 1 or len(ranges) <= 1:
+        for rows in ranges:
+            lsi.projection.merge(_decompose(corpus, rows, params), decay=lsi.decay)
+    else:
+        if isinstance(corpus, TfidfCsrCorpus):
+            base, idfs = corpus.corpus, corpus.idfs
+        else:
+            base, idfs = corpus, None
+        pool = multiprocessing.Pool(
+            processes,
+            initializer=_init_svd_worker,
+            initargs=(base.base_filename, base.num_terms, idfs, params),
+        )
+        try:
+            # Merging in the main process overlaps with the
+            # decomposition of subsequent chunks in the workers
+            for update in pool.imap(_decompose_range, ranges):
+                lsi.projection.merge(update, decay=lsi.decay)
+        finally:
+            pool.terminate()
+            pool.join()
+    lsi.docs_processed += len(corpus)
+
+
+# State of projection worker processes, set by _init_projection_worker()
+_worker_corpus = None  # type: Optional[CsrCorpus]
+_worker_engine = None  # type: Optional[InferenceEngine]
+
+
+def _init_projection_worker(
+    base_filename: str, num_terms: int, idfs: np.ndarray, projection: np.ndarray
+) -> None:
+    """ Initialize a projection worker process """
+    global _worker_corpus, _worker_engine
+    _worker_corpus = CsrCorpus(base_filename, num_terms)
+    _worker_engine = InferenceEngine({}, idfs, projection)
+
+
+def _project_range(rows: Tuple[int, int]) -> np.ndarray:
+    """ Project a range of documents within a worker process """
+    assert _worker_corpus is not None and _worker_engine is not None
+    start, end = rows
+    return _worker_engine.dense_vectors_from_matrix(_worker_corpus.matrix(start, end))
+
+
+def project_corpus(
+    corpus: CsrCorpus, engine: InferenceEngine, *,
+    processes: int = 1, chunksize: int = _DEFAULT_CHUNKSIZE
+) -> Iterator[np.ndarray]:
+    """ Yield the dense topic vectors of the documents in a plain vector
+        corpus (of term counts), in corpus order, one chunk of documents
+        at a time. If processes > 1, the chunks are projected in a pool
+        of worker processes, which memory-map the corpus files. """
+    ranges = [
+        (start, min(start + chunksize, len(corpus)))
+        for start in range(0, len(corpus), chunksize)
+    ]
+    if processes <= 1 or len(ranges) <= 1:
+        for start, end in ranges:
+            yield engine.dense_vectors_from_matrix(corpus.matrix(start, end))
+        return
+    pool = multiprocessing.Pool(
+        processes,
+        initializer=_init_projection_worker,
+        initargs=(corpus.base_filename, corpus.num_terms, engine.idfs, engine.projection),
+    )
+    try:
+        yield from pool.imap(_project_range, ranges)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def principal_angles(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """ Return the principal angles, in radians and in ascending order,
+        between the subspaces spanned by the columns of a and b """
+    qa, _ = np.linalg.qr(a)
+    qb, _ = np.linalg.qr(b)
+    cosines = np.linalg.svd(np.dot(qa.T, qb), compute_uv=False)
+    return np.arccos(np.clip(cosines, -1.0, 1.0))
+
+
+def compare_bases(
+    u: np.ndarray, u_reference: np.ndarray, *, dimensions: Optional[Iterable[int]] = None
+) -> Dict[str, Any]:
+    """ Compare an LSI basis (e.g. one fitted on a sample of the corpus)
+        with a reference basis (e.g. one fitted on the full corpus), both
+        of shape (terms, topics). For the leading k topics, for each k in
+        dimensions (by default, all topics and some leading subsets), the
+        report gives the mean and the smallest cosine of the principal
+        angles between the two subspaces; 1.0 means that the subspaces
+        coincide. Individual topics may differ in order and sign between
+        the bases without affecting the comparison. """
+    k_max = min(u.shape[1], u_reference.shape[1])
+    if dimensions is None:
+        dimensions = sorted({k for k in (10, 50, 100, k_max) if k <= k_max})
+    result = []  # type: List[Dict[str, float]]
+    for k in dimensions:
+        cosines = np.cos(principal_angles(u[:, :k], u_reference[:, :k]))
+        result.append(
+            dict(
+                dimensions=k,
+                mean_cosine=float(cosines.mean()),
+                min_cosine=float(cosines.min()),
+                max_angle_degrees=float(np.degrees(np.arccos(cosines.min()))),
+            )
+        )
+    return dict(terms=u.shape[0], subspaces=result)
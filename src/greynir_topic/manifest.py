@@ -0,0 +1,149 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Training manifests
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module implements the manifest of a training run, a JSON file
+    that records which training stages of a model have completed, so
+    that an interrupted run can be resumed without repeating them.
+
+    For each completed stage, the manifest records:
+
+    * a fingerprint: a hash of the stage name, its parameters (such as
+      min_count, max_ratio and the number of dimensions) and the
+      fingerprints of the stages whose outputs it reads, or of the
+      corpus, for the first stage
+    * the parameters themselves, for information
+    * the size and modification time of each output file
+
+    A stage is complete and up to date if its fingerprint matches the
+    one computed for the current run and its output files are unchanged.
+    A stage is removed from the manifest when it starts, and added when
+    it finishes, so a stage that was interrupted is never regarded as
+    complete. The manifest is written atomically after each change.
+
+"""
+
+from typing import Iterable, Dict, Any
+
+import os
+import json
+import time
+import hashlib
+
+
+# The current version of the manifest format
+MANIFEST_VERSION = 1
+
+
+def fingerprint(*parts: Any) -> str:
+    """ Return a hash of a sequence of JSON-serializable values """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def _stamp(filename: str) -> Dict[str, int]:
+    st = os.stat(filename)
+    return dict(size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+
+class TrainingManifest:
+
+    """ The record of the completed training stages of a model """
+
+    def __init__(self, filename: str) -> None:
+        """ Create a manifest, loading it from the given file if
+            it exists and has the current format version """
+        self._filename = filename
+        self._directory = os.path.dirname(filename)
+        self._stages = {}  # type: Dict[str, Dict[str, Any]]
+        if os.path.exists(filename):
+            with open(filename, "r", encoding="utf-8") as f:
+                contents = json.load(f)
+            if contents.get("version") == MANIFEST_VERSION:
+                self._stages = contents["stages"]
+
+    @property
+    def filename(self) -> str:
+        return self._filename
+
+    @property
+    def stages(self) -> Dict[str, Dict[str, Any]]:
+        """ The completed stages, mapped to their records """
+        return self._stages
+
+    def is_complete(self, stage: str, stage_fingerprint: str) -> bool:
+        """ Return True if the stage has completed with the given
+            fingerprint and its output files are unchanged since then """
+        entry = self._stages.get(stage)
+        if entry is None or entry["fingerprint"] != stage_fingerprint:
+            return False
+        for name, stamp in entry["outputs"].items():
+            filename = os.path.join(self._directory, name)
+            if not os.path.exists(filename) or _stamp(filename) != stamp:
+                return False
+        return True
+
+    def start(self, stage: str) -> None:
+        """ Mark a stage as started, i.e. not complete """
+        if self._stages.pop(stage, None) is not None:
+            self.save()
+
+    def complete(
+        self, stage: str, stage_fingerprint: str,
+        params: Dict[str, Any], outputs: Iterable[str]
+    ) -> None:
+        """ Mark a stage as complete, recording its output files,
+            which must be in the same directory as the manifest """
+        self._stages[stage] = dict(
+            fingerprint=stage_fingerprint,
+            params=params,
+            outputs={
+                os.path.relpath(f, self._directory): _stamp(f)
+                for f in outputs
+                if os.path.exists(f)
+            },
+            completed=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        )
+        self.save()
+
+    def save(self) -> None:
+        """ Write the manifest, atomically replacing any previous version """
+        temp_filename = self._filename + ".tmp"
+        with open(temp_filename, "w", encoding="utf-8") as f:
+            json.dump(
+                dict(version=MANIFEST_VERSION, stages=self._stages),
+                f, indent=2, sort_keys=True,
+            )
+        os.replace(temp_filename, self._filename)
+
+    def remove(self) -> None:
+        """ Delete the manifest file """
+        self._stages = {}
+        if os.path.exists(self._filename):
+            os.remove(self._filename)
@@ -0,0 +1,194 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Training instrumentation
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module contains the instrumentation of the training stages of
+    a model (dictionary, plain corpus, TFIDF model and corpus, LSI model
+    and similarity index).
+
+    Model.train() and Model.train_similarity() measure each stage with
+    a Stage instance and pass the resulting metrics to any observers
+    that have been registered with Model.add_observer(). An observer is
+    an instance of a TrainingObserver subclass, overriding one or both
+    of its methods. The TrainingReport observer collects the metrics of
+    all stages and can save them to a JSON file; the model keeps one for
+    the most recent training run, in Model.training_report.
+
+    The metrics of each stage include:
+
+    * stage: the name of the stage
+    * wall_seconds, cpu_seconds: the elapsed and CPU time of the stage;
+      the CPU time of worker processes is given in children_cpu_seconds
+    * peak_rss_mb: the peak resident memory of the process so far, and
+      children_peak_rss_mb, that of the largest worker process so far
+      (not available on all platforms)
+    * artifact_bytes: the total size of the files written by the stage
+
+    and, where applicable, documents, empty_documents (dropped because
+    they contain no lemmas), lemmas, documents_per_second,
+    lemmas_per_second, vocabulary_before and vocabulary_after (the
+    vocabulary size before and after filtering by document frequency).
+
+"""
+
+from typing import Iterable, List, Dict, Optional, Any
+
+import os
+import sys
+import json
+import time
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # Not available on Windows
+    resource = None  # type: ignore
+
+
+def _rusage() -> Dict[str, float]:
+    """ Return the CPU time and peak memory use of this
+        process and of its terminated child processes """
+    if resource is None:
+        return dict(cpu=time.process_time(), children_cpu=0.0)
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in kilobytes, except on macOS, where it is in bytes
+    scale = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0
+    return dict(
+        cpu=time.process_time(),
+        children_cpu=children.ru_utime + children.ru_stime,
+        peak_rss_mb=own.ru_maxrss / scale,
+        children_peak_rss_mb=children.ru_maxrss / scale,
+    )
+
+
+def artifact_bytes(filenames: Iterable[str]) -> int:
+    """ Return the total size of the given files, ignoring missing ones """
+    return sum(os.path.getsize(f) for f in filenames if os.path.exists(f))
+
+
+class TrainingObserver:
+
+    """ Base class for observers of model training. Subclasses
+        override the methods for the events that they are interested in. """
+
+    def stage_started(self, stage: str) -> None:
+        """ Called when a training stage starts """
+        pass
+
+    def stage_finished(self, stage: str, metrics: Dict[str, Any]) -> None:
+        """ Called with the metrics of a training stage when it finishes """
+        pass
+
+
+class TrainingReport(TrainingObserver):
+
+    """ An observer that collects the metrics of each training stage """
+
+    def __init__(self) -> None:
+        self._stages = []  # type: List[Dict[str, Any]]
+
+    def stage_finished(self, stage: str, metrics: Dict[str, Any]) -> None:
+        self._stages.append(metrics)
+
+    @property
+    def stages(self) -> List[Dict[str, Any]]:
+        """ The metrics of each finished stage, in order """
+        return self._stages
+
+    def stage(self, stage: str) -> Optional[Dict[str, Any]]:
+        """ Return the metrics of the given stage, or None if it did not run """
+        for metrics in self._stages:
+            if metrics["stage"] == stage:
+                return metrics
+        return None
+
+    def as_dict(self) -> Dict[str, Any]:
+        """ Return the report as a JSON-serializable dict """
+        return dict(
+            stages=self._stages,
+            wall_seconds=sum(m["wall_seconds"] for m in self._stages),
+            cpu_seconds=sum(
+                m["cpu_seconds"] + m["children_cpu_seconds"] for m in self._stages
+            ),
+        )
+
+    def save(self, filename: str) -> None:
+        """ Write the report to a JSON file """
+        with open(filename, "w", encoding="utf-8") as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+
+class Stage:
+
+    """ A context manager that measures a training stage and reports
+        its metrics to a list of observers when it finishes without
+        an exception. Additional metrics can be added with record(). """
+
+    def __init__(self, name: str, observers: Iterable[TrainingObserver]) -> None:
+        self._name = name
+        self._observers = list(observers)
+        self._metrics = {}  # type: Dict[str, Any]
+        self._start_wall = 0.0
+        self._start_usage = {}  # type: Dict[str, float]
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    def record(self, **metrics: Any) -> None:
+        """ Add metrics to the stage, such as documents=n """
+        self._metrics.update(metrics)
+
+    def __enter__(self) -> "Stage":
+        for observer in self._observers:
+            observer.stage_started(self._name)
+        self._start_usage = _rusage()
+        self._start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        if exc_type is not None:
+            return
+        wall = time.perf_counter() - self._start_wall
+        usage = _rusage()
+        metrics = dict(
+            stage=self._name,
+            wall_seconds=wall,
+            cpu_seconds=usage["cpu"] - self._start_usage["cpu"],
+            children_cpu_seconds=usage["children_cpu"] - self._start_usage["children_cpu"],
+        )
+        if "peak_rss_mb" in usage:
+            metrics["peak_rss_mb"] = usage["peak_rss_mb"]
+            metrics["children_peak_rss_mb"] = usage["children_peak_rss_mb"]
+        metrics.update(self._metrics)
+        for count in ("documents", "lemmas"):
+            if count in metrics and wall > 0.0:
+                metrics[count + "_per_second"] = metrics[count] / wall
+        for observer in self._observers:
+            observer.stage_finished(self._name, metrics)
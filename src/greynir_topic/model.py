@@ -53,13 +53,40 @@
 
 """
 
-from typing import Iterator, Tuple, List, Union, Optional
+from typing import (
+    TYPE_CHECKING,
+    Iterator, Iterable, Sequence, Tuple, List, Dict, Set, Union, Optional, Any
+)
 
 import os
 import sys
+import glob
 from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice, chain, repeat
+import multiprocessing
+import threading
+import time
 
-from gensim import corpora, models, matutils, similarities  # type: ignore
+import numpy as np  # type: ignore
+
+from .lemmacache import LemmaStreamCache, BagOfWords
+from .csrcorpus import CsrCorpus, CsrWriter, TfidfCsrCorpus, tfidf_transform
+from .inference import InferenceEngine
+from .index import top_k, recall_at_k, DenseIndex, IVFIndex
+from .serving import ServingState
+from .dictbuilder import DictionaryBuilder
+from .lsi import reservoir_sample, train_chunked, project_corpus, compare_bases
+from .metrics import TrainingObserver, TrainingReport, Stage, artifact_bytes
+from .manifest import TrainingManifest, fingerprint
+
+if TYPE_CHECKING:
+    from .dictionary import Dictionary
+
+# Note that Gensim is imported on demand, within the functions that
+# need it, so that serving a model from a ServingState or a bundle
+# does not pay for importing it
 
 
 # A TopicVector is a sparse array of floats,
@@ -97,18 +124,130 @@ class Corpus(ABC):
         """ Yield a stream of Document objects """
         ...
 
+    def fingerprint(self) -> Optional[str]:
+        """ Return a string that identifies the contents of the corpus,
+            such as a hash of the names, sizes and modification times of
+            its source files, or None if there is no such identifier.
+            A resumed training run only reuses the outputs of earlier
+            stages if the fingerprint of the corpus is unchanged. """
+        return None
+
+
+def __getattr__(name: str) -> Any:
+    """ Import the Dictionary class, and thereby Gensim, only on demand
+        (module attribute lookup hook, cf. PEP 562) """
+    if name == "Dictionary":
+        from .dictionary import Dictionary
+
+        return Dictionary
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+class LemmaCounts:
+
+    """ The lemmas of a document, counted as they are streamed from it,
+        so that memory use is proportional to the number of distinct
+        lemmas in the document rather than to its length. The lemma
+        strings are interned, so that each distinct lemma is only
+        stored once across documents. Iterating over a LemmaCounts
+        instance yields each lemma as many times as it occurs, so it
+        can be used wherever a list of lemmas is expected, e.g. by
+        Dictionary.doc2bow() and LemmaStreamCache.record(). """
+
+    __slots__ = ("_counts", "_total")
+
+    def __init__(self, lemmas: Iterable[LemmaString] = ()) -> None:
+        counts = {}  # type: Dict[str, int]
+        intern = sys.intern
+        get = counts.get
+        total = 0
+        for lemma in lemmas:
+            c = get(lemma)
+            if c is None:
+                counts[intern(lemma)] = 1
+            else:
+                counts[lemma] = c + 1
+            total += 1
+        self._counts = counts
+        self._total = total
 
-class Dictionary(corpora.Dictionary):
-
-    """ Subclass of gensim.corpora.Dictionary that adds a __contains__
-        operator for easy membership check """
+    @property
+    def counts(self) -> Dict[str, int]:
+        """ The number of occurrences of each distinct lemma """
+        return self._counts
 
-    def __init__(self, iterator: "CorpusIterator") -> None:
-        super().__init__(iterator)
+    def __len__(self) -> int:
+        """ The total number of lemmas, including repeats """
+        return self._total
 
-    def __contains__(self, word: str) -> bool:
-        """ Return True if the given word/lemma is in the dictionary """
-        return word in self.token2id
+    def __iter__(self) -> Iterator[LemmaString]:
+        return chain.from_iterable(map(repeat, self._counts.keys(), self._counts.values()))
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, LemmaCounts) and self._counts == other._counts
+
+    def __repr__(self) -> str:
+        return "LemmaCounts({0!r})".format(self._counts)
+
+    def __getstate__(self) -> Tuple[Dict[str, int], int]:
+        return self._counts, self._total
+
+    def __setstate__(self, state: Tuple[Dict[str, int], int]) -> None:
+        self._counts, self._total = state
+        # Intern the lemmas received from a worker process
+        self._counts = {sys.intern(k): v for k, v in self._counts.items()}
+
+    def bag(self, token2id: Any) -> BagOfWords:
+        """ Return the bag of words for the lemmas, i.e. a list of
+            (dictionary id, count) tuples sorted by id, omitting
+            lemmas that are not in the dictionary. This is identical
+            to the result of Dictionary.doc2bow(). """
+        get = token2id.get
+        bag = {}  # type: Dict[int, int]
+        for lemma, count in self._counts.items():
+            ix = get(lemma)
+            if ix is not None:
+                # Several lemmas can map to the same id in a hashed vocabulary
+                bag[ix] = bag.get(ix, 0) + count
+        return sorted(bag.items())
+
+
+def _vocabulary_of(dictionary: Any) -> Any:
+    """ Return the mapping from lemmas to ids of a dictionary, which
+        is the token2id dict of an ordinary dictionary, or a
+        HashVocabulary for a hashed dictionary """
+    vocabulary = getattr(dictionary, "vocabulary", None)
+    return dictionary.token2id if vocabulary is None else vocabulary
+
+
+# Assigned to Model._engine when the configuration of the TFIDF and
+# LSI models is not supported by the inference engine, so that this
+# is only checked once
+_UNSUPPORTED_ENGINE = object()
+
+# Dictionary used by CorpusIterator worker processes, if any.
+# This is set once per worker process by _init_worker().
+_worker_dictionary = None  # type: Optional[Dictionary]
+
+
+def _init_worker(dictionary: Optional["Dictionary"]) -> None:
+    """ Initialize a CorpusIterator worker process """
+    global _worker_dictionary
+    _worker_dictionary = dictionary
+
+
+def _process_documents(documents: List[Document]) -> List[Tuple[int, Any]]:
+    """ Lemmatize a batch of documents within a worker process,
+        returning the number of lemmas and the lemma counts or
+        a bag of words for each of them """
+    result = []  # type: List[Tuple[int, Any]]
+    for document in documents:
+        lemmas = LemmaCounts(document)
+        if lemmas and _worker_dictionary is not None:
+            result.append((len(lemmas), lemmas.bag(_vocabulary_of(_worker_dictionary))))
+        else:
+            result.append((len(lemmas), lemmas))
+    return result
 
 
 class CorpusIterator:
@@ -116,27 +255,114 @@ class CorpusIterator:
     """ Iterate through a Corpus (collection of Document instances),
         yielding a stream of indexable strings (usually of the form
         "lemma/cat") that are collected into a bag-of-words for
-        each document. """
+        each document. With a dictionary, a bag of words is yielded
+        for each document. Without a dictionary, the lemmas of each
+        document are yielded as a LemmaCounts instance, not as a list
+        of lemmas as in earlier versions. A LemmaCounts instance can
+        be iterated over and has a length, like a list, but it cannot
+        be indexed and it yields repeated lemmas together rather than
+        in document order; call list() on it if a list is needed.
+        Either way, the lemmas are counted as they are streamed from
+        the document, without ever being collected into a list.
+
+        If processes > 1, the documents are lemmatized in a pool of
+        worker processes, each with its own copy of any lemmatizer
+        state (such as the ParsedDocument parser singleton). Documents
+        are sent to the workers in batches of chunksize, with at most
+        max_in_flight batches outstanding at any time, and results are
+        yielded in the same order as the documents in the corpus.
+        Documents must be picklable for this to work.
+
+        Documents that contain no lemmas are skipped. After (or during)
+        an iteration, num_documents, num_empty and num_lemmas give
+        the number of documents read, the number of them that were
+        skipped, and the total number of lemmas. """
+
+    # Default number of documents sent to a worker process at a time
+    _DEFAULT_CHUNKSIZE = 16
 
-    def __init__(self, corpus: Corpus, dictionary: Dictionary = None):
+    def __init__(
+        self, corpus: Corpus, dictionary: "Dictionary" = None, *,
+        processes: int = 1, chunksize: int = None, max_in_flight: int = None
+    ) -> None:
         self._corpus = corpus
         self._dictionary = dictionary
+        self._processes = max(1, processes or 1)
+        self._chunksize = chunksize or self._DEFAULT_CHUNKSIZE
+        # By default, allow each worker to have a couple of batches queued
+        self._max_in_flight = max_in_flight or 2 * self._processes
         if self._dictionary is not None:
             # If this iterator is associated with a dictionary, use it to
             # return bags-of-words using dictionary indices
-            self._xform = lambda x: self._dictionary.doc2bow(x)
+            token2id = _vocabulary_of(self._dictionary)
+            self._xform = lambda x: x.bag(token2id)
         else:
-            # No dictionary: return the lemma/cat strings as-is
+            # No dictionary: return the lemma/cat counts as-is
             self._xform = lambda x: x
+        self._num_documents = 0
+        self._num_empty = 0
+        self._num_lemmas = 0
+
+    @property
+    def num_documents(self) -> int:
+        return self._num_documents
+
+    @property
+    def num_empty(self) -> int:
+        return self._num_empty
 
-    def __iter__(self) -> Iterator[Union[List[LemmaString], List[int]]]:
-        """ Iterate through documents and return a lemma/cat list or
-            a bag of words for each of them """
+    @property
+    def num_lemmas(self) -> int:
+        return self._num_lemmas
+
+    def __iter__(self) -> Iterator[Union[LemmaCounts, BagOfWords]]:
+        """ Iterate through documents and return the lemma/cat
+            counts or a bag of words for each of them """
+        self._num_documents = self._num_empty = self._num_lemmas = 0
+        if self._processes > 1:
+            yield from self._iter_parallel()
+            return
         xform = self._xform
         for document in self._corpus:
-            lemmas = [lemma for lemma in document]
+            lemmas = LemmaCounts(document)
+            self._num_documents += 1
             if lemmas:
+                self._num_lemmas += len(lemmas)
                 yield xform(lemmas)
+            else:
+                self._num_empty += 1
+
+    def _iter_parallel(self) -> Iterator[Union[LemmaCounts, BagOfWords]]:
+        """ Iterate through documents using a pool of worker processes,
+            yielding results in corpus order """
+        pool = multiprocessing.Pool(
+            self._processes,
+            initializer=_init_worker,
+            initargs=(self._dictionary,),
+        )
+        try:
+            pending = deque()  # type: deque
+            documents = iter(self._corpus)
+            while True:
+                # Keep the queue of outstanding batches full
+                while len(pending) < self._max_in_flight:
+                    batch = list(islice(documents, self._chunksize))
+                    if not batch:
+                        break
+                    pending.append(pool.apply_async(_process_documents, (batch,)))
+                if not pending:
+                    break
+                # Wait for the oldest batch, thereby maintaining the order
+                for num_lemmas, result in pending.popleft().get():
+                    self._num_documents += 1
+                    if num_lemmas:
+                        self._num_lemmas += num_lemmas
+                        yield result
+                    else:
+                        self._num_empty += 1
+        finally:
+            pool.terminate()
+            pool.join()
 
 
 class Model:
@@ -146,6 +372,17 @@ class Model:
     # Default number of dimensions in topic vectors
     _DEFAULT_DIMENSIONS = 200
 
+    # Model artifacts that are loaded lazily, mapped to the attribute
+    # that holds each of them and the method that loads it
+    _ARTIFACTS = {
+        "dictionary": ("_dictionary", "load_dictionary"),
+        "tfidf": ("_tfidf", "load_tfidf_model"),
+        "lsi": ("_model", "load_lsi_model"),
+        "engine": ("_engine", "load_inference_engine"),
+        "similarity": ("_simindex", "load_similarity_index"),
+        "ann": ("_ann", "load_ann_index"),
+    }
+
     # The default directory for model data files is the ./models directory
     _DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), "models")
 
@@ -166,6 +403,22 @@ class Model:
         self._tfidf = None
         self._model = None
         self._simindex = None
+        self._ann = None  # type: Optional[IVFIndex]
+        # Serializes modifications of the similarity index
+        self._index_lock = threading.Lock()
+        self._engine = None  # type: Optional[InferenceEngine]
+        # The serving state loaded by load_serving_state(), if any
+        self._serving_state = None  # type: Optional[ServingState]
+        # Serializes the lazy loading of model artifacts, so that each
+        # is loaded only once even if many threads need it at the same time
+        self._load_lock = threading.RLock()
+        self._load_timings = {}  # type: Dict[str, float]
+        self._dictionary_report = None  # type: Optional[Dict[str, Any]]
+        # Training instrumentation
+        self._observers = []  # type: List[TrainingObserver]
+        self._training_report = None  # type: Optional[TrainingReport]
+        self._training = False
+        self._stage = None  # type: Optional[Stage]
 
     def _filename_from_ext(self, ext: str) -> str:
         """ Return a full file path from a given extension """
@@ -193,14 +446,100 @@ class Model:
 
     @property
     def simindex_filename(self) -> str:
-        return self._filename_from_ext("similarity")
+        return self._filename_from_ext("similarity.npy")
+
+    @property
+    def ann_index_filename(self) -> str:
+        return self._filename_from_ext("ann.npz")
+
+    @property
+    def lemma_cache_filename(self) -> str:
+        return self._filename_from_ext("lemmas")
+
+    @property
+    def serving_state_filename(self) -> str:
+        return self._filename_from_ext("serving")
+
+    @property
+    def manifest_filename(self) -> str:
+        return self._filename_from_ext("manifest.json")
+
+    @property
+    def bundle_filename(self) -> str:
+        return self._filename_from_ext("bundle")
 
     @property
     def dimensions(self) -> int:
         return self._dimensions
 
-    def train_dictionary(self, corpus_iterator: CorpusIterator, *,
-        min_count: int = 5, max_ratio: float = 0.5) -> None:
+    @property
+    def load_timings(self) -> Dict[str, float]:
+        """ The time, in seconds, that it took to load each
+            of the model artifacts that have been loaded lazily
+            or by warm_up() """
+        return dict(self._load_timings)
+
+    def _ensure(self, artifact: str) -> None:
+        """ Load the given model artifact if it has not been loaded
+            already. This is safe to call from multiple threads: the
+            artifact is only loaded once, by the first thread that needs
+            it, while the other threads wait for it to finish. """
+        attr, loader = self._ARTIFACTS[artifact]
+        # Artifacts are fully constructed before being assigned, so
+        # checking without the lock first is safe and avoids contention
+        if getattr(self, attr) is not None:
+            return
+        with self._load_lock:
+            if getattr(self, attr) is not None:
+                return
+            t0 = time.perf_counter()
+            getattr(self, loader)()
+            self._load_timings[artifact] = time.perf_counter() - t0
+
+    def warm_up(
+        self, *, similarity: bool = True, ann: bool = True, prefetch: bool = False
+    ) -> Dict[str, float]:
+        """ Load all model artifacts needed for inference ahead of time,
+            so that the first calls to topic_vector() and nearest_neighbors()
+            don't pay for it. The similarity index and the approximate
+            nearest neighbor index are loaded too, if they exist and the
+            corresponding parameters are True. If prefetch is True, the
+            memory-mapped similarity index is read through once, to bring
+            it into the page cache. Returns a dict with the load time,
+            in seconds, of each artifact that was loaded. If the model is
+            served from a serving state (see load_serving_state()), the
+            Gensim artifacts are not loaded, since they are not needed
+            and may not even exist. """
+        state = self._serving_state
+        serving = state is not None and self._engine is state.engine
+        artifacts = [] if serving else ["dictionary", "tfidf", "lsi", "engine"]
+        if similarity and (
+            os.path.exists(self.simindex_filename)
+            or os.path.exists(self._filename_from_ext("similarity"))
+        ):
+            artifacts.append("similarity")
+            if ann and os.path.exists(self.ann_index_filename):
+                artifacts.append("ann")
+        for artifact in artifacts:
+            self._ensure(artifact)
+        timings = {
+            artifact: self._load_timings[artifact]
+            for artifact in artifacts
+            if artifact in self._load_timings
+        }
+        if serving and "serving" in self._load_timings:
+            timings["serving"] = self._load_timings["serving"]
+        if prefetch and isinstance(self._simindex, DenseIndex):
+            t0 = time.perf_counter()
+            vectors = self._simindex.vectors
+            for start in range(0, len(vectors), 65536):
+                np.add.reduce(vectors[start : start + 65536], axis=None)
+            timings["prefetch"] = time.perf_counter() - t0
+        return timings
+
+    def train_dictionary(self, corpus_iterator: Iterable[List[LemmaString]], *,
+        min_count: int = 5, max_ratio: float = 0.5,
+        max_vocabulary: int = None) -> None:
         """ Iterate through the document corpus
             and create a fresh Gensim dictionary. The min_count parameter
             indicates the minimum number of documents that a word must
@@ -208,94 +547,401 @@ class Model:
             parameter specifies the maximum number of documents that a
             word can occur in to be included in the dictionary, as a fraction
             of the total corpus size (0.5 = 50% of the documents in the corpus).
+            If max_vocabulary is given, at most that many distinct words are
+            kept in memory during the pass, and the least frequent ones are
+            pruned as needed (see DictionaryBuilder); the pruning statistics
+            are then available in dictionary_report.
         """
-        dic = Dictionary(corpus_iterator)
-        # Drop words that only occur very few times in the entire set,
-        # and words that occur very frequently and are thus not likely
-        # to be significant when indexing or in searches
-        if min_count > 0 or max_ratio < 1.0:
-            dic.filter_extremes(no_below=min_count, no_above=max_ratio, keep_n=None)
+        if max_vocabulary:
+            builder = DictionaryBuilder(max_vocabulary)
+            builder.add_documents(corpus_iterator)
+            dic = builder.dictionary(min_count=min_count, max_ratio=max_ratio)
+            self._dictionary_report = builder.report()
+            self._record(vocabulary_before=self._dictionary_report["tracked"])
+        else:
+            from .dictionary import Dictionary
+
+            dic = Dictionary(corpus_iterator)
+            self._record(vocabulary_before=len(dic))
+            # Drop words that only occur very few times in the entire set,
+            # and words that occur very frequently and are thus not likely
+            # to be significant when indexing or in searches
+            if min_count > 0 or max_ratio < 1.0:
+                dic.filter_extremes(no_below=min_count, no_above=max_ratio, keep_n=None)
+            self._dictionary_report = None
         # We must have something in our dictionary
         assert len(dic.token2id) > 0
+        self._record(vocabulary_after=len(dic))
         dic.save(self.dictionary_filename)
         self._dictionary = dic
+        self._engine = None
+
+    def train_hashed_corpus(
+        self, corpus: Corpus, num_buckets: int, *,
+        min_count: int = 5, max_ratio: float = 0.5, processes: int = 1
+    ) -> None:
+        """ Create a plain vector corpus in a single pass over the
+            document corpus, mapping lemmas to num_buckets ids via a
+            stable hash function, and create a hashed dictionary with
+            document frequencies taken from the vector corpus. Buckets
+            are filtered by document frequency as in train_dictionary(),
+            except that instead of being removed, filtered buckets get
+            no idf weight and are thereby ignored. """
+        from .dictionary import HashDictionary
+
+        dic = HashDictionary(num_buckets)
+        iterator = CorpusIterator(corpus, dictionary=dic, processes=processes)
+        self.train_plain_corpus(iterator)
+        self._record(
+            documents=iterator.num_documents,
+            empty_documents=iterator.num_empty,
+            lemmas=iterator.num_lemmas,
+        )
+        plain = CsrCorpus(self.plain_corpus_filename, num_buckets)
+        dfs, cfs = plain.term_frequencies()
+        keep = dfs > 0
+        if min_count > 0 or max_ratio < 1.0:
+            # The same criteria as Dictionary.filter_extremes()
+            keep &= (dfs >= min_count) & (dfs <= int(max_ratio * len(plain)))
+        nonzero = np.flatnonzero(keep).tolist()
+        self._record(vocabulary_before=int((dfs > 0).sum()), vocabulary_after=len(nonzero))
+        dic.dfs = dict(zip(nonzero, dfs[nonzero].tolist()))
+        dic.cfs = dict(zip(nonzero, cfs[nonzero].astype(np.int64).tolist()))
+        dic.num_docs = len(plain)
+        dic.num_nnz = plain.num_nnz
+        dic.num_pos = int(cfs.sum())
+        dic.save(self.dictionary_filename)
+        self._dictionary = dic
+        self._dictionary_report = None
+        self._engine = None
+
+    @property
+    def dictionary_report(self) -> Optional[Dict[str, Any]]:
+        """ Pruning statistics from the last bounded-memory
+            dictionary pass, if any (see DictionaryBuilder.report()) """
+        return self._dictionary_report
+
+    def add_observer(self, observer: TrainingObserver) -> None:
+        """ Register an observer that is notified when each
+            stage of train() or train_similarity() starts and
+            finishes (see metrics.py) """
+        self._observers.append(observer)
+
+    def remove_observer(self, observer: TrainingObserver) -> None:
+        self._observers.remove(observer)
+
+    @property
+    def training_report(self) -> Optional[TrainingReport]:
+        """ The metrics of each stage of the most recent
+            call to train() or train_similarity() """
+        return self._training_report
+
+    @contextmanager
+    def _training_run(self, report_filename: Optional[str]) -> Iterator[None]:
+        """ Collect a fresh training report for the stages run within
+            the block, unless already within such a block, and save it
+            to the given JSON file if training completes """
+        if self._training:
+            yield
+            return
+        self._training_report = TrainingReport()
+        self._training = True
+        try:
+            yield
+        finally:
+            self._training = False
+        if report_filename is not None:
+            self._training_report.save(report_filename)
+
+    @contextmanager
+    def _training_stage(self, name: str) -> Iterator[Stage]:
+        """ Measure a training stage, reporting it to the observers """
+        observers = list(self._observers)
+        if self._training and self._training_report is not None:
+            observers.append(self._training_report)
+        with Stage(name, observers) as stage:
+            self._stage = stage
+            try:
+                yield stage
+            finally:
+                self._stage = None
+
+    def _record(self, **metrics: Any) -> None:
+        """ Add metrics to the current training stage, if any """
+        if self._stage is not None:
+            self._stage.record(**metrics)
+
+    @staticmethod
+    def _saved_files(filename: str) -> List[str]:
+        """ Return the files of a saved Gensim object, which may
+            store large arrays in separate files next to the main one """
+        return [filename] + glob.glob(glob.escape(filename) + ".*")
 
     def load_dictionary(self) -> None:
         """ Load a dictionary from a previously prepared file """
+        from .dictionary import Dictionary
+
         self._dictionary = Dictionary.load(self.dictionary_filename)
+        self._engine = None
 
-    def train_plain_corpus(self, corpus_iterator: CorpusIterator) -> None:
+    def train_plain_corpus(self, corpus_iterator: Iterable[BagOfWords]) -> None:
         """ Create a plain vector corpus, where each vector represents a
             document. Each element of the vector contains the count of
             the corresponding word (as indexed by the dictionary) in
             the document. """
-        corpora.MmCorpus.serialize(self.plain_corpus_filename, corpus_iterator)
+        CsrCorpus.serialize(self.plain_corpus_filename, corpus_iterator)
 
-    def load_plain_corpus(self) -> corpora.MmCorpus:
+    def load_plain_corpus(self) -> CsrCorpus:
         """ Load the plain corpus from file """
-        return corpora.MmCorpus(self.plain_corpus_filename)
+        self._ensure("dictionary")
+        assert self._dictionary is not None
+        return CsrCorpus(self.plain_corpus_filename, len(self._dictionary))
 
     def train_tfidf_model(self) -> None:
         """ Create a fresh TFIDF model from a dictionary """
-        if self._dictionary is None:
-            self.load_dictionary()
+        self._ensure("dictionary")
+        from gensim import models  # type: ignore
+
         tfidf = models.TfidfModel(dictionary=self._dictionary)
         tfidf.save(self.tfidf_model_filename)
         self._tfidf = tfidf
+        self._engine = None
 
     def load_tfidf_model(self) -> None:
         """ Load an already generated TFIDF model """
+        from gensim import models  # type: ignore
+
         self._tfidf = models.TfidfModel.load(self.tfidf_model_filename, mmap="r")
+        self._engine = None
 
     def train_tfidf_corpus(self) -> None:
         """ Create a TFIDF corpus from a plain vector corpus """
-        if self._tfidf is None:
-            self.load_tfidf_model()
+        self._ensure("tfidf")
         assert self._tfidf is not None
         corpus = self.load_plain_corpus()
-        corpus_tfidf = self._tfidf[corpus]
-        corpora.MmCorpus.serialize(self.tfidf_corpus_filename, corpus_tfidf)
+        if InferenceEngine.supports_tfidf(self._tfidf):
+            # Transform the corpus a chunk of documents at a time
+            idfs = InferenceEngine.idf_vector(self._tfidf, corpus.num_terms)
+            with CsrWriter(self.tfidf_corpus_filename) as w:
+                for chunk in corpus.chunks():
+                    w.add_matrix(tfidf_transform(chunk, idfs))
+        else:
+            CsrCorpus.serialize(self.tfidf_corpus_filename, self._tfidf[corpus])
 
-    def load_tfidf_corpus(self) -> corpora.MmCorpus:
+    def load_tfidf_corpus(self) -> CsrCorpus:
         """ Load a TFIDF corpus from file """
-        return corpora.MmCorpus(self.tfidf_corpus_filename)
+        self._ensure("dictionary")
+        assert self._dictionary is not None
+        return CsrCorpus(self.tfidf_corpus_filename, len(self._dictionary))
+
+    def stream_tfidf_corpus(self) -> Iterable[BagOfWords]:
+        """ Return a view of the plain corpus that applies the
+            TFIDF transformation on the fly, without storing it """
+        return self.stream_tfidf_corpus_from(self.load_plain_corpus())
 
-    def train_lsi_model(self, **kwargs) -> None:
-        """ Train an LSI model from the entire document corpus """
-        corpus_tfidf = self.load_tfidf_corpus()
-        if self._dictionary is None:
-            self.load_dictionary()
+    def stream_tfidf_corpus_from(self, corpus: CsrCorpus) -> Iterable[BagOfWords]:
+        """ Return a view of the given plain vector corpus that
+            applies the TFIDF transformation on the fly """
+        self._ensure("tfidf")
+        assert self._tfidf is not None
+        if InferenceEngine.supports_tfidf(self._tfidf):
+            idfs = InferenceEngine.idf_vector(self._tfidf, corpus.num_terms)
+            return TfidfCsrCorpus(corpus, idfs)
+        return self._tfidf[corpus]
+
+    def _tfidf_corpus(self) -> Iterable[BagOfWords]:
+        """ Return the stored TFIDF corpus if it exists,
+            or otherwise a TFIDF stream from the plain corpus """
+        if CsrCorpus.exists(self.tfidf_corpus_filename):
+            return self.load_tfidf_corpus()
+        return self.stream_tfidf_corpus()
+
+    def train_lsi_model(
+        self, *, sample_size: int = None, seed: int = 0, processes: int = 1, **kwargs
+    ) -> None:
+        """ Train an LSI model from the entire document corpus or, if
+            sample_size is given, from a uniform random sample of that
+            many documents, drawn from the corpus in a single pass.
+            If processes > 1, the corpus is decomposed in chunks in that
+            many worker processes, and the results merged (this does not
+            apply to a sample, or with the multi-pass algorithm). """
+        corpus_tfidf = self._tfidf_corpus()
+        self._ensure("dictionary")
         # Initialize an LSI transformation
-        lsi = models.LsiModel(
+        from gensim import models  # type: ignore
+
+        if (
+            processes > 1
+            and sample_size is None
+            and isinstance(corpus_tfidf, (CsrCorpus, TfidfCsrCorpus))
+            and kwargs.get("onepass", True)
+            and not kwargs.get("distributed", False)
+        ):
+            lsi = models.LsiModel(
+                id2word=self._dictionary, num_topics=self._dimensions, **kwargs
+            )
+            train_chunked(corpus_tfidf, lsi, processes=processes)
+        else:
+            if sample_size is not None:
+                corpus_tfidf = reservoir_sample(corpus_tfidf, sample_size, seed=seed)
+            lsi = models.LsiModel(
+                corpus_tfidf,
+                id2word=self._dictionary,
+                num_topics=self._dimensions,
+                **kwargs
+            )
+        # Save the generated model
+        self._model = lsi
+        self._engine = None
+        lsi.save(self.lsi_model_filename)
+
+    def lsi_quality_report(self, **kwargs) -> Dict[str, Any]:
+        """ Compare the basis of the current LSI model, typically trained
+            on a sample of the corpus, with the basis of an LSI model
+            trained (in memory, without saving it) on the entire corpus.
+            The TFIDF or plain corpus must still be present, i.e. the
+            model must have been trained with keep_temp_files=True.
+            See lsi.compare_bases() for the contents of the report. """
+        self._ensure("lsi")
+        assert self._model is not None
+        corpus_tfidf = self._tfidf_corpus()
+        from gensim import models  # type: ignore
+
+        full = models.LsiModel(
             corpus_tfidf,
             id2word=self._dictionary,
             num_topics=self._dimensions,
             **kwargs
         )
-        # Save the generated model
-        self._model = lsi
-        lsi.save(self.lsi_model_filename)
+        report = compare_bases(self._model.projection.u, full.projection.u)
+        report["sample_documents"] = self._model.docs_processed
+        report["corpus_documents"] = full.docs_processed
+        return report
 
     def load_lsi_model(self) -> None:
         """ Load a previously generated LSI model """
+        from gensim import models  # type: ignore
+
         self._model = models.LsiModel.load(self.lsi_model_filename, mmap="r")
+        self._engine = None
+
+    def load_inference_engine(self) -> None:
+        """ Compile the dictionary, TFIDF model and LSI model into
+            a fast inference engine, if their configuration allows """
+        self._ensure("dictionary")
+        self._ensure("tfidf")
+        self._ensure("lsi")
+        if InferenceEngine.supports(self._tfidf, self._model):
+            self._engine = InferenceEngine.from_models(
+                self._dictionary, self._tfidf, self._model
+            )
+        else:
+            self._engine = _UNSUPPORTED_ENGINE  # type: ignore
+
+    def _inference_engine(self) -> Optional[InferenceEngine]:
+        """ Return the inference engine, loading it if necessary, or None
+            if the model configuration is not supported by it. Callers
+            should use the returned engine rather than reading _engine
+            again, since another thread may replace it in the meantime. """
+        self._ensure("engine")
+        engine = self._engine
+        return None if engine is _UNSUPPORTED_ENGINE else engine
+
+    def serving_state(self, *, with_index: bool = True) -> ServingState:
+        """ Return the state needed to serve this model, i.e. the
+            inference engine and (if with_index is True and the model
+            has one) the similarity index, laid out in flat arrays """
+        engine = self._inference_engine()
+        if engine is None:
+            raise ValueError("Unsupported TFIDF or LSI model configuration")
+        index = None
+        if with_index and os.path.exists(self.simindex_filename):
+            self._ensure("similarity")
+            assert isinstance(self._simindex, DenseIndex)
+            index = self._simindex
+        return ServingState.from_engine(engine, index)
+
+    def export_serving_state(self, *, with_index: bool = True) -> ServingState:
+        """ Save the serving state of this model to files that can
+            subsequently be memory-mapped by load_serving_state() """
+        state = self.serving_state(with_index=with_index)
+        state.save(self.serving_state_filename)
+        return state
+
+    def load_serving_state(self, state: ServingState = None) -> ServingState:
+        """ Serve this model from the given serving state or, by default,
+            from a memory-mapped state saved by export_serving_state().
+            Loading the state in a parent process before forking worker
+            processes, or attaching each worker to a state in shared memory
+            via ServingState.attach(), lets all workers share a single
+            physical copy of it. The Gensim dictionary and models are then
+            not needed for topic vectors and nearest neighbor queries. """
+        with self._load_lock:
+            t0 = time.perf_counter()
+            if state is None:
+                state = ServingState.load(self.serving_state_filename)
+            self._engine = state.engine
+            self._serving_state = state
+            if state.index is not None:
+                self._simindex = state.index
+            self._load_timings["serving"] = time.perf_counter() - t0
+        return state
+
+    def export_bundle(self, filename: str = None, *, with_index: bool = True) -> str:
+        """ Pack everything needed to serve this model (the vocabulary,
+            idf weights, LSI projection and, if with_index is True, the
+            similarity index) into a single bundle file, along with
+            metadata. Returns the name of the file, which by default
+            is in the model directory. """
+        from . import __version__
+
+        filename = filename or self.bundle_filename
+        state = self.serving_state(with_index=with_index)
+        index = state.index
+        state.metadata.update(
+            name=self._name,
+            dimensions=state.engine.dimensions,
+            num_terms=state.engine.num_terms,
+            num_documents=0 if index is None else len(index),
+            greynir_topic_version=__version__,
+            created=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        )
+        state.save_bundle(filename)
+        return filename
+
+    def load_bundle(self, filename: str = None, *, verify: bool = False) -> Dict[str, Any]:
+        """ Serve this model from a bundle file created by export_bundle(),
+            which by default is in the model directory. The arrays in the
+            bundle are memory-mapped in place, and the Gensim dictionary
+            and models are not loaded. If verify is True, the checksums
+            in the bundle are verified first. Returns the metadata
+            of the bundle. """
+        state = ServingState.load_bundle(filename or self.bundle_filename, verify=verify)
+        self.load_serving_state(state)
+        return state.metadata
 
     def remove_temp_files(self) -> None:
         """ Remove intermediate model files that are only
             used during training, not during inference
         """
-        os.remove(self.plain_corpus_filename)
-        os.remove(self.tfidf_corpus_filename)
-        # Also remove additional index files created by Gensim
-        os.remove(self.plain_corpus_filename + ".index")
-        os.remove(self.tfidf_corpus_filename + ".index")
+        CsrCorpus.remove(self.plain_corpus_filename)
+        CsrCorpus.remove(self.tfidf_corpus_filename)
+        LemmaStreamCache(self.lemma_cache_filename).remove()
 
 
     def train(
         self, corpus: Corpus, *,
-        dictionary: Dictionary = None,
+        dictionary: "Dictionary" = None,
         keep_temp_files: bool = False,
-        min_count: int = 3, max_ratio: float = 0.5
+        min_count: int = 3, max_ratio: float = 0.5,
+        processes: int = 1,
+        cache_lemmas: bool = True,
+        stream_tfidf: bool = False,
+        max_vocabulary: int = None,
+        hash_buckets: int = None,
+        lsi_sample_size: int = None,
+        report_filename: str = None,
+        resume: bool = False
     ) -> None:
         """ Go through all training steps for a document corpus,
             ending with an LSI model built on TF-IDF vectors
@@ -309,25 +955,454 @@ class Model:
             min_count:
                 Only keep lemmas in the dictionary that occur
                 at least min_count times in the corpus
+            processes:
+                The number of worker processes to use for lemmatizing
+                the corpus documents and for training the LSI model
+                (1 = do everything in this process)
+            cache_lemmas:
+                If True, the lemma stream from the dictionary pass is
+                cached on disk and replayed when creating the plain
+                corpus, instead of lemmatizing the corpus twice
+            stream_tfidf:
+                If True, no TFIDF corpus is stored; instead, the TFIDF
+                transformation is applied on the fly to the plain corpus
+                whenever the TFIDF vectors are needed
+            max_vocabulary:
+                If given, the dictionary is built in bounded memory, tracking
+                at most this many distinct lemmas at a time. Note that the
+                lemma cache keeps its own table of all distinct lemmas, so
+                for a fixed memory ceiling, also set cache_lemmas=False.
+            hash_buckets:
+                If given, no dictionary pass is made. Instead, lemmas are
+                mapped to this many buckets by a stable hash function (the
+                "hashing trick"), and the corpus is read only once. The
+                max_vocabulary and cache_lemmas parameters do not apply
+                in this mode.
+            lsi_sample_size:
+                If given, the LSI basis is fitted on a uniform random sample
+                of this many documents instead of on the entire corpus.
+                Use lsi_quality_report() to check that the sample is large
+                enough.
+            report_filename:
+                If given, the metrics of each training stage (also
+                available in training_report) are written to this
+                JSON file when training completes
+            resume:
+                If True, stages that completed in an earlier run with
+                the same parameters and inputs, and whose output files
+                are unchanged, are skipped (see manifest.py). Changes in
+                the corpus are only detected if Corpus.fingerprint()
+                is implemented; otherwise, the corpus is assumed
+                to be unchanged.
         """
+        with self._training_run(report_filename):
+            self._train(
+                corpus, dictionary=dictionary,
+                min_count=min_count, max_ratio=max_ratio, processes=processes,
+                cache_lemmas=cache_lemmas, stream_tfidf=stream_tfidf,
+                max_vocabulary=max_vocabulary, hash_buckets=hash_buckets,
+                lsi_sample_size=lsi_sample_size, resume=resume,
+            )
+        if not keep_temp_files:
+            self.remove_temp_files()
+
+    def _training_plan(
+        self, corpus: Corpus, *,
+        dictionary: Optional["Dictionary"],
+        min_count: int, max_ratio: float,
+        stream_tfidf: bool,
+        max_vocabulary: Optional[int],
+        hash_buckets: Optional[int],
+        lsi_sample_size: Optional[int],
+        ann_lists: Optional[int]
+    ) -> List[Tuple[str, Dict[str, Any], List[str]]]:
+        """ Return the training stages for the given options, in order,
+            as (name, parameters, input stages) tuples. The similarity
+            index stage is included if ann_lists is not None. """
+        corpus_fingerprint = corpus.fingerprint()
+        plan = []  # type: List[Tuple[str, Dict[str, Any], List[str]]]
+        if hash_buckets:
+            plan.append(
+                (
+                    "hashed_corpus",
+                    dict(
+                        corpus=corpus_fingerprint, hash_buckets=hash_buckets,
+                        min_count=min_count, max_ratio=max_ratio,
+                    ),
+                    [],
+                )
+            )
+            dictionary_params = {}  # type: Dict[str, Any]
+            dictionary_inputs = ["hashed_corpus"]
+        else:
+            if dictionary is None:
+                plan.append(
+                    (
+                        "dictionary",
+                        dict(
+                            corpus=corpus_fingerprint, min_count=min_count,
+                            max_ratio=max_ratio, max_vocabulary=max_vocabulary,
+                        ),
+                        [],
+                    )
+                )
+                dictionary_params = {}
+                dictionary_inputs = ["dictionary"]
+            else:
+                # A given dictionary is not a stage, but its contents
+                # determine the outputs of the subsequent stages
+                dictionary_params = dict(
+                    dictionary=fingerprint(
+                        sorted(dictionary.token2id.items()),
+                        sorted(dictionary.dfs.items()),
+                        dictionary.num_docs,
+                    )
+                )
+                dictionary_inputs = []
+        # The hashed_corpus stage creates the plain corpus as well, but
+        # it is recorded as a separate stage, since it is a temporary
+        # file that can be recreated from the hashed dictionary alone
+        plan.append(
+            (
+                "plain_corpus",
+                dict(dictionary_params, corpus=corpus_fingerprint),
+                dictionary_inputs,
+            )
+        )
+        plan.append(("tfidf_model", dictionary_params, dictionary_inputs))
+        tfidf_inputs = ["plain_corpus", "tfidf_model"]
+        if not stream_tfidf:
+            plan.append(("tfidf_corpus", {}, tfidf_inputs))
+            tfidf_inputs = tfidf_inputs + ["tfidf_corpus"]
+        plan.append(
+            (
+                "lsi",
+                dict(dimensions=self._dimensions, lsi_sample_size=lsi_sample_size),
+                tfidf_inputs,
+            )
+        )
+        if ann_lists is not None:
+            plan.append(
+                ("similarity_index", dict(ann_lists=ann_lists), ["lsi"] + tfidf_inputs)
+            )
+        return plan
+
+    def _train(
+        self, corpus: Corpus, *,
+        dictionary: Optional["Dictionary"],
+        min_count: int, max_ratio: float,
+        processes: int,
+        cache_lemmas: bool,
+        stream_tfidf: bool,
+        max_vocabulary: Optional[int],
+        hash_buckets: Optional[int],
+        lsi_sample_size: Optional[int],
+        resume: bool,
+        ann_lists: int = None
+    ) -> None:
+        """ Run the training stages of train(), and of train_similarity()
+            if ann_lists is given, measuring each of them and recording
+            them in the manifest. If resume is True, skip the stages that
+            are complete and up to date, unless a stage that they
+            depend on needs to be run. """
+        if hash_buckets and dictionary is not None:
+            raise ValueError("A dictionary cannot be used with hash_buckets")
         # Make sure that the models directory exists
         try:
             os.makedirs(self._DIRECTORY)
         except FileExistsError:
             pass
-        if dictionary is None:
-            self.train_dictionary(
-                CorpusIterator(corpus, dictionary=None),
-                min_count=min_count, max_ratio=max_ratio,
+        plan = self._training_plan(
+            corpus, dictionary=dictionary, min_count=min_count, max_ratio=max_ratio,
+            stream_tfidf=stream_tfidf, max_vocabulary=max_vocabulary,
+            hash_buckets=hash_buckets, lsi_sample_size=lsi_sample_size,
+            ann_lists=ann_lists,
+        )
+        fingerprints = {}  # type: Dict[str, str]
+        for name, params, inputs in plan:
+            fingerprints[name] = fingerprint(
+                name, params, [fingerprints[i] for i in inputs]
             )
-        else:
+        manifest = TrainingManifest(self.manifest_filename)
+        # The stored model artifacts must exist after training,
+        # while the corpora are only needed to create them
+        needed = {"tfidf_model", "lsi"}
+        if hash_buckets:
+            needed.add("hashed_corpus")
+        elif dictionary is None:
+            needed.add("dictionary")
+        if ann_lists is not None:
+            needed.add("similarity_index")
+        # Work out which stages to run: those that are needed but not
+        # complete, those whose inputs are needed by a stage that runs,
+        # and those whose inputs change because they run
+        run = set()  # type: Set[str]
+        changed = True
+        while changed:
+            changed = False
+            for name, params, inputs in reversed(plan):
+                if name in run:
+                    continue
+                stale = not (resume and manifest.is_complete(name, fingerprints[name]))
+                if (name in needed and stale) or any(i in run for i in inputs):
+                    run.add(name)
+                    needed.update(inputs)
+                    changed = True
+        # Discard any artifacts held in memory, since the stored ones are
+        # either reused or replaced
+        self._dictionary = self._tfidf = self._model = None
+        self._simindex = self._ann = None
+        self._engine = None
+        if dictionary is not None:
             self._dictionary = dictionary
-        self.train_plain_corpus(CorpusIterator(corpus, dictionary=self._dictionary))
-        self.train_tfidf_model()
-        self.train_tfidf_corpus()
-        self.train_lsi_model()
-        if not keep_temp_files:
-            self.remove_temp_files()
+
+        def stage(name: str) -> Any:
+            """ Return a context manager for running a stage """
+            manifest.start(name)
+            return self._training_stage(name)
+
+        def complete(name: str, outputs: List[str]) -> None:
+            params = next(p for n, p, _ in plan if n == name)
+            manifest.complete(name, fingerprints[name], params, outputs)
+
+        cache = None  # type: Optional[LemmaStreamCache]
+        lemma_lists = None  # type: Optional[CorpusIterator]
+        if "hashed_corpus" in run:
+            assert hash_buckets
+            with stage("hashed_corpus") as st:
+                self.train_hashed_corpus(
+                    corpus, hash_buckets,
+                    min_count=min_count, max_ratio=max_ratio, processes=processes,
+                )
+                outputs = self._saved_files(self.dictionary_filename)
+                plain_outputs = CsrCorpus.filenames(self.plain_corpus_filename)
+                st.record(artifact_bytes=artifact_bytes(outputs + plain_outputs))
+            complete("hashed_corpus", outputs)
+            complete("plain_corpus", plain_outputs)
+            run.discard("plain_corpus")
+        if "dictionary" in run:
+            with stage("dictionary") as st:
+                manifest.start("lemma_cache")
+                lemma_lists = CorpusIterator(corpus, dictionary=None, processes=processes)
+                lemmas = lemma_lists  # type: Iterable[Any]
+                if cache_lemmas:
+                    cache = LemmaStreamCache(self.lemma_cache_filename)
+                    lemmas = cache.record(lemmas)
+                self.train_dictionary(
+                    lemmas, min_count=min_count, max_ratio=max_ratio,
+                    max_vocabulary=max_vocabulary,
+                )
+                outputs = self._saved_files(self.dictionary_filename)
+                st.record(
+                    documents=lemma_lists.num_documents,
+                    empty_documents=lemma_lists.num_empty,
+                    lemmas=lemma_lists.num_lemmas,
+                    artifact_bytes=artifact_bytes(outputs),
+                )
+            complete("dictionary", outputs)
+            if cache is not None:
+                # The lemma cache is valid for the corpus of the dictionary stage
+                manifest.complete(
+                    "lemma_cache", fingerprints["dictionary"], {}, cache.filenames
+                )
+        elif dictionary is None and not hash_buckets and resume and "plain_corpus" in run:
+            # Reuse the lemma cache of an earlier dictionary stage, if intact
+            if manifest.is_complete("lemma_cache", fingerprints["dictionary"]):
+                cache = LemmaStreamCache(self.lemma_cache_filename)
+        if "plain_corpus" in run:
+            self._ensure("dictionary")
+            assert self._dictionary is not None
+            with stage("plain_corpus") as st:
+                if cache is not None:
+                    # Replay the cached lemma stream instead of lemmatizing again
+                    self.train_plain_corpus(cache.bags(self._dictionary.token2id))
+                    manifest.start("lemma_cache")
+                    cache.remove()
+                    if lemma_lists is not None:
+                        # The documents are the same as in the dictionary pass
+                        st.record(
+                            documents=lemma_lists.num_documents,
+                            empty_documents=lemma_lists.num_empty,
+                            lemmas=lemma_lists.num_lemmas,
+                        )
+                    else:
+                        st.record(documents=len(self.load_plain_corpus()))
+                else:
+                    iterator = CorpusIterator(
+                        corpus, dictionary=self._dictionary, processes=processes
+                    )
+                    self.train_plain_corpus(iterator)
+                    st.record(
+                        documents=iterator.num_documents,
+                        empty_documents=iterator.num_empty,
+                        lemmas=iterator.num_lemmas,
+                    )
+                outputs = CsrCorpus.filenames(self.plain_corpus_filename)
+                st.record(artifact_bytes=artifact_bytes(outputs))
+            complete("plain_corpus", outputs)
+        if "tfidf_model" in run:
+            with stage("tfidf_model") as st:
+                self.train_tfidf_model()
+                outputs = self._saved_files(self.tfidf_model_filename)
+                st.record(artifact_bytes=artifact_bytes(outputs))
+            complete("tfidf_model", outputs)
+        if stream_tfidf:
+            # Make sure that a stale TFIDF corpus is not used
+            manifest.start("tfidf_corpus")
+            CsrCorpus.remove(self.tfidf_corpus_filename)
+        elif "tfidf_corpus" in run:
+            with stage("tfidf_corpus") as st:
+                self.train_tfidf_corpus()
+                outputs = CsrCorpus.filenames(self.tfidf_corpus_filename)
+                st.record(
+                    documents=len(self.load_tfidf_corpus()),
+                    artifact_bytes=artifact_bytes(outputs),
+                )
+            complete("tfidf_corpus", outputs)
+        if "lsi" in run:
+            with stage("lsi") as st:
+                self.train_lsi_model(sample_size=lsi_sample_size, processes=processes)
+                assert self._model is not None
+                outputs = self._saved_files(self.lsi_model_filename)
+                st.record(
+                    documents=self._model.docs_processed,
+                    artifact_bytes=artifact_bytes(outputs),
+                )
+            complete("lsi", outputs)
+        if "similarity_index" in run:
+            assert ann_lists is not None
+            with stage("similarity_index") as st:
+                self.calculate_similarity_index(ann_lists=ann_lists, processes=processes)
+                assert self._simindex is not None
+                outputs = [self.simindex_filename]
+                if ann_lists > 0:
+                    outputs.append(self.ann_index_filename)
+                st.record(documents=len(self._simindex), artifact_bytes=artifact_bytes(outputs))
+            complete("similarity_index", outputs)
+
+    def _update_dictionary(
+        self, cache: LemmaStreamCache, new_vocabulary: str, min_count: int
+    ) -> int:
+        """ Update the document frequencies in the dictionary from
+            a cached lemma stream, and possibly add new vocabulary to
+            the end of it. Returns the number of lemmas added. """
+        dic = self._dictionary
+        assert dic is not None
+        token2id = dic.token2id
+        new_dfs = {}  # type: Dict[str, int]
+        new_cfs = {}  # type: Dict[str, int]
+        for lemmas in cache:
+            counts = {}  # type: Dict[str, int]
+            for lemma in lemmas:
+                counts[lemma] = counts.get(lemma, 0) + 1
+            dic.num_docs += 1
+            dic.num_pos += len(lemmas)
+            for lemma, count in counts.items():
+                ix = token2id.get(lemma)
+                if ix is not None:
+                    dic.dfs[ix] = dic.dfs.get(ix, 0) + 1
+                    dic.cfs[ix] = dic.cfs.get(ix, 0) + count
+                    dic.num_nnz += 1
+                elif new_vocabulary == "add":
+                    new_dfs[lemma] = new_dfs.get(lemma, 0) + 1
+                    new_cfs[lemma] = new_cfs.get(lemma, 0) + count
+        added = 0
+        for lemma, df in sorted(new_dfs.items()):
+            # Only add lemmas that occur in at least min_count new documents.
+            # New lemmas are appended, so existing ids remain valid.
+            if df >= min_count:
+                ix = token2id[lemma] = len(token2id)
+                dic.dfs[ix] = df
+                dic.cfs[ix] = new_cfs[lemma]
+                dic.num_nnz += df
+                added += 1
+        # Invalidate the reverse mapping, which Gensim rebuilds on demand
+        dic.id2token = {}
+        dic.save(self.dictionary_filename)
+        return added
+
+    def update(
+        self, corpus: Corpus, *,
+        new_vocabulary: str = "ignore",
+        min_count: int = 3,
+        processes: int = 1,
+        decay: float = None
+    ) -> None:
+        """ Update a trained model with additional documents, without
+            retraining it from scratch. The document frequencies in the
+            dictionary and the TFIDF model are updated, the LSI model is
+            updated with the new documents, and if a similarity index
+            exists, the new documents are appended to it (with indexes
+            following those of the existing documents).
+            corpus:
+                The additional documents
+            new_vocabulary:
+                "ignore" to ignore lemmas that are not already in the
+                dictionary, or "add" to add new lemmas to the dictionary
+            min_count:
+                With new_vocabulary="add", only add new lemmas that
+                occur in at least min_count of the additional documents
+            processes:
+                The number of worker processes to use for lemmatization
+            decay:
+                The weight of existing observations relative to the new
+                ones when updating the LSI model (default: that of the model)
+            Note that the document vectors already in the similarity index
+            are not recalculated, so they gradually drift away from what
+            a full retraining would produce.
+        """
+        if new_vocabulary not in ("ignore", "add"):
+            raise ValueError("new_vocabulary must be 'ignore' or 'add'")
+        self._ensure("dictionary")
+        if hasattr(self._dictionary, "id_range"):
+            raise ValueError("Models trained with hash_buckets cannot be updated")
+        self._ensure("lsi")
+        assert self._dictionary is not None and self._model is not None
+        lsi = self._model
+        # Lemmatize the new documents once, caching the lemma stream
+        cache = LemmaStreamCache(self.lemma_cache_filename)
+        for _ in cache.record(CorpusIterator(corpus, processes=processes)):
+            pass
+        update_filename = self._filename_from_ext("corpus-update")
+        try:
+            added = self._update_dictionary(cache, new_vocabulary, min_count)
+            CsrCorpus.serialize(update_filename, cache.bags(self._dictionary.token2id))
+            cache.remove()
+            # Recalculate the idf weights from the updated dictionary
+            self.train_tfidf_model()
+            if added:
+                # Extend the LSI basis with zero rows for the new lemmas
+                u = lsi.projection.u
+                lsi.projection.u = np.vstack([u, np.zeros((added, u.shape[1]), u.dtype)])
+                lsi.projection.m = lsi.num_terms = len(self._dictionary)
+            lsi.id2word = self._dictionary
+            corpus_tfidf = self.stream_tfidf_corpus_from(
+                CsrCorpus(update_filename, len(self._dictionary))
+            )
+            lsi.add_documents(corpus_tfidf, decay=decay)
+            lsi.save(self.lsi_model_filename)
+            self._engine = None
+            if os.path.exists(self.simindex_filename):
+                with self._index_lock:
+                    self._append_to_similarity_index(lsi[corpus_tfidf])
+        finally:
+            cache.remove()
+            CsrCorpus.remove(update_filename)
+
+    def _append_to_similarity_index(self, topic_vectors: Iterable[TopicVector]) -> None:
+        """ Append document vectors to the similarity index and
+            to the ANN index, if any """
+        self._ensure("similarity")
+        assert isinstance(self._simindex, DenseIndex)
+        start = len(self._simindex)
+        self._simindex = DenseIndex.append(
+            self.simindex_filename, topic_vectors, self._simindex.dimensions
+        )
+        if os.path.exists(self.ann_index_filename):
+            self._ensure("ann")
+            assert self._ann is not None
+            self._ann.add(self._simindex, start)
+            self._ann.save(self.ann_index_filename)
 
     def topic_vector(self, lemmas: List[LemmaString]) -> TopicVector:
         """ Return a sparse topic vector for a list of lemmas,
@@ -335,14 +1410,40 @@ class Model:
             ("lemma", "category") tuples. """
         if not lemmas:
             return []
-        if self._dictionary is None:
-            self.load_dictionary()
+        engine = self._inference_engine()
+        if engine is not None:
+            return engine.topic_vector(lemmas)
+        return self._gensim_topic_vector(lemmas)
+
+    def topic_vectors(
+        self, batch: Sequence[List[LemmaString]], *, chunksize: int = None
+    ) -> np.ndarray:
+        """ Return a dense array of shape (len(batch), dimensions) containing
+            the topic vectors of a batch of lemma lists. If chunksize is given,
+            at most that many documents are processed at a time, to cap
+            peak memory use. """
+        engine = self._inference_engine()
+        if engine is not None:
+            return engine.dense_vectors(batch, chunksize=chunksize)
+        # No inference engine: fall back to one topic vector at a time,
+        # with as many columns as the LSI model has topics, which may be
+        # fewer than the requested dimensions
+        self._ensure("lsi")
+        assert self._model is not None
+        result = np.zeros((len(batch), self._model.projection.u.shape[1]), dtype=np.float32)
+        for i, lemmas in enumerate(batch):
+            for ix, val in self._gensim_topic_vector(lemmas):
+                result[i, ix] = val
+        return result
+
+    def _gensim_topic_vector(self, lemmas: List[LemmaString]) -> TopicVector:
+        """ Return a sparse topic vector for a list of lemmas,
+            calculated via the Gensim dictionary and models """
+        self._ensure("dictionary")
         assert self._dictionary is not None
-        if self._tfidf is None:
-            self.load_tfidf_model()
+        self._ensure("tfidf")
         assert self._tfidf is not None
-        if self._model is None:
-            self.load_lsi_model()
+        self._ensure("lsi")
         assert self._model is not None
         bag = self._dictionary.doc2bow(lemmas)
         if not bag:
@@ -353,64 +1454,232 @@ class Model:
     @staticmethod
     def similarity(topic_vector_a: TopicVector, topic_vector_b: TopicVector) -> float:
         """ Return the cosine similarity of two sparse topic vectors """
+        from gensim import matutils  # type: ignore
+
         return matutils.cossim(topic_vector_a, topic_vector_b)
 
 
-    def calculate_similarity_index(self) -> None:
-        """ Transform corpus to LSI space and index it """
-        corpus_tfidf = self.load_tfidf_corpus()
-        if self._dictionary is None:
-            self.load_dictionary()
-        assert self._dictionary is not None
-        if self._model is None:
-            self.load_lsi_model()
+    def calculate_similarity_index(
+        self, *, ann_lists: int = 0, processes: int = 1
+    ) -> None:
+        """ Transform corpus to LSI space and index it. If ann_lists > 0,
+            also build an approximate nearest neighbor index with
+            that many inverted lists (a common choice is around
+            the square root of the number of documents). If processes > 1,
+            the plain corpus is projected in that many worker processes,
+            provided that it is still present and that the models are
+            supported by the inference engine. """
+        self._ensure("lsi")
         assert self._model is not None
-
-        # Calculate the similarity index
-        simindex = similarities.Similarity(
-            self.simindex_filename,
-            self._model[corpus_tfidf],
-            num_features=len(self._dictionary)
-        )
-
-        # Save the similarity index
-        simindex.save(self.simindex_filename)
-        self._simindex = simindex
+        dimensions = self._model.projection.u.shape[1]
+        engine = None  # type: Optional[InferenceEngine]
+        if processes > 1 and CsrCorpus.exists(self.plain_corpus_filename):
+            engine = self._inference_engine()
+        if engine is not None:
+            # Project the plain corpus a chunk of documents at a time,
+            # in a pool of worker processes
+            self._simindex = DenseIndex.build_dense(
+                self.simindex_filename,
+                project_corpus(self.load_plain_corpus(), engine, processes=processes),
+                dimensions=dimensions,
+            )
+        else:
+            # Calculate and save the similarity index
+            self._simindex = DenseIndex.build(
+                self.simindex_filename,
+                self._model[self._tfidf_corpus()],
+                dimensions=dimensions,
+            )
+        if ann_lists > 0:
+            self.calculate_ann_index(ann_lists)
+
+    def calculate_ann_index(self, num_lists: int, **kwargs) -> None:
+        """ Build an approximate nearest neighbor index
+            on top of the similarity index """
+        self._ensure("similarity")
+        assert isinstance(self._simindex, DenseIndex)
+        ann = IVFIndex.build(self._simindex, num_lists, **kwargs)
+        ann.save(self.ann_index_filename)
+        self._ann = ann
+
+    def load_ann_index(self) -> None:
+        """ Load a previously generated approximate nearest neighbor index """
+        self._ann = IVFIndex.load(self.ann_index_filename)
 
     def load_similarity_index(self) -> None:
         """ Load similarity index to local variable """
-        self._simindex = similarities.Similarity.load(self.simindex_filename)
+        if os.path.exists(self.simindex_filename):
+            self._simindex = DenseIndex.load(self.simindex_filename)
+        else:
+            # Fall back to an index in the old Gensim format, if present
+            from gensim import similarities  # type: ignore
+
+            self._simindex = similarities.Similarity.load(
+                self._filename_from_ext("similarity")
+            )
 
     def train_similarity(
         self, corpus: Corpus, *,
-        dictionary: Dictionary = None,
+        dictionary: "Dictionary" = None,
         keep_temp_files: bool = False,
-        min_count: int = 3, max_ratio: float = 0.5
+        min_count: int = 3, max_ratio: float = 0.5,
+        processes: int = 1,
+        cache_lemmas: bool = True,
+        stream_tfidf: bool = False,
+        max_vocabulary: int = None,
+        hash_buckets: int = None,
+        lsi_sample_size: int = None,
+        ann_lists: int = 0,
+        report_filename: str = None,
+        resume: bool = False
     ) -> None:
         """ Train the model for similarity calculations.
             This is function has the same parameters as the 'self.train' function
             but adds an extra layer that calculates the similarity matrix
-            for similarity comparison.
+            for similarity comparison. If ann_lists > 0, an approximate
+            nearest neighbor index with that many inverted lists is
+            built as well. The corpus is projected into the index
+            using the given number of worker processes.
         """
-        self.train(corpus, dictionary=dictionary, keep_temp_files=True, min_count=min_count, max_ratio=max_ratio)
-        self.calculate_similarity_index()
+        with self._training_run(report_filename):
+            self._train(
+                corpus, dictionary=dictionary,
+                min_count=min_count, max_ratio=max_ratio, processes=processes,
+                cache_lemmas=cache_lemmas, stream_tfidf=stream_tfidf,
+                max_vocabulary=max_vocabulary, hash_buckets=hash_buckets,
+                lsi_sample_size=lsi_sample_size, resume=resume,
+                ann_lists=ann_lists,
+            )
         if not keep_temp_files:
             self.remove_temp_files()
 
-    def nearest_neighbors(self, topic_vector: TopicVector, num_neighbors: int = None, cutoff: float = 0.0) -> List[int]:
+    def nearest_neighbors(
+        self, topic_vector: TopicVector, num_neighbors: int = None,
+        cutoff: float = 0.0, *, with_scores: bool = False, probes: int = None
+    ) -> Union[List[int], List[Tuple[int, float]]]:
         """ Return a list of indexes for the items in corpus that are most similar to given topic vector.
             num_neighbors:
                 Number of returned neighbors. If None then return all neighbors with similarity above cutoff.
             cutoff:
                 A similarity threshold deciding how similar items have to be to be returned.
                 Similarity can be on the range [-1, 1] and default is 0.0
+            with_scores:
+                If True, return a list of (index, similarity) tuples instead of plain indexes
+            probes:
+                If given, use the approximate nearest neighbor index, searching
+                this many of its inverted lists. More probes give better recall
+                at the cost of latency.
         """
-        if self._simindex is None:
-            self.load_similarity_index()
-        assert self._simindex is not None
-
-        # Obtain a list of similarities, with one float for each document in the corpus
-        similarities = self._simindex[topic_vector]
-        # Sort into descending order by similarity, maintaining the document indices
-        neighbors = [ix for ix, s in sorted(enumerate(similarities), key=lambda t: -t[1]) if s >= cutoff]
-        return neighbors[:num_neighbors] if num_neighbors else neighbors
+        self._ensure("similarity")
+        # The index may be replaced by compaction while the query runs,
+        # so the same index must be used throughout
+        index = self._simindex
+        assert index is not None
+
+        if probes is not None:
+            # Approximate search
+            self._ensure("ann")
+            ann = self._ann
+            assert ann is not None
+            assert isinstance(index, DenseIndex)
+            query = index.dense_query(topic_vector)
+            indices, scores = ann.search(index, query, num_neighbors, cutoff, probes=probes)
+        else:
+            # Obtain an array of similarities, with one float for each document in the corpus
+            similarities = index[topic_vector]
+            # Select the best neighbors in descending order by similarity,
+            # leaving out deleted documents
+            deleted = index.deleted if isinstance(index, DenseIndex) else None
+            indices, scores = top_k(similarities, num_neighbors, cutoff, exclude=deleted)
+        if isinstance(index, DenseIndex):
+            # Map index rows to document indexes, which differ after compaction
+            indices = index.ids_of(indices)
+        if with_scores:
+            return list(zip(indices.tolist(), scores.tolist()))
+        return indices.tolist()
+
+    def delete_documents(self, indices: Iterable[int]) -> int:
+        """ Mark documents in the similarity index as deleted, so that they
+            are no longer returned by nearest_neighbors(). The index does not
+            shrink until it is compacted. Returns the number of documents
+            that were deleted. """
+        with self._index_lock:
+            self._ensure("similarity")
+            assert isinstance(self._simindex, DenseIndex)
+            return self._simindex.delete(indices)
+
+    def compact_similarity_index(
+        self, *, threshold: float = 0.0, background: bool = False
+    ) -> Optional[threading.Thread]:
+        """ Rewrite the similarity index without its deleted documents,
+            if they make up more than the threshold fraction of it.
+            Document indexes are not affected by compaction. If background
+            is True, compaction runs in a separate thread, which is
+            returned; the model can be queried, and documents can be
+            deleted or added, while it runs. """
+        if background:
+            thread = threading.Thread(
+                target=self._compact_similarity_index, args=(threshold,), daemon=True
+            )
+            thread.start()
+            return thread
+        self._compact_similarity_index(threshold)
+        return None
+
+    def _compact_similarity_index(self, threshold: float) -> None:
+        """ Compact the similarity index and the ANN index, if any """
+        with self._index_lock:
+            self._ensure("similarity")
+            index = self._simindex
+            assert isinstance(index, DenseIndex)
+            if index.num_deleted == 0 or index.deleted_fraction < threshold:
+                return
+            snapshot = index.deleted.copy()
+            end = len(index)
+        # Write the live rows to a temporary index without holding the lock
+        temp_filename = self._filename_from_ext("similarity-compact.npy")
+        try:
+            mapping = index.compact_into(temp_filename, 0, end)
+            with self._index_lock:
+                current = self._simindex
+                assert isinstance(current, DenseIndex)
+                if len(current) > end:
+                    # Documents were added during compaction
+                    mapping = np.concatenate(
+                        [mapping, current.compact_into(temp_filename, end, append=True)]
+                    )
+                compacted = DenseIndex.load(temp_filename)
+                if current.deleted is not None:
+                    # Documents were deleted during compaction
+                    rows = np.flatnonzero(current.deleted[:end] & ~snapshot)
+                    compacted.delete(current.ids_of(rows).tolist())
+                DenseIndex.replace(temp_filename, self.simindex_filename)
+                if os.path.exists(self.ann_index_filename):
+                    self._ensure("ann")
+                    assert self._ann is not None
+                    self._ann.remap(mapping)
+                    self._ann.save(self.ann_index_filename)
+                self._simindex = DenseIndex.load(self.simindex_filename)
+        finally:
+            DenseIndex.remove(temp_filename)
+
+    def ann_recall_report(
+        self, topic_vectors: Sequence[TopicVector] = None, *,
+        k: int = 10, probes: Sequence[int] = (1, 2, 4, 8, 16),
+        num_queries: int = 100
+    ) -> List[Dict[str, float]]:
+        """ Measure the recall@k of the approximate nearest neighbor index
+            against exact search, for each given number of probes. If no
+            query topic vectors are given, a random sample of documents
+            from the index is used as queries. """
+        self._ensure("similarity")
+        self._ensure("ann")
+        assert isinstance(self._simindex, DenseIndex) and self._ann is not None
+        if topic_vectors is None:
+            rng = np.random.RandomState(0)
+            n = len(self._simindex)
+            rows = rng.choice(n, min(n, num_queries), replace=False)
+            queries = np.asarray(self._simindex.vectors[rows])
+        else:
+            queries = np.array([self._simindex.dense_query(tv) for tv in topic_vectors])
+        return recall_at_k(self._simindex, self._ann, queries, k, probes)
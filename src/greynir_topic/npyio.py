@@ -0,0 +1,127 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Streaming .npy file output
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module implements writing of NumPy .npy files whose length is
+    not known in advance. Rows are appended to the file as they become
+    available, and the array header, which contains the array shape, is
+    rewritten in place when the file is closed. The header is padded to
+    a fixed size so that it can be rewritten without moving any data.
+    Existing .npy files can also be opened for appending.
+
+"""
+
+from typing import Tuple, Any
+
+import numpy as np  # type: ignore
+
+
+# The .npy format magic string, followed by format version 1.0
+_MAGIC = b"\x93NUMPY\x01\x00"
+
+# Total size of the headers that we write, including the magic string.
+# This keeps the array data aligned on a 64-byte boundary and leaves
+# ample room for the shape of any array.
+_HEADER_SIZE = 128
+
+
+def _header(dtype: np.dtype, shape: Tuple[int, ...], size: int) -> bytes:
+    """ Return a .npy version 1.0 header of exactly the given size """
+    d = "{{'descr': {0!r}, 'fortran_order': False, 'shape': {1!r}, }}".format(
+        np.lib.format.dtype_to_descr(dtype), tuple(shape)
+    )
+    # The header consists of the magic string, the header length
+    # as a little-endian 16-bit integer, and the header itself,
+    # padded with spaces and terminated by a newline
+    header_len = size - len(_MAGIC) - 2
+    if len(d) + 1 > header_len:
+        raise ValueError("Array shape does not fit in .npy header")
+    d = d.ljust(header_len - 1) + "\n"
+    return _MAGIC + header_len.to_bytes(2, "little") + d.encode("latin-1")
+
+
+class NpyWriter:
+
+    """ Writes a .npy file incrementally, one block of rows at a time """
+
+    def __init__(
+        self, filename: str, dtype: Any, row_shape: Tuple[int, ...] = (), *,
+        append: bool = False
+    ) -> None:
+        """ Open a .npy file for writing. The file contains an array
+            with the given dtype and shape (rows,) + row_shape. If append
+            is True, the file must exist and contain an array of that
+            dtype and row shape, and new rows are added to the end of it. """
+        self._dtype = np.dtype(dtype)
+        self._row_shape = tuple(row_shape)
+        self._header_size = _HEADER_SIZE
+        self._rows = 0
+        if append:
+            self._f = open(filename, "r+b")
+            if np.lib.format.read_magic(self._f) != (1, 0):
+                self._f.close()
+                raise ValueError("Unsupported .npy version in {0}".format(filename))
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(self._f)
+            if fortran_order or dtype != self._dtype or shape[1:] != self._row_shape:
+                self._f.close()
+                raise ValueError("Incompatible array in {0}".format(filename))
+            self._header_size = self._f.tell()
+            self._rows = shape[0]
+            self._f.seek(0, 2)
+        else:
+            self._f = open(filename, "wb")
+            self._f.write(self._header())
+
+    def _header(self) -> bytes:
+        return _header(self._dtype, (self._rows,) + self._row_shape, self._header_size)
+
+    @property
+    def rows(self) -> int:
+        """ The number of rows written so far """
+        return self._rows
+
+    def write(self, rows: np.ndarray) -> None:
+        """ Append a block of rows to the array """
+        rows = np.ascontiguousarray(rows, dtype=self._dtype)
+        assert rows.shape[1:] == self._row_shape
+        self._f.write(rows.tobytes())
+        self._rows += rows.shape[0]
+
+    def close(self) -> None:
+        """ Finalize the array header and close the file """
+        if self._f.closed:
+            return
+        self._f.seek(0)
+        self._f.write(self._header())
+        self._f.close()
+
+    def __enter__(self) -> "NpyWriter":
+        return self
+
+    def __exit__(self, exc_type: Any, exc_value: Any, traceback: Any) -> None:
+        self.close()
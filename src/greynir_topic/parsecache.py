@@ -0,0 +1,234 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Persistent lemmatization cache
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module implements a persistent, content-addressed cache
+    of sentence lemmatization results, stored in an SQLite database.
+    Each entry maps a hash of a normalized sentence to the list of
+    (lemma, category) tuples that the lemmatizer produced for it.
+    This allows retraining on a mostly unchanged corpus, or recalculating
+    topic vectors for known text, without parsing the same sentences again.
+
+    The cache holds at most max_entries sentences. When it grows beyond
+    that, the least recently used entries are evicted.
+
+"""
+
+from typing import Iterable, List, Tuple, Optional, Dict
+
+import os
+import json
+import hashlib
+import sqlite3
+
+
+# A LemmaTuple contains two strings, the lemma and its category
+LemmaTuple = Tuple[str, str]
+
+
+class ParseCache:
+
+    """ A persistent, size-bounded cache of sentence lemmatizations """
+
+    # Default maximum number of cached sentences
+    _DEFAULT_MAX_ENTRIES = 2000000
+
+    # Evict entries when the cache has grown by this fraction beyond its
+    # maximum size, in order to amortize the cost of eviction
+    _EVICTION_SLACK = 0.05
+
+    # Flush the recency of cache hits to the database when
+    # this many of them are pending
+    _MAX_PENDING_HITS = 4096
+
+    def __init__(
+        self, filename: str, *, max_entries: int = None, salt: str = ""
+    ) -> None:
+        """ Create a cache instance.
+            filename: the path of the SQLite database file.
+            max_entries: the maximum number of cached sentences.
+            salt: an arbitrary string that is included in all hash keys,
+                for instance a lemmatizer version, so that changing
+                it invalidates all existing entries.
+        """
+        self._filename = filename
+        self._max_entries = max_entries or self._DEFAULT_MAX_ENTRIES
+        self._salt = salt.encode("utf-8")
+        self._conn = None  # type: Optional[sqlite3.Connection]
+        # The process id of the connection owner; connections
+        # must not be shared with child processes
+        self._pid = 0
+        self._tick = 0
+        self._size = 0
+        # Recency ticks of cache hits that have not been written to the
+        # database. Writing them on each hit would hold a write lock on
+        # the database until the next commit, blocking other processes.
+        self._pending = {}  # type: Dict[bytes, int]
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self) -> Dict:
+        """ Do not attempt to pickle the database connection """
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pending"] = {}
+        return state
+
+    @property
+    def filename(self) -> str:
+        return self._filename
+
+    @property
+    def max_entries(self) -> int:
+        return self._max_entries
+
+    def _connection(self) -> sqlite3.Connection:
+        """ Return a database connection for this process """
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self._filename, timeout=60.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lemmas "
+                "(key BLOB PRIMARY KEY, value TEXT NOT NULL, used INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS lemmas_used ON lemmas (used)")
+            conn.commit()
+            self._tick = conn.execute(
+                "SELECT COALESCE(MAX(used), 0) FROM lemmas"
+            ).fetchone()[0]
+            self._size = conn.execute("SELECT COUNT(*) FROM lemmas").fetchone()[0]
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def key(self, tokens: Iterable[str]) -> bytes:
+        """ Return the hash key for a sentence, given as
+            a sequence of normalized token strings """
+        h = hashlib.sha1(self._salt)
+        for t in tokens:
+            h.update(t.encode("utf-8"))
+            # Unit separator, which does not occur within tokens
+            h.update(b"\x1f")
+        return h.digest()
+
+    def get(self, key: bytes) -> Optional[List[LemmaTuple]]:
+        """ Return the cached lemmatization for the given key,
+            or None if it is not in the cache """
+        conn = self._connection()
+        row = conn.execute("SELECT value FROM lemmas WHERE key=?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._tick += 1
+        self._pending[key] = self._tick
+        if len(self._pending) >= self._MAX_PENDING_HITS:
+            self._flush()
+        return [(lemma, cat) for lemma, cat in json.loads(row[0])]
+
+    def _flush(self) -> None:
+        """ Write the recency of pending cache hits to the
+            database, in one short committed transaction """
+        if not self._pending:
+            return
+        conn = self._connection()
+        conn.executemany(
+            "UPDATE lemmas SET used=? WHERE key=?",
+            [(tick, key) for key, tick in self._pending.items()],
+        )
+        conn.commit()
+        self._pending = {}
+
+    def put(self, key: bytes, lemmas: List[LemmaTuple]) -> None:
+        """ Store a lemmatization in the cache """
+        conn = self._connection()
+        self._pending.pop(key, None)
+        self._flush()
+        self._tick += 1
+        cursor = conn.execute(
+            "INSERT OR REPLACE INTO lemmas (key, value, used) VALUES (?, ?, ?)",
+            (key, json.dumps(lemmas, ensure_ascii=False), self._tick),
+        )
+        if cursor.rowcount > 0:
+            self._size += 1
+        if self._size > self._max_entries * (1.0 + self._EVICTION_SLACK):
+            self._evict()
+        conn.commit()
+
+    def _evict(self) -> None:
+        """ Evict the least recently used entries from the cache """
+        conn = self._connection()
+        # Other processes may have added entries as well
+        self._size = conn.execute("SELECT COUNT(*) FROM lemmas").fetchone()[0]
+        excess = self._size - self._max_entries
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM lemmas WHERE key IN "
+                "(SELECT key FROM lemmas ORDER BY used LIMIT ?)",
+                (excess,),
+            )
+            self._size -= excess
+
+    def __len__(self) -> int:
+        return self._connection().execute("SELECT COUNT(*) FROM lemmas").fetchone()[0]
+
+    @property
+    def hit_ratio(self) -> float:
+        """ Return the fraction of lookups that were cache hits """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        """ Return a dictionary of cache statistics """
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hit_ratio,
+            entries=len(self),
+            max_entries=self._max_entries,
+        )
+
+    def clear(self) -> None:
+        """ Remove all entries from the cache """
+        conn = self._connection()
+        conn.execute("DELETE FROM lemmas")
+        conn.commit()
+        self._pending = {}
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def close(self) -> None:
+        """ Commit pending changes and close the database connection """
+        if self._conn is not None and self._pid == os.getpid():
+            self._flush()
+            self._conn.commit()
+            self._conn.close()
+        self._conn = None
+        self._pending = {}
@@ -0,0 +1,449 @@
+"""
+    Greynir: Natural language processing for Icelandic
+
+    Shared model serving state
+
+    Copyright (C) 2020 Miðeind ehf.
+    Original author: Vilhjálmur Þorsteinsson
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+    This module lays out everything that is needed to serve a trained
+    model, i.e. to calculate topic vectors and find nearest neighbors,
+    in a handful of flat, read-only NumPy arrays:
+
+    * the vocabulary, as an ArrayVocabulary (see below), or just
+      the number of hash buckets, for a hashed vocabulary
+    * the idf weight of each vocabulary entry
+    * the projection matrix of the InferenceEngine
+    * the vectors of the similarity index, with their document ids
+      and tombstones, if the model has a similarity index
+
+    Unlike Python objects such as the dict in a Gensim dictionary, whose
+    pages are copied as soon as a forked process touches their reference
+    counts, flat arrays can be shared by any number of worker processes.
+    A ServingState can be saved to .npy files, which are memory-mapped
+    when loaded (so that all processes on a host share one copy in the
+    operating system's page cache), or to a single bundle file (see
+    bundle.py), or placed in a block of shared memory that other
+    processes attach to by name.
+
+"""
+
+from typing import Iterator, Mapping, Dict, Set, Optional, Any
+
+import os
+import sys
+import json
+import zlib
+
+import numpy as np  # type: ignore
+
+from .inference import InferenceEngine
+from .index import DenseIndex
+from .bundle import write_bundle, read_bundle
+from .hashing import HashVocabulary
+
+
+# Sections within shared memory blocks start on
+# 64-byte boundaries, i.e. at the start of a cache line
+_ALIGNMENT = 64
+
+# Marks an empty slot in an ArrayVocabulary hash table
+_EMPTY = -1
+
+# Names of the shared memory blocks created by share() in this process
+_created_blocks = set()  # type: Set[str]
+
+
+def _align(offset: int) -> int:
+    """ Round an offset up to the next alignment boundary """
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+def _hash(key: bytes) -> int:
+    """ A hash function that, unlike hash(), is stable
+        across processes and Python versions """
+    return zlib.crc32(key)
+
+
+class ArrayVocabulary(Mapping[str, int]):
+
+    """ A read-only mapping from lemma strings to vocabulary indices,
+        stored in three flat arrays instead of a Python dict:
+
+        * blob: the UTF-8 encoded lemmas, concatenated in index order (uint8)
+        * offsets: the start of each lemma within the blob,
+          followed by the length of the blob (int64)
+        * table: an open addressing hash table, with linear probing,
+          containing the vocabulary index of each lemma (int32)
+
+        The mapping can be used as the token2id of an InferenceEngine. """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, table: np.ndarray) -> None:
+        assert len(table) & (len(table) - 1) == 0, "Table size must be a power of 2"
+        self._blob = blob
+        self._bytes = memoryview(blob).cast("B") if len(blob) else memoryview(b"")
+        self._offsets = offsets
+        self._table = table
+        self._mask = len(table) - 1
+
+    @classmethod
+    def from_token2id(cls, token2id: Mapping[str, int]) -> "ArrayVocabulary":
+        """ Create a vocabulary from a mapping, such as the token2id
+            of a Gensim dictionary, whose indices run from 0 to len-1 """
+        n = len(token2id)
+        tokens = [b""] * n
+        for token, ix in token2id.items():
+            tokens[ix] = token.encode("utf-8")
+        lengths = np.fromiter((len(t) for t in tokens), dtype=np.int64, count=n)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        blob = np.frombuffer(b"".join(tokens), dtype=np.uint8).copy()
+        # Keep the load factor of the hash table at or below 50%
+        size = 8
+        while size < 2 * n:
+            size *= 2
+        table = np.full(size, _EMPTY, dtype=np.int32)
+        mask = size - 1
+        for ix, token in enumerate(tokens):
+            slot = _hash(token) & mask
+            while table[slot] != _EMPTY:
+                slot = (slot + 1) & mask
+            table[slot] = ix
+        return cls(blob, offsets, table)
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """ The arrays making up the vocabulary """
+        return dict(blob=self._blob, offsets=self._offsets, table=self._table)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def token(self, ix: int) -> str:
+        """ Return the lemma string with the given index """
+        a, b = int(self._offsets[ix]), int(self._offsets[ix + 1])
+        return bytes(self._bytes[a:b]).decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        """ Yield the lemma strings in index order """
+        for ix in range(len(self)):
+            yield self.token(ix)
+
+    def get(self, token: Any, default: Any = None) -> Any:
+        """ Return the index of a lemma string, or the default
+            value if it is not in the vocabulary """
+        if not isinstance(token, str):
+            return default
+        key = token.encode("utf-8")
+        table = self._table
+        offsets = self._offsets
+        slot = _hash(key) & self._mask
+        while True:
+            ix = int(table[slot])
+            if ix == _EMPTY:
+                return default
+            if self._bytes[int(offsets[ix]) : int(offsets[ix + 1])] == key:
+                return ix
+            slot = (slot + 1) & self._mask
+
+    def __getitem__(self, token: str) -> int:
+        ix = self.get(token)
+        if ix is None:
+            raise KeyError(token)
+        return ix
+
+    def __contains__(self, token: Any) -> bool:
+        return self.get(token) is not None
+
+
+class ServingState:
+
+    """ The read-only state needed to serve a model, laid out in flat
+        arrays that can be memory-mapped or placed in shared memory """
+
+    # The arrays that must be present in every serving state
+    _REQUIRED = ("idfs", "projection")
+
+    # The arrays of a vocabulary, of which there are two kinds: an
+    # ArrayVocabulary, or a HashVocabulary for a model trained with
+    # hash buckets, which is described by the number of buckets alone
+    _VOCABULARY = ("vocab_blob", "vocab_offsets", "vocab_table")
+    _HASH_VOCABULARY = ("hash_buckets",)
+
+    def __init__(
+        self, arrays: Dict[str, np.ndarray], *,
+        shm: Any = None, metadata: Dict[str, Any] = None
+    ) -> None:
+        """ Create a serving state from a dict of named arrays. If the
+            arrays are views of a block of shared memory, shm is the
+            SharedMemory object, which is kept open as long as the
+            state is in use. Any metadata is stored along with the
+            arrays in bundle files. """
+        required = self._REQUIRED + (
+            self._HASH_VOCABULARY if "hash_buckets" in arrays else self._VOCABULARY
+        )
+        missing = [name for name in required if name not in arrays]
+        if missing:
+            raise ValueError("Missing serving state arrays: {0}".format(missing))
+        self._arrays = arrays
+        self._shm = shm
+        self._metadata = dict(metadata or {})
+        self._vocabulary = (
+            HashVocabulary(int(arrays["hash_buckets"][0]))
+            if "hash_buckets" in arrays
+            else ArrayVocabulary(
+                arrays["vocab_blob"], arrays["vocab_offsets"], arrays["vocab_table"]
+            )
+        )  # type: Any
+        self._engine = InferenceEngine(
+            self._vocabulary, arrays["idfs"], arrays["projection"]
+        )
+        self._index = None  # type: Optional[DenseIndex]
+        if "index_vectors" in arrays:
+            deleted = arrays.get("index_deleted")
+            self._index = DenseIndex(
+                arrays["index_vectors"],
+                arrays.get("index_ids"),
+                None if deleted is None else deleted.astype(bool),
+            )
+
+    @classmethod
+    def from_engine(
+        cls, engine: InferenceEngine, index: Optional[DenseIndex] = None
+    ) -> "ServingState":
+        """ Create a serving state from an inference engine and,
+            optionally, a similarity index """
+        vocabulary = engine.token2id
+        if isinstance(vocabulary, HashVocabulary):
+            arrays = {
+                "hash_buckets": np.array([vocabulary.num_buckets], dtype=np.int64)
+            }
+        else:
+            if not isinstance(vocabulary, ArrayVocabulary):
+                vocabulary = ArrayVocabulary.from_token2id(vocabulary)
+            arrays = {
+                "vocab_" + name: array for name, array in vocabulary.arrays.items()
+            }
+        arrays["idfs"] = np.asarray(engine.idfs, dtype=np.float64)
+        arrays["projection"] = np.asarray(engine.projection)
+        if index is not None:
+            arrays["index_vectors"] = np.asarray(index.vectors)
+            rows = np.arange(len(index))
+            arrays["index_ids"] = np.append(index.ids_of(rows), index.next_id).astype(
+                np.int64
+            )
+            if index.deleted is not None:
+                arrays["index_deleted"] = index.deleted.astype(np.uint8)
+        return cls(arrays)
+
+    @property
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return dict(self._arrays)
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self._metadata
+
+    @property
+    def vocabulary(self) -> Any:
+        """ The ArrayVocabulary or HashVocabulary of the model """
+        return self._vocabulary
+
+    @property
+    def engine(self) -> InferenceEngine:
+        return self._engine
+
+    @property
+    def index(self) -> Optional[DenseIndex]:
+        return self._index
+
+    @property
+    def nbytes(self) -> int:
+        """ The total size of the arrays, in bytes """
+        return sum(a.nbytes for a in self._arrays.values())
+
+    @staticmethod
+    def filename(base_filename: str, name: str) -> str:
+        """ Return the name of the file containing one of the arrays """
+        return "{0}.{1}.npy".format(base_filename, name)
+
+    @staticmethod
+    def _manifest_filename(base_filename: str) -> str:
+        return base_filename + ".json"
+
+    @staticmethod
+    def exists(base_filename: str) -> bool:
+        """ Return True if a serving state has been saved
+            with the given base file name """
+        return os.path.exists(ServingState._manifest_filename(base_filename))
+
+    @staticmethod
+    def remove(base_filename: str) -> None:
+        """ Remove the files of a saved serving state, if they exist """
+        manifest = ServingState._manifest_filename(base_filename)
+        if not os.path.exists(manifest):
+            return
+        with open(manifest, "r", encoding="utf-8") as f:
+            names = json.load(f)["arrays"]
+        for name in names:
+            fname = ServingState.filename(base_filename, name)
+            if os.path.exists(fname):
+                os.remove(fname)
+        os.remove(manifest)
+
+    def save(self, base_filename: str) -> None:
+        """ Save the arrays to .npy files, along with a JSON manifest
+            listing them. The manifest is written last, so an
+            interrupted save is never mistaken for a complete one. """
+        self.remove(base_filename)
+        for name, array in self._arrays.items():
+            np.save(self.filename(base_filename, name), array)
+        with open(self._manifest_filename(base_filename), "w", encoding="utf-8") as f:
+            json.dump({"arrays": sorted(self._arrays)}, f)
+
+    @classmethod
+    def load(cls, base_filename: str) -> "ServingState":
+        """ Load a saved serving state, memory-mapping its arrays """
+        with open(cls._manifest_filename(base_filename), "r", encoding="utf-8") as f:
+            names = json.load(f)["arrays"]
+        arrays = {}
+        for name in names:
+            fname = cls.filename(base_filename, name)
+            try:
+                arrays[name] = np.load(fname, mmap_mode="r")
+            except ValueError:
+                # An empty array cannot be memory-mapped
+                arrays[name] = np.load(fname)
+        return cls(arrays)
+
+    def save_bundle(self, filename: str) -> None:
+        """ Save the arrays and metadata to a single bundle file """
+        write_bundle(filename, self._arrays, self._metadata)
+
+    @classmethod
+    def load_bundle(cls, filename: str, *, verify: bool = False) -> "ServingState":
+        """ Load a serving state from a bundle file, memory-mapping its
+            arrays in place. If verify is True, the checksums of the
+            arrays are verified, which requires reading the whole file. """
+        arrays, metadata = read_bundle(filename, verify=verify)
+        return cls(arrays, metadata=metadata)
+
+    @property
+    def name(self) -> Optional[str]:
+        """ The name of the shared memory block holding
+            the arrays, or None if they are not shared """
+        return None if self._shm is None else self._shm.name
+
+    def share(self, name: str = None) -> "ServingState":
+        """ Copy the arrays into a new block of shared memory, returning
+            a serving state that uses the shared copy. Other processes
+            can attach to the block by calling ServingState.attach() with
+            its name. The block remains in existence until unlink() is
+            called. Requires Python 3.8 or later. """
+        from multiprocessing import shared_memory
+
+        # The block starts with the length of a JSON header, as a 64-bit
+        # little-endian integer, followed by the header itself. The arrays
+        # follow on aligned offsets, relative to the end of the header.
+        table = {}  # type: Dict[str, Dict[str, Any]]
+        size = 0
+        for array_name in sorted(self._arrays):
+            a = self._arrays[array_name]
+            table[array_name] = dict(dtype=a.dtype.str, shape=list(a.shape), offset=size)
+            size = _align(size + a.nbytes)
+        header = json.dumps({"arrays": table}).encode("utf-8")
+        start = _align(8 + len(header))
+        shm = shared_memory.SharedMemory(name=name, create=True, size=start + size)
+        _created_blocks.add(shm.name)
+        shm.buf[:8] = len(header).to_bytes(8, "little")
+        shm.buf[8 : 8 + len(header)] = header
+        for array_name, info in table.items():
+            a = self._arrays[array_name]
+            view = np.ndarray(
+                a.shape, dtype=a.dtype, buffer=shm.buf, offset=start + info["offset"]
+            )
+            view[...] = a
+            del view
+        return self._attach(shm)
+
+    @classmethod
+    def attach(cls, name: str) -> "ServingState":
+        """ Attach to a serving state in shared memory, created
+            by share() in this or another process. Only the creator
+            of the block destroys it; attaching processes may exit
+            without affecting it. """
+        from multiprocessing import shared_memory
+
+        if sys.version_info >= (3, 13):
+            return cls._attach(shared_memory.SharedMemory(name=name, track=False))
+        shm = shared_memory.SharedMemory(name=name)
+        if getattr(shared_memory, "_USE_POSIX", False) and shm.name not in _created_blocks:
+            # Attaching registers the block with the resource tracker of
+            # this process, which would destroy it when the process exits
+            from multiprocessing import resource_tracker
+
+            resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+        return cls._attach(shm)
+
+    @classmethod
+    def _attach(cls, shm: Any) -> "ServingState":
+        """ Create a serving state from read-only views
+            of the arrays in a block of shared memory """
+        header_len = int.from_bytes(bytes(shm.buf[:8]), "little")
+        header = json.loads(bytes(shm.buf[8 : 8 + header_len]).decode("utf-8"))
+        start = _align(8 + header_len)
+        arrays = {}
+        for array_name, info in header["arrays"].items():
+            view = np.ndarray(
+                tuple(info["shape"]),
+                dtype=np.dtype(info["dtype"]),
+                buffer=shm.buf,
+                offset=start + info["offset"],
+            )
+            view.flags.writeable = False
+            arrays[array_name] = view
+        return cls(arrays, shm=shm)
+
+    def close(self) -> None:
+        """ Detach from the shared memory block, if any. The
+            state cannot be used afterwards. """
+        if self._shm is None:
+            return
+        # All views of the shared memory must be released before closing it
+        self._arrays = {}
+        self._vocabulary = None  # type: ignore
+        self._engine = None  # type: ignore
+        self._index = None
+        shm, self._shm = self._shm, None
+        shm.close()
+
+    def unlink(self) -> None:
+        """ Close and destroy the shared memory block, if any. This should
+            be called once, by the process that created the block, when
+            no process needs it any more. """
+        shm = self._shm
+        self.close()
+        if shm is not None:
+            _created_blocks.discard(shm.name)
+            shm.unlink()
@@ -35,6 +35,7 @@
 from typing import Iterable, Union, Optional
 
 from .tuplemodel import TupleDocument, LemmaTuple
+from .parsecache import ParseCache
 
 from reynir import Greynir, tokenize, paragraphs, Tok, TOK
 
@@ -89,16 +90,45 @@ class ParsedDocument(TokenDocument):
 
     """ This subclass of TokenDocument uses the Greynir parser to
         lemmatize sentences, falling back to the TokenDocument lemmatizer
-        for sentences that can't be parsed. """
+        for sentences that can't be parsed. If a ParseCache has been
+        set via ParsedDocument.set_cache(), lemmatization results are
+        looked up in it before parsing and stored in it afterwards. """
 
     _g = None  # type: Optional[Greynir]
+    _cache = None  # type: Optional[ParseCache]
 
     def __init__(self, text_or_gen: StringIterable) -> None:
         super().__init__(text_or_gen)
 
+    @classmethod
+    def set_cache(cls, cache: Optional[ParseCache]) -> None:
+        """ Set (or with None, remove) the lemmatization cache
+            used by all instances of this class """
+        cls._cache = cache
+
+    @classmethod
+    def cache(cls) -> Optional[ParseCache]:
+        """ Return the lemmatization cache, if any """
+        return cls._cache
+
     def lemmatize(self, sent: Iterable[Tok]) -> Iterable[LemmaTuple]:
         """ Lemmatize a sentence (list of tokens), returning
             an iterable of (lemma, category) tuples """
+        cache = self._cache
+        if cache is None:
+            yield from self.parse_lemmatize(sent)
+            return
+        sent = list(sent)
+        # The cache key is based on the kinds and texts of the tokens
+        key = cache.key("{0}:{1}".format(t.kind, t.txt) for t in sent)
+        lemmas = cache.get(key)
+        if lemmas is None:
+            lemmas = list(self.parse_lemmatize(sent))
+            cache.put(key, lemmas)
+        yield from lemmas
+
+    def parse_lemmatize(self, sent: Iterable[Tok]) -> Iterable[LemmaTuple]:
+        """ Lemmatize a sentence by parsing it """
         if self._g is None:
             # Initialize parser singleton
             self.__class__._g = Greynir()
@@ -33,22 +33,72 @@
 
 """
 
-from typing import Iterator, Iterable, Tuple, List, Union, cast
+from typing import (
+    Iterator, Iterable, Sequence, Tuple, List, Mapping, Union, Optional, Any,
+    cast,
+)
 
 from abc import abstractmethod
+from functools import lru_cache
+
+import numpy as np  # type: ignore
 
 from .model import Model, Document, TopicVector, LemmaString
+from .inference import InferenceEngine
 
 
 # A LemmaTuple contains two strings, the lemma and its category
 LemmaTuple = Tuple[str, str]
 
+# Number of normalized (lemma, cat) tuples to remember,
+# both in TupleDocument and in each TupleVocabulary
+_MEMO_SIZE = 1 << 16
+
 
 def w_from_lemma(lemma: str, cat: str) -> LemmaString:
     """ Convert a (lemma, cat) tuple to a bag-of-words key """
     return lemma.lower().replace("-", "").replace(" ", "_") + "/" + cat
 
 
+# A memoized w_from_lemma, for streams in which the same tuples recur
+_memo_w_from_lemma = lru_cache(maxsize=_MEMO_SIZE)(w_from_lemma)
+
+
+class TupleVocabulary:
+
+    """ Maps (lemma, category) tuples directly to vocabulary indices,
+        without building a "lemma/category" string for each of them
+        more than once. Each tuple is normalized via w_from_lemma() and
+        looked up in the vocabulary, and the result is memoized for the
+        memo_size most recently used tuples. Nothing is precomputed from
+        the vocabulary, which may be large and shared between processes
+        (an ArrayVocabulary), or have no table of tokens at all (a
+        HashVocabulary). """
+
+    def __init__(self, token2id: Mapping[str, int], *, memo_size: int = _MEMO_SIZE) -> None:
+        self._token2id = token2id
+        self._lookup = lru_cache(maxsize=memo_size)(self._normalized_get)
+
+    @property
+    def token2id(self) -> Mapping[str, int]:
+        return self._token2id
+
+    def _normalized_get(self, lemma: str, cat: str) -> Optional[int]:
+        return self._token2id.get(w_from_lemma(lemma, cat))
+
+    def get(self, lemma_tuple: Any, default: Any = None) -> Any:
+        """ Return the vocabulary index of a (lemma, category) tuple,
+            or the default value if it is not in the vocabulary """
+        ix = self._lookup(*lemma_tuple)
+        return default if ix is None else ix
+
+    def __contains__(self, lemma_tuple: Any) -> bool:
+        return self.get(lemma_tuple) is not None
+
+    def __len__(self) -> int:
+        return len(self._token2id)
+
+
 class TupleDocument(Document):
 
     """ A TupleDocument is an abstract Document class that produces its stream
@@ -75,13 +125,36 @@ class TupleDocument(Document):
             # Do not include tuples that have no lemma or no category
             # (the latter case includes punctuation and other non-text tokens)
             if lemma and cat and self.filter_tuple(lemma, cat):
-                yield w_from_lemma(lemma, cat)
+                yield _memo_w_from_lemma(lemma, cat)
 
 
 class TupleModel(Model):
 
     """ Wraps the topic vector modeling functionality """
 
+    def __init__(self, name: str, **kwargs: Any) -> None:
+        super().__init__(name, **kwargs)
+        self._tuple_vocabulary = None  # type: Optional[TupleVocabulary]
+
+    def tuple_vocabulary(self) -> Optional[TupleVocabulary]:
+        """ Return a TupleVocabulary for the inference engine of the
+            model, or None if the model has no inference engine """
+        engine = self._inference_engine()
+        if engine is None:
+            return None
+        return self._tuple_vocabulary_of(engine)
+
+    def _tuple_vocabulary_of(self, engine: InferenceEngine) -> TupleVocabulary:
+        """ Return a TupleVocabulary for the given inference engine """
+        vocab = self._tuple_vocabulary
+        if vocab is None or vocab.token2id is not engine.token2id:
+            with self._load_lock:
+                vocab = self._tuple_vocabulary
+                if vocab is None or vocab.token2id is not engine.token2id:
+                    vocab = TupleVocabulary(engine.token2id)
+                    self._tuple_vocabulary = vocab
+        return vocab
+
     def topic_vector(
         self, lemmas: Union[List[LemmaTuple], List[LemmaString]]
     ) -> TopicVector:
@@ -92,7 +165,43 @@ class TupleModel(Model):
             return []
         if isinstance(lemmas[0], tuple):
             lemmas = cast(List[LemmaTuple], lemmas)
+            engine = self._inference_engine()
+            if engine is not None:
+                # Map the tuples directly to vocabulary indices
+                vocab = self._tuple_vocabulary_of(engine)
+                return engine.sparse(
+                    engine.dense_vector_from_bag(*engine.bag(lemmas, get=vocab.get))
+                )
             lemmas = [w_from_lemma(lemma, cat) for lemma, cat in lemmas]
         else:
             assert all("/" in lemma for lemma in lemmas)  # Must contain a slash
         return super().topic_vector(cast(List[LemmaString], lemmas))
+
+    def topic_vectors(
+        self,
+        batch: Sequence[Union[List[LemmaTuple], List[LemmaString]]],
+        *,
+        chunksize: int = None
+    ) -> np.ndarray:
+        """ Return a dense array of topic vectors for a batch of lemma lists,
+            each of which can contain either "lemma/category" strings or
+            ("lemma", "category") tuples. """
+        engine = self._inference_engine()
+        if engine is not None:
+            vocab = self._tuple_vocabulary_of(engine)
+            get = vocab.get
+            if not all(not lemmas or isinstance(lemmas[0], tuple) for lemmas in batch):
+                # A mixture of tuple lists and string lists
+                string_get = engine.token2id.get
+                tuple_get = vocab.get
+                get = lambda w: string_get(w) if isinstance(w, str) else tuple_get(w)
+            return engine.dense_vectors(batch, chunksize=chunksize, get=get)
+        return super().topic_vectors(
+            [
+                [w_from_lemma(lemma, cat) for lemma, cat in lemmas]
+                if lemmas and isinstance(lemmas[0], tuple)
+                else lemmas
+                for lemmas in batch
+            ],
+            chunksize=chunksize,
+        )
@@ -0,0 +1,99 @@
+"""
+
+    test_index.py
+
+    Tests for the GreynirTopic similarity index module
+
+    Copyright (C) 2020 by Miðeind ehf.
+
+    This software is licensed under the MIT License:
+
+        Permission is hereby granted, free of charge, to any person
+        obtaining a copy of this software and associated documentation
+        files (the "Software"), to deal in the Software without restriction,
+        including without limitation the rights to use, copy, modify, merge,
+        publish, distribute, sublicense, and/or sell copies of the Software,
+        and to permit persons to whom the Software is furnished to do so,
+        subject to the following conditions:
+
+        The above copyright notice and this permission notice shall be
+        included in all copies or substantial portions of the Software.
+
+        THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+        EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+        MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+        IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+        CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+        TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+        SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+    This module tests the dense and approximate similarity indexes.
+
+"""
+
+import numpy as np
+import pytest
+
+from greynir_topic.index import DenseIndex, IVFIndex, recall_at_k
+
+
+@pytest.fixture(scope="module")
+def dense_index(tmp_path_factory):
+    """ Provide a DenseIndex over clustered random vectors """
+    rng = np.random.RandomState(42)
+    centers = rng.normal(size=(20, 16))
+    vectors = centers[rng.randint(20, size=2000)] + 0.3 * rng.normal(size=(2000, 16))
+    filename = str(tmp_path_factory.mktemp("index") / "test.similarity.npy")
+    topic_vectors = ([(i, float(v)) for i, v in enumerate(row)] for row in vectors)
+    yield DenseIndex.build(filename, topic_vectors, dimensions=16)
+
+
+def test_ivf_index(dense_index, tmp_path):
+    ann = IVFIndex.build(dense_index, 20)
+    assert len(ann) == len(dense_index)
+    filename = str(tmp_path / "test.ann.npz")
+    ann.save(filename)
+    ann = IVFIndex.load(filename)
+    q = dense_index.vectors[17]
+    # Probing all lists is equivalent to exact search
+    indices, scores = ann.search(dense_index, q, 10, -1.0, probes=20)
+    exact = np.argsort(-dense_index.similarities(q), kind="stable")[:10]
+    assert indices.tolist() == exact.tolist()
+    assert indices[0] == 17 and scores[0] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_recall_at_k(dense_index):
+    ann = IVFIndex.build(dense_index, 20)
+    report = recall_at_k(
+        dense_index, ann, np.asarray(dense_index.vectors[:50]), 10, (1, 4, 20)
+    )
+    recalls = [r["recall"] for r in report]
+    assert recalls == sorted(recalls)
+    assert recalls[-1] == 1.0
+    assert recalls[0] > 0.5
+
+
+def test_delete(dense_index):
+    index = DenseIndex(np.asarray(dense_index.vectors[:10]))
+    # Duplicates, unknown ids and deleted documents are not counted
+    assert index.delete([3, 3, 5, 99]) == 2
+    assert index.delete([3, 7, 7]) == 1
+    assert index.num_deleted == 3
+
+
+def test_ivf_save_interrupted(dense_index, tmp_path, monkeypatch):
+    filename = str(tmp_path / "test.ann.npz")
+    ann = IVFIndex.build(dense_index, 4)
+    ann.save(filename)
+
+    def fail(f, **arrays):
+        f.write(b"partial")
+        raise OSError("disk full")
+
+    monkeypatch.setattr(np, "savez", fail)
+    with pytest.raises(OSError):
+        IVFIndex.build(dense_index, 8).save(filename)
+    monkeypatch.undo()
+    # The previous version of the index is intact
+    assert IVFIndex.load(filename).num_lists == 4
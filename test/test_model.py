@@ -43,6 +43,10 @@ from greynir_topic import (
     Dictionary,
 )
 from greynir_topic.model import CorpusIterator
+from greynir_topic.tuplemodel import TupleModel
+from greynir_topic.lemmacache import LemmaStreamCache
+from greynir_topic.parsecache import ParseCache
+from greynir_topic.index import top_k, DenseIndex
 from greynir_topic.tuplemodel import w_from_lemma
 
 
@@ -98,6 +102,219 @@ def test_dictionary():
     assert d.num_docs == 4
 
 
+def test_dictionary_builder():
+    import numpy as np
+    from greynir_topic.dictbuilder import DictionaryBuilder, compare_dictionaries
+
+    # A corpus with a Zipfian vocabulary of lemmas
+    rng = np.random.RandomState(0)
+    docs = [
+        ["w{0}/kk".format(w) for w in rng.zipf(1.3, size=50) if w < 100000]
+        for _ in range(500)
+    ]
+    exact = Dictionary(docs)
+    exact.filter_extremes(no_below=3, no_above=0.5, keep_n=None)
+
+    # Without pruning, the result is identical
+    builder = DictionaryBuilder(100000)
+    builder.add_documents(docs)
+    assert builder.report()["exact"]
+    d = builder.dictionary(min_count=3, max_ratio=0.5)
+    assert {w: d.dfs[ix] for w, ix in d.token2id.items()} == {
+        w: exact.dfs[ix] for w, ix in exact.token2id.items()
+    }
+    assert d.num_docs == exact.num_docs and d.num_pos == exact.num_pos
+
+    # With pruning, memory is bounded and the frequent lemmas survive
+    builder = DictionaryBuilder(200)
+    builder.add_documents(docs)
+    report = builder.report()
+    # The limit can be exceeded by the new lemmas of a single document
+    assert report["prunes"] > 0 and report["peak_tracked"] <= 200 + 50
+    d = builder.dictionary(min_count=3, max_ratio=0.5)
+    comparison = compare_dictionaries(d, exact)
+    assert comparison["common"] >= 0.9 * min(comparison["exact"], 160)
+    assert comparison["mean_df_error"] < 0.1
+
+    # A lemma that is pruned and readmitted keeps its earlier occurrences
+    builder = DictionaryBuilder(4)
+    builder.add_documents([["a/kk"] * 3] * 2)
+    builder.add_documents([["y0/kk", "y1/kk", "y2/kk"]] * 5)
+    builder.add_document(["z/kk"])
+    assert "a/kk" not in builder._tracked
+    builder.add_document(["a/kk"])
+    assert builder.report()["readmitted"] == 1
+    # (The estimates can only err on the high side)
+    assert builder._tracked["a/kk"] == [3, 7]
+
+
+def test_parallel_corpus_iterator():
+    corpus = DummyCorpus()
+    serial = list(CorpusIterator(corpus))
+    parallel = list(CorpusIterator(corpus, processes=2, chunksize=1))
+    assert parallel == serial
+    d = Dictionary(CorpusIterator(corpus))
+    serial = list(CorpusIterator(corpus, dictionary=d))
+    parallel = list(CorpusIterator(corpus, dictionary=d, processes=2))
+    assert parallel == serial
+
+
+def test_lemma_counts():
+    import pickle
+    from greynir_topic.model import LemmaCounts
+
+    lemmas = ["maður/kk", "búð/kvk", "maður/kk", "vera/so", "maður/kk", "ekki/ao"]
+    counts = LemmaCounts(iter(lemmas))
+    assert len(counts) == len(lemmas)
+    assert counts.counts == {"maður/kk": 3, "búð/kvk": 1, "vera/so": 1, "ekki/ao": 1}
+    assert sorted(counts) == sorted(lemmas)
+    assert not LemmaCounts([])
+    d = Dictionary([lemmas[:4]])
+    assert counts.bag(d.token2id) == d.doc2bow(lemmas)
+    assert d.doc2bow(counts) == d.doc2bow(lemmas)
+    assert pickle.loads(pickle.dumps(counts)) == counts
+
+
+def test_lemma_stream_cache(tmp_path):
+    corpus = DummyCorpus()
+    cache = LemmaStreamCache(str(tmp_path / "test.lemmas"))
+    d = Dictionary(cache.record(CorpusIterator(corpus)))
+    assert [sorted(lemmas) for lemmas in cache] == [
+        sorted(lemmas) for lemmas in CorpusIterator(corpus)
+    ]
+    assert list(cache.bags(d.token2id)) == list(CorpusIterator(corpus, dictionary=d))
+    # A fresh cache instance can replay the stream from disk
+    replay = LemmaStreamCache(str(tmp_path / "test.lemmas"))
+    assert list(replay) == list(cache)
+    cache.remove()
+    assert not any((tmp_path / f).exists() for f in cache.filenames)
+    # Lemmas can contain line breaks and other special characters
+    docs = [["a\nb/x", "c\r/x", "\u2028/x"], [], ["c\r/x", "d\r\n/x", "e/x"]]
+    list(cache.record(docs))
+    assert list(LemmaStreamCache(str(tmp_path / "test.lemmas"))) == docs
+
+
+def test_csr_corpora(tmp_path):
+    m = Model("csr", directory=str(tmp_path))
+    m.train(DummyCorpus(), min_count=0, keep_temp_files=True)
+    plain = m.load_plain_corpus()
+    expected = list(CorpusIterator(DummyCorpus(), dictionary=m._dictionary))
+    assert len(plain) == len(expected) == 4
+    assert list(plain) == expected
+    tfidf = m.load_tfidf_corpus()
+    assert len(tfidf) == 4
+    for doc, ref in zip(tfidf, m._tfidf[expected]):
+        assert dict(doc).keys() == dict(ref).keys()
+        for ix, val in ref:
+            assert dict(doc)[ix] == pytest.approx(val, rel=1e-6)
+    assert plain.matrix(1, 3).shape == (2, len(m._dictionary))
+    m.remove_temp_files()
+    assert not any(f.name.endswith(".npy") for f in tmp_path.iterdir())
+
+
+def test_stream_tfidf(tmp_path):
+    stored = Model("stored", directory=str(tmp_path))
+    stored.train_similarity(DummyCorpus(), min_count=0)
+    streamed = Model("streamed", directory=str(tmp_path))
+    streamed.train_similarity(
+        DummyCorpus(), min_count=0, stream_tfidf=True, keep_temp_files=True
+    )
+    assert not (tmp_path / "streamed.corpus-tfidf.data.npy").exists()
+    plain = streamed.load_plain_corpus()
+    for doc, ref in zip(streamed.stream_tfidf_corpus(), streamed._tfidf[plain]):
+        assert [ix for ix, _ in doc] == [ix for ix, _ in ref]
+        assert [val for _, val in doc] == pytest.approx([val for _, val in ref])
+    # The LSI bases may differ in the signs of their vectors,
+    # but the similarities between documents are the same
+    s = ["maður/kk", "búð/kvk"]
+    n1 = dict(stored.nearest_neighbors(stored.topic_vector(s), cutoff=-1.0, with_scores=True))
+    n2 = dict(streamed.nearest_neighbors(streamed.topic_vector(s), cutoff=-1.0, with_scores=True))
+    assert n1.keys() == n2.keys()
+    for ix, sim in n1.items():
+        assert n2[ix] == pytest.approx(sim, abs=1e-5)
+
+
+class UpdateCorpus(Corpus):
+    def __iter__(self):
+        yield DummyDocument("köttur/kk elta/so mús/kvk í/fs búð/kvk".split())
+        yield DummyDocument("köttur/kk veiða/so mús/kvk".split())
+
+
+def test_update(tmp_path):
+    m = Model("update", directory=str(tmp_path))
+    m.train_similarity(DummyCorpus(), min_count=0, max_ratio=1.0, ann_lists=2)
+    num_terms = len(m._dictionary)
+    df = m._dictionary.dfs[m._dictionary.token2id["búð/kvk"]]
+    # Ignore new vocabulary
+    m.update(UpdateCorpus())
+    assert len(m._dictionary) == num_terms
+    assert m._dictionary.num_docs == 6
+    assert m._dictionary.dfs[m._dictionary.token2id["búð/kvk"]] == df + 1
+    assert len(m._simindex) == 6 and len(m._ann) == 6
+    # Add new vocabulary that occurs in at least two documents
+    m.update(UpdateCorpus(), new_vocabulary="add", min_count=2)
+    assert "köttur/kk" in m._dictionary and "mús/kvk" in m._dictionary
+    assert "veiða/so" not in m._dictionary
+    assert len(m._dictionary) == num_terms + 2
+    assert m._model.projection.u.shape[0] == num_terms + 2
+    # The updated model and index can be reloaded from disk
+    m2 = Model("update", directory=str(tmp_path))
+    tv = m2.topic_vector(["köttur/kk", "mús/kvk"])
+    assert tv
+    neighbors = m2.nearest_neighbors(tv, 2)
+    assert set(neighbors) <= {4, 5, 6, 7}
+    assert m2.nearest_neighbors(tv, 2, probes=2) == neighbors
+
+
+def test_delete_and_compact(tmp_path):
+    import numpy as np
+
+    m = Model("delete", directory=str(tmp_path))
+    m.train_similarity(DummyCorpus(), min_count=0, max_ratio=1.0, ann_lists=2)
+    tv = m.topic_vector(["búð/kvk", "vera/so", "lokaður/lo"])
+    before = m.nearest_neighbors(tv, cutoff=-1.0)
+    assert before[0] == 1
+    assert m.delete_documents([1, 17]) == 1
+    assert m.delete_documents([1]) == 0
+    expected = [ix for ix in before if ix != 1]
+    assert m.nearest_neighbors(tv, cutoff=-1.0) == expected
+    assert m.nearest_neighbors(tv, cutoff=-1.0, probes=2) == expected
+    # Deleted documents are excluded whatever the cutoff
+    assert m.nearest_neighbors(tv, cutoff=float("-inf")) == expected
+    assert m.nearest_neighbors(tv, cutoff=float("-inf"), probes=2) == expected
+    # Deletions persist
+    assert Model("delete", directory=str(tmp_path)).nearest_neighbors(
+        tv, cutoff=-1.0
+    ) == expected
+    # Nothing happens below the threshold
+    m.compact_similarity_index(threshold=0.5)
+    assert len(m._simindex) == 4
+    m.compact_similarity_index(threshold=0.2)
+    assert len(m._simindex) == 3 and m._simindex.num_deleted == 0
+    assert m.nearest_neighbors(tv, cutoff=-1.0) == expected
+    assert m.nearest_neighbors(tv, cutoff=-1.0, probes=2) == expected
+    # A query uses the same index throughout, even if compaction
+    # replaces it in the meantime
+    current = m._simindex
+
+    class ReplacedIndex(DenseIndex):
+        def __getitem__(self, topic_vector):
+            m._simindex = DenseIndex(np.asarray(current.vectors))
+            return super().__getitem__(topic_vector)
+
+    m._simindex = ReplacedIndex(current.vectors, current._ids, current.deleted)
+    assert m.nearest_neighbors(tv, cutoff=-1.0) == expected
+    m._simindex = current
+    # Document indexes continue from the highest one after an update
+    m.update(UpdateCorpus())
+    assert m._simindex.ids_of([3, 4]).tolist() == [4, 5]
+    m.delete_documents([0, 4])
+    thread = m.compact_similarity_index(background=True)
+    thread.join()
+    m2 = Model("delete", directory=str(tmp_path))
+    assert sorted(m2.nearest_neighbors(tv, cutoff=-1.0)) == [2, 3, 5]
+
+
 def test_init(model: Model):
     assert model._dimensions == Model._DEFAULT_DIMENSIONS
 
@@ -129,6 +346,105 @@ def test_load(trained_model: Model):
     assert trained_model.similarity(tv2, tv3) > 0.9999
 
 
+def test_inference_engine(trained_model: Model):
+    """ The inference engine must give the same results as Gensim """
+    trained_model.load_inference_engine()
+    assert trained_model._engine is not None
+    for s in (
+        ["maður/kk", "hundur/kk"],
+        ["maður/kk", "búð/kvk", "búð/kvk", "vera/so"],
+        ["hægur/lo", "kaupa/so", "matur/kk", "lokaður/lo"],
+        ["hundur/kk"],
+    ):
+        tv = dict(trained_model.topic_vector(s))
+        ref = dict(trained_model._gensim_topic_vector(s))
+        assert tv.keys() == ref.keys()
+        for k, v in ref.items():
+            assert tv[k] == pytest.approx(v, rel=1e-5, abs=1e-6)
+
+
+def test_unsupported_engine(trained_model: Model, monkeypatch):
+    """ An unsupported model configuration is only detected once,
+        after which the Gensim models are used """
+    from greynir_topic.inference import InferenceEngine
+
+    calls = []
+
+    def supports(cls, tfidf, lsi):
+        calls.append((tfidf, lsi))
+        return False
+
+    monkeypatch.setattr(InferenceEngine, "supports", classmethod(supports))
+    m = Model("test")
+    s = ["maður/kk", "búð/kvk"]
+    tv = dict(m.topic_vector(s))
+    assert tv == pytest.approx(dict(trained_model._gensim_topic_vector(s)))
+    assert dict(m.topic_vector(s)) == tv
+    # The fallback has the same width as the inference engine's result
+    width = trained_model.topic_vectors([s]).shape[1]
+    assert m.topic_vectors([s]).shape == (1, width)
+    assert len(calls) == 1
+    with pytest.raises(ValueError):
+        m.serving_state()
+
+
+def test_topic_vectors(trained_model: Model):
+    batch = [
+        ["maður/kk", "hundur/kk"],
+        [],
+        ["maður/kk", "búð/kvk", "búð/kvk", "vera/so"],
+        ["hundur/kk"],
+        ["hægur/lo", "kaupa/so", "matur/kk", "lokaður/lo"],
+    ]
+    m = trained_model.topic_vectors(batch)
+    # The LSI model may have fewer topics than requested, for a small corpus
+    assert m.shape[0] == len(batch) and m.shape[1] <= trained_model.dimensions
+    for row, lemmas in zip(m, batch):
+        expected = [0.0] * m.shape[1]
+        for ix, val in trained_model.topic_vector(lemmas):
+            expected[ix] = val
+        assert row.tolist() == pytest.approx(expected, rel=1e-5, abs=1e-6)
+    assert (trained_model.topic_vectors(batch, chunksize=2) == m).all()
+    tm = TupleModel("test")
+    tuples = [[tuple(w.split("/")) for w in lemmas] for lemmas in batch]
+    assert tm.topic_vectors(tuples) == pytest.approx(m, rel=1e-5, abs=1e-6)
+
+
+def test_tuple_vocabulary(trained_model: Model):
+    from greynir_topic.tuplemodel import TupleVocabulary
+
+    vocab = TupleVocabulary({"maður/kk": 0, "að_minnsta_kosti/ao": 1, "búð/kvk": 2})
+    assert vocab.get(("maður", "kk")) == 0
+    assert vocab.get(("Maður", "kk")) == 0
+    assert vocab.get(("að minnsta kosti", "ao")) == 1
+    assert ("búð", "kvk") in vocab and ("búð", "kk") not in vocab
+    assert vocab.get(("hestur", "kk"), -1) == -1
+    # Tuples are always normalized, so a token that is not in normalized
+    # form cannot be matched, just as with a "lemma/category" string
+    vocab = TupleVocabulary({"Reykjavík/entity": 0, "reykjavík/entity": 1})
+    assert vocab.get(("Reykjavík", "entity")) == vocab.get(("reykjavík", "entity")) == 1
+
+    class Unlisted(dict):
+        def items(self):
+            raise AssertionError("The vocabulary must not be enumerated")
+
+        def __iter__(self):
+            raise AssertionError("The vocabulary must not be enumerated")
+
+    vocab = TupleVocabulary(Unlisted({"maður/kk": 0}))
+    assert vocab.get(("Maður", "kk")) == 0
+
+    tm = TupleModel("test")
+    strings = ["maður/kk", "búð/kvk", "búð/kvk", "hundur/kk", "óþekkt/hk"]
+    tuples = [("Maður", "kk"), ("búð", "kvk"), ("Búð", "kvk"), ("hundur", "kk"), ("óþekkt", "hk")]
+    tv = dict(trained_model.topic_vector(strings))
+    assert dict(tm.topic_vector(tuples)) == pytest.approx(tv)
+    assert tm.tuple_vocabulary() is tm.tuple_vocabulary()
+    m = tm.topic_vectors([tuples, strings, []])
+    assert m[0].tolist() == pytest.approx(m[1].tolist())
+    assert not m[2].any()
+
+
 def test_token_document():
     td = TokenDocument(
         "Maðurinn fór út í búð með hundinn Xochitl og grátkeypti sér "
@@ -178,6 +494,59 @@ def test_parsed_document():
     assert "xochitl/entity" in w
 
 
+def test_parse_cache(tmp_path):
+    text = "Maðurinn fór út í búð. Hundurinn beit köttinn. Kötturinn hljóp."
+    cache = ParseCache(str(tmp_path / "test.parsecache"))
+    ParsedDocument.set_cache(cache)
+    try:
+        w = list(ParsedDocument(text))
+        assert cache.misses == 3 and cache.hits == 0
+        assert list(ParsedDocument(text)) == w
+        assert cache.misses == 3 and cache.hits == 3
+        assert len(cache) == 3
+    finally:
+        ParsedDocument.set_cache(None)
+        cache.close()
+    # The cache persists between instances, and evicts
+    # the least recently used entries when it is full
+    cache = ParseCache(str(tmp_path / "test.parsecache"), max_entries=1)
+    ParsedDocument.set_cache(cache)
+    try:
+        assert list(ParsedDocument(text)) == w
+        assert cache.hits == 3
+        list(ParsedDocument("Konan las bókina."))
+        assert len(cache) == 1
+    finally:
+        ParsedDocument.set_cache(None)
+        cache.close()
+
+
+def test_parse_cache_shared(tmp_path):
+    import sqlite3
+
+    filename = str(tmp_path / "shared.parsecache")
+    a = ParseCache(filename, max_entries=2)
+    b = ParseCache(filename, max_entries=2)
+    try:
+        k1, k2, k3 = (a.key([w]) for w in ("einn", "tveir", "þrír"))
+        a.put(k1, [("einn", "to")])
+        a.put(k2, [("tveir", "to")])
+        assert b.get(k1) == [("einn", "to")]
+        # A cache hit does not keep the database locked for writing
+        conn = sqlite3.connect(filename, timeout=0.1)
+        conn.execute("BEGIN IMMEDIATE")
+        conn.rollback()
+        conn.close()
+        # The recency of the hit is recorded with the next insertion,
+        # so the entry that was not used is evicted
+        b.put(k3, [("þrír", "to")])
+        assert a.get(k2) is None
+        assert a.get(k1) is not None and a.get(k3) is not None
+    finally:
+        a.close()
+        b.close()
+
+
 class TokenCorpus(Corpus):
     def __iter__(self):
         yield TokenDocument("Maður fór út í búð.")
@@ -200,6 +569,266 @@ def test_train_token(model: Model):
     assert model.similarity(tv2, tv3) > 0.9999
 
 
+def test_train_max_vocabulary(tmp_path):
+    m = Model("bounded", directory=str(tmp_path))
+    m.train(TokenCorpus(), min_count=0, max_ratio=1.0, max_vocabulary=1000)
+    report = m.dictionary_report
+    assert report is not None and report["exact"]
+    assert report["tracked"] == len(m._dictionary)
+
+
+def test_hashed_model(tmp_path):
+    import zlib
+    from gensim.corpora import HashDictionary
+    from greynir_topic.hashing import HashVocabulary, bucket_of, hashing_report
+    from greynir_topic.serving import ServingState
+
+    vocab = HashVocabulary(64)
+    ref = HashDictionary(id_range=64, myhash=zlib.crc32, debug=False)
+    for lemma in ("maður/kk", "búð/kvk", "kaupa/so"):
+        assert vocab[lemma] == bucket_of(lemma, 64) == ref.restricted_hash(lemma)
+    assert vocab.get(("maður", "kk")) is None
+
+    m = Model("hashed", directory=str(tmp_path))
+    m.train_similarity(TokenCorpus(), min_count=0, hash_buckets=1024)
+    assert len(m._dictionary) == 1024 and m._dictionary.num_docs == 4
+    lemmas = ["maður/kk", "búð/kvk", "kaupa/so", "matur/kk"]
+    tv = m.topic_vector(lemmas)
+    assert isinstance(m._engine.token2id, HashVocabulary)
+    assert dict(tv) == pytest.approx(dict(m._gensim_topic_vector(lemmas)), abs=1e-5)
+    neighbors = m.nearest_neighbors(tv)
+    # Tuples are hashed via their "lemma/category" form
+    tm = TupleModel("hashed", directory=str(tmp_path))
+    tuples = [("maður", "kk"), ("Búð", "kvk"), ("kaupa", "so"), ("matur", "kk")]
+    assert dict(tm.topic_vector(tuples)) == pytest.approx(dict(tv), abs=1e-5)
+    assert tm.topic_vectors([tuples, lemmas])[0] == pytest.approx(
+        tm.topic_vectors([lemmas])[0], abs=1e-5
+    )
+    # Without collisions, the result is the same as with a dictionary
+    exact = Model("exact", directory=str(tmp_path))
+    exact.train_similarity(TokenCorpus(), min_count=0)
+    # (A small cutoff excludes orthogonal documents, whose scores are
+    # rounding noise that may fall on either side of zero)
+    assert dict(m.nearest_neighbors(tv, cutoff=1e-3, with_scores=True)) == pytest.approx(
+        dict(
+            exact.nearest_neighbors(
+                exact.topic_vector(lemmas), cutoff=1e-3, with_scores=True
+            )
+        ),
+        abs=1e-5,
+    )
+
+    # A hashed model can be served without any vocabulary arrays
+    served = Model("hashed", directory=str(tmp_path))
+    served.load_serving_state(ServingState.load_bundle(m.export_bundle()))
+    assert dict(served.topic_vector(lemmas)) == pytest.approx(dict(tv))
+    assert served.nearest_neighbors(tv) == neighbors
+    with pytest.raises(ValueError):
+        m.update(TokenCorpus())
+
+    docs = [list(doc) for doc in DummyCorpus()]
+    report = hashing_report(docs, 4, num_pairs=10)
+    assert report["num_lemmas"] == len({w for doc in docs for w in doc})
+    assert 0.0 < report["collision_rate"] <= 1.0
+    assert hashing_report(docs, 1 << 20)["mean_similarity_error"] == 0.0
+
+
+def test_lsi_sample(tmp_path):
+    import numpy as np
+    from greynir_topic.lsi import reservoir_sample, project_corpus, compare_bases
+
+    assert reservoir_sample(range(5), 10) == [0, 1, 2, 3, 4]
+    sample = reservoir_sample(range(1000), 10, seed=1)
+    assert len(sample) == 10 and sample == sorted(sample)
+    assert sample == reservoir_sample(range(1000), 10, seed=1)
+    u = np.linalg.qr(np.random.RandomState(0).randn(20, 4))[0]
+    report = compare_bases(u[:, ::-1] * -1.0, u)
+    assert report["subspaces"][-1]["dimensions"] == 4
+    assert report["subspaces"][-1]["min_cosine"] == pytest.approx(1.0)
+
+    m = Model("sampled", directory=str(tmp_path))
+    m.train_similarity(TokenCorpus(), min_count=0, keep_temp_files=True, lsi_sample_size=3)
+    assert m._model.docs_processed == 3
+    report = m.lsi_quality_report()
+    assert report["sample_documents"] == 3 and report["corpus_documents"] == 4
+    assert 0.0 < report["subspaces"][-1]["mean_cosine"] <= 1.0 + 1e-6
+
+    # Parallel projection gives the same vectors as serial projection
+    m.warm_up(similarity=False)
+    corpus = m.load_plain_corpus()
+    serial = np.vstack(list(project_corpus(corpus, m._engine, chunksize=1)))
+    parallel = np.vstack(
+        list(project_corpus(corpus, m._engine, processes=2, chunksize=1))
+    )
+    assert np.allclose(serial, parallel)
+    m.calculate_similarity_index(processes=2)
+    assert np.allclose(np.asarray(m._simindex.vectors), DenseIndex.normalize(serial))
+
+
+def test_lsi_chunked(tmp_path):
+    import numpy as np
+    from gensim import models
+    from greynir_topic.lsi import train_chunked
+
+    m = Model("chunked", directory=str(tmp_path))
+    m.train(TokenCorpus(), min_count=0, keep_temp_files=True)
+    corpus = m.load_tfidf_corpus()
+    serial = models.LsiModel(
+        corpus, id2word=m._dictionary, num_topics=m.dimensions,
+        chunksize=2, random_seed=0,
+    )
+    lsi = models.LsiModel(
+        id2word=m._dictionary, num_topics=m.dimensions, chunksize=2, random_seed=0
+    )
+    train_chunked(corpus, lsi, processes=2)
+    assert lsi.docs_processed == serial.docs_processed == 4
+    assert np.allclose(lsi.projection.s, serial.projection.s)
+    assert np.allclose(np.abs(lsi.projection.u), np.abs(serial.projection.u))
+
+    # A model trained in parallel is saved and loaded as usual
+    m.train_lsi_model(processes=2, chunksize=2)
+    loaded = Model("chunked", directory=str(tmp_path))
+    loaded.load_lsi_model()
+    assert loaded._model.docs_processed == 4
+    assert np.allclose(loaded._model.projection.s, m._model.projection.s)
+
+
+def test_training_report(tmp_path):
+    import json
+    from greynir_topic import TrainingObserver
+
+    class EmptyCorpus(Corpus):
+        def __iter__(self):
+            yield from DummyCorpus()
+            yield DummyDocument([])
+
+    for processes in (1, 2):
+        ci = CorpusIterator(EmptyCorpus(), processes=processes)
+        assert len(list(ci)) == 4
+        assert (ci.num_documents, ci.num_empty, ci.num_lemmas) == (5, 1, 18)
+
+    class Observer(TrainingObserver):
+        def __init__(self):
+            self.events = []
+
+        def stage_started(self, stage):
+            self.events.append(("started", stage))
+
+        def stage_finished(self, stage, metrics):
+            self.events.append(("finished", stage))
+
+    observer = Observer()
+    m = Model("report", directory=str(tmp_path))
+    m.add_observer(observer)
+    filename = str(tmp_path / "report.json")
+    m.train_similarity(EmptyCorpus(), min_count=2, report_filename=filename)
+    stages = [
+        "dictionary", "plain_corpus", "tfidf_model",
+        "tfidf_corpus", "lsi", "similarity_index",
+    ]
+    assert observer.events == [
+        (event, stage) for stage in stages for event in ("started", "finished")
+    ]
+    report = m.training_report
+    assert [s["stage"] for s in report.stages] == stages
+    dictionary = report.stage("dictionary")
+    assert dictionary["documents"] == 5 and dictionary["empty_documents"] == 1
+    assert dictionary["lemmas"] == 18
+    assert dictionary["vocabulary_before"] == 12
+    assert dictionary["vocabulary_after"] == len(m._dictionary) < 12
+    assert dictionary["artifact_bytes"] > 0
+    assert report.stage("similarity_index")["documents"] == 4
+    for metrics in report.stages:
+        assert metrics["wall_seconds"] >= 0.0 and metrics["cpu_seconds"] >= 0.0
+    with open(filename, encoding="utf-8") as f:
+        saved = json.load(f)
+    assert [s["stage"] for s in saved["stages"]] == stages
+    assert saved["wall_seconds"] == pytest.approx(report.as_dict()["wall_seconds"])
+
+    # Observers are not notified after being removed
+    m.remove_observer(observer)
+    m.train(DummyCorpus(), min_count=0, hash_buckets=64)
+    assert len(observer.events) == 2 * len(stages)
+    assert [s["stage"] for s in m.training_report.stages] == [
+        "hashed_corpus", "tfidf_model", "tfidf_corpus", "lsi",
+    ]
+
+
+def test_resume_training(tmp_path, monkeypatch):
+    import os
+    import json
+
+    class VersionedCorpus(DummyCorpus):
+        version = "1"
+
+        def fingerprint(self):
+            return self.version
+
+    def stages(m):
+        return [s["stage"] for s in m.training_report.stages]
+
+    corpus = VersionedCorpus()
+    m = Model("resume", directory=str(tmp_path), dimensions=3)
+    m.train_similarity(corpus, min_count=0, keep_temp_files=True, resume=True)
+    neighbors = m.nearest_neighbors(m.topic_vector(["búð/kvk"]), with_scores=True)
+    with open(m.manifest_filename, encoding="utf-8") as f:
+        manifest = json.load(f)
+    assert set(manifest["stages"]) == {
+        "dictionary", "plain_corpus", "tfidf_model",
+        "tfidf_corpus", "lsi", "similarity_index",
+    }
+    assert manifest["stages"]["dictionary"]["params"]["min_count"] == 0
+
+    # Nothing is repeated when everything is up to date
+    m = Model("resume", directory=str(tmp_path), dimensions=3)
+    m.train_similarity(corpus, min_count=0, keep_temp_files=True, resume=True)
+    assert stages(m) == []
+    assert m.nearest_neighbors(m.topic_vector(["búð/kvk"]), with_scores=True) == neighbors
+
+    # A failed stage is repeated, along with the stages that depend on it
+    def fail(self, **kwargs):
+        raise RuntimeError("LSI failed")
+
+    m = Model("resume", directory=str(tmp_path), dimensions=2)
+    with monkeypatch.context() as mp:
+        mp.setattr(Model, "train_lsi_model", fail)
+        with pytest.raises(RuntimeError):
+            m.train_similarity(corpus, min_count=0, keep_temp_files=True, resume=True)
+    assert stages(m) == []
+    m.train_similarity(corpus, min_count=0, keep_temp_files=True, resume=True)
+    assert stages(m) == ["lsi", "similarity_index"]
+    assert m._model.projection.u.shape[1] <= 2
+
+    # Missing intermediate files are recreated if a later stage needs them
+    m.remove_temp_files()
+    m = Model("resume", directory=str(tmp_path), dimensions=3)
+    m.train_similarity(corpus, min_count=0, keep_temp_files=True, resume=True)
+    assert stages(m) == ["plain_corpus", "tfidf_corpus", "lsi", "similarity_index"]
+
+    # Changed parameters or corpus contents invalidate the stages they affect
+    m.train_similarity(corpus, min_count=0, keep_temp_files=True, ann_lists=2, resume=True)
+    assert stages(m) == ["similarity_index"]
+    corpus.version = "2"
+    m.train(corpus, min_count=0, resume=True)
+    assert stages(m) == ["dictionary", "plain_corpus", "tfidf_model", "tfidf_corpus", "lsi"]
+
+    # Without resume, every stage is run
+    m.train(corpus, min_count=0)
+    assert stages(m) == ["dictionary", "plain_corpus", "tfidf_model", "tfidf_corpus", "lsi"]
+
+    # A finished hashed run is not repeated after its temporary files are removed
+    h = Model("resume_hashed", directory=str(tmp_path), dimensions=3)
+    h.train(corpus, min_count=0, hash_buckets=64, resume=True)
+    assert stages(h) == ["hashed_corpus", "tfidf_model", "tfidf_corpus", "lsi"]
+    assert not os.path.exists(h.plain_corpus_filename + ".indptr.npy")
+    h.train(corpus, min_count=0, hash_buckets=64, resume=True)
+    assert stages(h) == []
+    # The plain corpus is recreated from the hashed dictionary if needed
+    h = Model("resume_hashed", directory=str(tmp_path), dimensions=2)
+    h.train(corpus, min_count=0, hash_buckets=64, resume=True)
+    assert stages(h) == ["plain_corpus", "tfidf_corpus", "lsi"]
+
+
 def test_similarity_index(model: Model):
     corpus = TokenCorpus()
     model.train_similarity(corpus, min_count=0)
@@ -208,3 +837,224 @@ def test_similarity_index(model: Model):
     similarity = model.nearest_neighbors(topic_vector=tv)
     assert type(similarity) == list
     assert similarity[0] == 0
+
+
+def test_ann_similarity_index(model: Model):
+    import os
+
+    corpus = TokenCorpus()
+    model.train_similarity(corpus, min_count=0, ann_lists=2)
+    assert os.path.exists(model.ann_index_filename)
+    s = TokenDocument("Maðurinn fór út í búð að kaupa mat")
+    tv = model.topic_vector(s)
+    similarity = model.nearest_neighbors(topic_vector=tv)
+    assert similarity[0] == 0
+    # Probing every inverted list gives the same result as exact search
+    assert model.nearest_neighbors(topic_vector=tv, probes=2) == similarity
+
+
+def test_top_k():
+    sims = [0.5, -0.2, 0.9, 0.5, 0.1, 0.5]
+    ix, scores = top_k(sims)
+    assert ix.tolist() == [2, 0, 3, 5, 4]
+    assert scores.tolist() == [0.9, 0.5, 0.5, 0.5, 0.1]
+    # Ties are resolved by ascending index
+    assert top_k(sims, 2)[0].tolist() == [2, 0]
+    assert top_k(sims, 3, cutoff=0.6)[0].tolist() == [2]
+    assert top_k(sims, 10, cutoff=-1.0)[0].tolist() == [2, 0, 3, 5, 4, 1]
+
+
+def test_nearest_neighbors_with_scores(model: Model):
+    tv = model.topic_vector(["maður/kk", "búð/kvk", "kaupa/so", "matur/kk"])
+    neighbors = model.nearest_neighbors(tv, with_scores=True)
+    assert [ix for ix, _ in neighbors] == model.nearest_neighbors(tv)
+    assert all(a[1] >= b[1] for a, b in zip(neighbors, neighbors[1:]))
+    assert model.nearest_neighbors(tv, 2) == model.nearest_neighbors(tv)[:2]
+    # Probing all inverted lists of the approximate index gives exact results
+    assert model.nearest_neighbors(tv, probes=2) == model.nearest_neighbors(tv)
+    report = model.ann_recall_report(k=2, probes=(1, 2))
+    assert report[-1]["recall"] == 1.0
+
+
+def test_dense_index(model: Model):
+    import numpy as np
+
+    index = DenseIndex.load(model.simindex_filename)
+    # The index file is memory-mapped
+    assert isinstance(index.vectors, np.memmap)
+    assert index.vectors.dtype == np.float32
+    assert len(index) == 4
+    tv = model.topic_vector(["maður/kk", "búð/kvk"])
+    sims = index[tv]
+    for i, row in enumerate(index.vectors):
+        doc = [(ix, float(val)) for ix, val in enumerate(row)]
+        assert sims[i] == pytest.approx(model.similarity(tv, doc), abs=1e-5)
+
+
+def test_warm_up(model: Model):
+    import threading
+
+    fresh = Model("test")
+    timings = fresh.warm_up(prefetch=True)
+    assert {"dictionary", "tfidf", "lsi", "engine", "similarity", "ann"} <= set(timings)
+    assert all(t >= 0.0 for t in timings.values())
+    # A second warm-up has nothing left to load
+    assert fresh.warm_up() == {k: v for k, v in timings.items() if k != "prefetch"}
+
+    # Lazy loading from many threads at once loads each artifact only once
+    fresh = Model("test")
+    loads = []
+    load_dictionary = fresh.load_dictionary
+
+    def counting_load_dictionary():
+        loads.append(1)
+        load_dictionary()
+
+    fresh.load_dictionary = counting_load_dictionary  # type: ignore
+    tv = model.topic_vector(["maður/kk", "búð/kvk"])
+    expected = model.nearest_neighbors(tv)
+    results = []
+
+    def query():
+        results.append(fresh.nearest_neighbors(fresh.topic_vector(["maður/kk", "búð/kvk"])))
+
+    threads = [threading.Thread(target=query) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(loads) == 1
+    assert results == [expected] * len(threads)
+    assert set(fresh.load_timings) >= {"dictionary", "engine", "similarity"}
+
+
+def test_serving_state(model: Model):
+    import os
+    import sys
+    import subprocess
+    import numpy as np
+    from greynir_topic.serving import ArrayVocabulary, ServingState
+
+    model.load_dictionary()
+    token2id = model._dictionary.token2id
+    vocab = ArrayVocabulary.from_token2id(token2id)
+    assert len(vocab) == len(token2id)
+    assert all(vocab[token] == ix for token, ix in token2id.items())
+    assert list(vocab) == sorted(token2id, key=token2id.get)
+    assert "ekki-til/kk" not in vocab and vocab.get(("maður", "kk")) is None
+
+    lemmas = ["maður/kk", "búð/kvk", "kaupa/so"]
+    tv = model.topic_vector(lemmas)
+    neighbors = model.nearest_neighbors(tv, with_scores=True)
+    model.export_serving_state()
+
+    served = Model("test")
+    served.load_serving_state()
+    assert served._dictionary is None and served._model is None
+    assert isinstance(served._engine.token2id, ArrayVocabulary)
+    assert isinstance(served._engine.projection, np.memmap)
+    assert dict(served.topic_vector(lemmas)) == pytest.approx(dict(tv))
+    assert dict(served.nearest_neighbors(tv, with_scores=True)) == pytest.approx(
+        dict(neighbors)
+    )
+
+    # Share the state in a block of shared memory and attach to it by name
+    shared = ServingState.load(served.serving_state_filename).share()
+    try:
+        attached = ServingState.attach(shared.name)
+        assert attached.nbytes == shared.nbytes
+        other = Model("test")
+        other.load_serving_state(attached)
+        assert dict(other.topic_vector(lemmas)) == pytest.approx(dict(tv))
+        assert other.nearest_neighbors(tv) == [ix for ix, _ in neighbors]
+        other._engine = other._simindex = None
+        attached.close()
+        # A separate process can attach and exit without destroying the block
+        code = (
+            "import sys; from greynir_topic.serving import ServingState; "
+            "s = ServingState.attach(sys.argv[1]); print(s.nbytes); s.close()"
+        )
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        for _ in range(2):
+            out = subprocess.run(
+                [sys.executable, "-c", code, shared.name], env=env, check=True,
+                stdout=subprocess.PIPE, universal_newlines=True,
+            ).stdout
+            assert int(out) == shared.nbytes
+        ServingState.attach(shared.name).close()
+    finally:
+        shared.unlink()
+
+
+def test_bundle(model: Model, tmp_path):
+    import os
+    import shutil
+    import numpy as np
+    from greynir_topic.bundle import write_bundle, read_bundle, read_bundle_header
+
+    # Round trip of arbitrary arrays, including an empty one
+    fname = str(tmp_path / "test.bundle")
+    arrays = {
+        "a": np.arange(10, dtype=np.int32),
+        "b": np.random.RandomState(0).rand(7, 3).astype(np.float32),
+        "empty": np.zeros(0, dtype=np.int64),
+    }
+    write_bundle(fname, arrays, {"key": "value"})
+    header = read_bundle_header(fname)
+    assert all(info["offset"] % 64 == 0 for info in header["sections"].values())
+    loaded, metadata = read_bundle(fname, verify=True)
+    assert metadata == {"key": "value"}
+    assert isinstance(loaded["b"], np.memmap)
+    for name, a in arrays.items():
+        assert loaded[name].dtype == a.dtype and (loaded[name] == a).all()
+    # Corruption is detected by checksum verification
+    del loaded
+    with open(fname, "r+b") as f:
+        f.seek(header["sections"]["a"]["offset"])
+        f.write(b"\xff")
+    with pytest.raises(ValueError):
+        read_bundle(fname, verify=True)
+    with pytest.raises(ValueError):
+        read_bundle(model.dictionary_filename)
+
+    # Export a model and serve it from the bundle
+    lemmas = ["maður/kk", "búð/kvk", "kaupa/so"]
+    tv = model.topic_vector(lemmas)
+    neighbors = model.nearest_neighbors(tv)
+    bundle_filename = model.export_bundle()
+    served = Model("test")
+    metadata = served.load_bundle(bundle_filename, verify=True)
+    assert metadata["num_documents"] == 4
+    assert metadata["dimensions"] == len(served._engine.projection[0])
+    assert served._dictionary is None and served._model is None
+    assert dict(served.topic_vector(lemmas)) == pytest.approx(dict(tv))
+    assert served.nearest_neighbors(tv) == neighbors
+
+    # A directory that holds nothing but the bundle
+    os.makedirs(str(tmp_path / "bundle_only"))
+    only = Model("b", directory=str(tmp_path / "bundle_only"))
+    shutil.copy(bundle_filename, only.bundle_filename)
+    only.load_bundle()
+    timings = only.warm_up(prefetch=True)
+    assert "serving" in timings and "prefetch" in timings
+    assert "dictionary" not in timings and only._dictionary is None
+    assert dict(only.topic_vector(lemmas)) == pytest.approx(dict(tv))
+    assert only.nearest_neighbors(tv) == neighbors
+
+
+def test_lazy_imports():
+    import os
+    import sys
+    import subprocess
+
+    # Importing the model does not import Gensim or the Greynir parser
+    code = (
+        "import sys; from greynir_topic import Model; "
+        "print(','.join(m for m in ('gensim', 'reynir') if m in sys.modules))"
+    )
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    out = subprocess.run(
+        [sys.executable, "-c", code], env=env, check=True,
+        stdout=subprocess.PIPE, universal_newlines=True,
+    ).stdout
+    assert out.strip() == ""